@@ -0,0 +1,294 @@
+#! /usr/bin/env python
+
+'''A reproducible load benchmark for downpour's fetchers.
+
+This spins up a local server (in its own process) that serves responses
+of configurable size, latency, status, compression and redirect chains,
+across many virtual hosts (every address in 127.0.0.0/8 is loopback, so
+each of 127.0.0.1, 127.0.0.2, ... is a distinct host to the fetchers). It
+then drives each fetcher against it (each in its own process, so that the
+measurements aren't polluted by the server or each other) and reports the
+throughput, latency percentiles, CPU time and peak RSS as JSON.
+
+The PoliteFetcher needs Redis, and so is only benchmarked if you provide
+a `redis-server` binary, which is started on a scratch port and thrown
+away afterwards. Results can be compared against a previous run's, and
+the exit code is non-zero if anything regressed by more than --tolerance:
+
+    python bench/benchmark.py --requests 5000 --output new.json
+    python bench/benchmark.py --requests 5000 --baseline old.json
+'''
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import urllib
+import resource
+import argparse
+import platform
+import subprocess
+
+def compress(body, encoding):
+    '''Encode a body the way a server would for this content-encoding'''
+    if encoding == 'gzip':
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(body) + c.flush()
+    elif encoding == 'deflate':
+        return zlib.compress(body)
+    return body
+
+##################
+# The server
+##################
+def serve(port):
+    '''Run the benchmark server until killed. A request for
+
+        /bench?size=1024&delay=10&status=200&encoding=gzip&redirects=2
+
+    waits 10ms, redirects twice, and then responds with a 200 and 1024
+    bytes of gzip-encoded content.'''
+    from twisted.internet import reactor
+    from twisted.web import server, resource
+
+    bodies = {}
+    def body(size, encoding):
+        key = (size, encoding)
+        if key not in bodies:
+            bodies[key] = compress(('downpour ' * (size / 9 + 1))[:size], encoding)
+        return bodies[key]
+
+    class Bench(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            args = dict((k, v[0]) for k, v in request.args.items())
+            delay = float(args.get('delay', 0)) / 1000.0
+            if not delay:
+                return self.respond(request, args)
+            reactor.callLater(delay, self.finish, request, args)
+            return server.NOT_DONE_YET
+
+        def finish(self, request, args):
+            request.write(self.respond(request, args))
+            request.finish()
+
+        def respond(self, request, args):
+            redirects = int(args.get('redirects', 0))
+            if redirects:
+                args['redirects'] = redirects - 1
+                args['delay'] = 0
+                request.setResponseCode(301)
+                request.setHeader('location', '/bench?' + urllib.urlencode(args))
+                return ''
+            request.setResponseCode(int(args.get('status', 200)))
+            encoding = args.get('encoding', 'identity')
+            if encoding != 'identity':
+                request.setHeader('content-encoding', encoding)
+            request.setHeader('content-type', 'text/html')
+            return body(int(args.get('size', 1024)), encoding)
+
+    root = resource.Resource()
+    root.putChild('bench', Bench())
+    site = server.Site(root)
+    # No access logs, please
+    site.log = lambda request: None
+    reactor.listenTCP(port, site, backlog=1024)
+    reactor.run()
+
+def waitFor(port, timeout=10.0):
+    '''Wait for something to be listening on the local port'''
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('Nothing listening on port %i' % port)
+
+##################
+# The workload
+##################
+def urls(options):
+    '''The (deterministic, given the seed) list of urls to fetch'''
+    rand = random.Random(options.seed)
+    sizes = [int(s) for s in options.sizes.split(',')]
+    results = []
+    for i in xrange(options.requests):
+        args = {
+            'size'    : rand.choice(sizes),
+            'delay'   : options.latency and rand.expovariate(1.0 / options.latency),
+            'status'  : (rand.random() < options.errors and 500) or 200,
+            'encoding': (rand.random() < options.compressed and 'gzip') or 'identity',
+            'redirects': (rand.random() < options.redirected and options.chain) or 0,
+            # Make each url unique
+            'i'       : i
+        }
+        host = '127.0.%i.%i' % ((i % options.hosts) / 254, (i % options.hosts) % 254 + 1)
+        results.append('http://%s:%i/bench?%s' % (host, options.port, urllib.urlencode(args)))
+    return results
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def drive(name, options):
+    '''Fetch the workload with the named fetcher, and print the results'''
+    import logging
+    # Each driver is a fresh process, so this is a cold import
+    start = time.time()
+    import downpour
+    importSeconds = time.time() - start
+    downpour.logger.setLevel(logging.CRITICAL)
+
+    latencies = []
+    received  = [0]
+    class BenchRequest(downpour.BaseRequest):
+        def onSuccess(self, text, fetcher):
+            received[0] += len(text)
+
+        def onDone(self, response, fetcher):
+            latencies.append(self.timing.breakdown()['total'])
+
+    if name == 'BaseFetcher':
+        fetcher = downpour.BaseFetcher(options.pool, stopWhenDone=True)
+    else:
+        import redis
+        redis.Redis(port=options.redis_port).flushdb()
+        fetcher = downpour.PoliteFetcher(options.pool, stopWhenDone=True,
+            delay=0.001, allowAll=True, port=options.redis_port)
+
+    requests = [BenchRequest(url) for url in urls(options)]
+    start = time.time()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    fetcher.extend(requests)
+    del requests
+    fetcher.start()
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    latencies.sort()
+    print json.dumps({
+        'fetcher'           : name,
+        'requests'          : len(latencies),
+        'seconds'           : elapsed,
+        'requestsPerSecond' : len(latencies) / elapsed,
+        'bytesPerSecond'    : received[0] / elapsed,
+        'latency'           : {
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': percentile(latencies, 1.00)
+        },
+        'importSeconds'     : importSeconds,
+        'cpuSeconds'        : (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        # On Linux, this is in kilobytes
+        'maxRSSBytes'       : after.ru_maxrss * 1024
+    })
+
+##################
+# Comparison
+##################
+def compare(results, baseline, tolerance):
+    '''Return a list of human-readable regressions'''
+    regressions = []
+    before = dict((r['fetcher'], r) for r in baseline['results'])
+    for result in results['results']:
+        old = before.get(result['fetcher'])
+        if not old:
+            continue
+        checks = [
+            ('requestsPerSecond', result['requestsPerSecond'], old['requestsPerSecond'], -1),
+            ('p99 latency', result['latency']['p99'], old['latency']['p99'], 1),
+            ('importSeconds', result.get('importSeconds'), old.get('importSeconds'), 1),
+            ('cpuSeconds', result['cpuSeconds'], old['cpuSeconds'], 1),
+            ('maxRSSBytes', result['maxRSSBytes'], old['maxRSSBytes'], 1)
+        ]
+        for name, new, was, sign in checks:
+            if new is None or not was:
+                continue
+            change = (new - was) / float(was)
+            if change * sign > tolerance:
+                regressions.append('%s %s: %s => %s (%+.1f%%)' % (
+                    result['fetcher'], name, was, new, change * 100))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark downpour fetchers')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of requests')
+    parser.add_argument('--hosts', type=int, default=50, help='Number of virtual hosts')
+    parser.add_argument('--pool', type=int, default=100, help='Fetcher pool size')
+    parser.add_argument('--sizes', default='1024,16384,131072', help='Response sizes to choose from')
+    parser.add_argument('--latency', type=float, default=5.0, help='Mean server latency (ms)')
+    parser.add_argument('--errors', type=float, default=0.05, help='Fraction of 500s')
+    parser.add_argument('--compressed', type=float, default=0.5, help='Fraction gzip-encoded')
+    parser.add_argument('--redirected', type=float, default=0.1, help='Fraction redirected')
+    parser.add_argument('--chain', type=int, default=2, help='Length of redirect chains')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the workload')
+    parser.add_argument('--port', type=int, default=8765, help='Port for the server')
+    parser.add_argument('--redis-server', default=None, help='redis-server binary, to benchmark the PoliteFetcher')
+    parser.add_argument('--redis-port', type=int, default=6399, help='Port for the scratch redis-server')
+    parser.add_argument('--output', default=None, help='Write the results JSON here')
+    parser.add_argument('--baseline', default=None, help='Compare against these results')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed regression (fraction)')
+    # These are used internally to run the server and the fetchers
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--drive', default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.serve:
+        return serve(options.port)
+    if options.drive:
+        return drive(options.drive, options)
+
+    argv = [sys.executable, os.path.abspath(__file__)] + (argv or sys.argv[1:])
+    processes = [subprocess.Popen(argv + ['--serve'])]
+    fetchers = ['BaseFetcher']
+    if options.redis_server:
+        processes.append(subprocess.Popen([options.redis_server, '--port',
+            str(options.redis_port), '--save', '', '--appendonly', 'no'],
+            stdout=open(os.devnull, 'w')))
+        fetchers.append('PoliteFetcher')
+    try:
+        waitFor(options.port)
+        if options.redis_server:
+            waitFor(options.redis_port)
+        results = {
+            'time'    : time.time(),
+            'python'  : platform.python_version(),
+            'platform': platform.platform(),
+            'options' : dict((k, v) for k, v in vars(options).items()
+                if k not in ('serve', 'drive', 'output', 'baseline')),
+            'results' : []
+        }
+        for name in fetchers:
+            output = subprocess.check_output(argv + ['--drive', name])
+            results['results'].append(json.loads(output.strip().split('\n')[-1]))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    import downpour
+    results['version'] = downpour.__version__
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    print text
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, 'REGRESSION: %s' % regression
+        return len(regressions) and 1 or 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
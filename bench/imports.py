@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+
+'''How long importing downpour takes, cold. Each import is timed in a fresh
+interpreter (the first one warms the filesystem cache, and isn't counted),
+and the results are reported as JSON, in seconds:
+
+    python bench/imports.py --runs 20
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+def timed(module):
+    '''Import module in a fresh interpreter, returning how long it took'''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    env.pop('DOWNPOUR_LOGGING', None)
+    code = 'import time; start = time.time(); import %s; print time.time() - start' % module
+    return float(subprocess.check_output([sys.executable, '-c', code], env=env).strip())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure how long importing downpour takes')
+    parser.add_argument('--runs', type=int, default=10, help='Number of imports to time')
+    parser.add_argument('--module', default='downpour', help='Module to import')
+    parser.add_argument('--output', default=None, help='Write the results JSON here')
+    options = parser.parse_args(argv)
+
+    timed(options.module)
+    times = sorted(timed(options.module) for i in range(options.runs))
+    text = json.dumps({
+        'module' : options.module,
+        'runs'   : options.runs,
+        'min'    : times[0],
+        'median' : times[len(times) / 2],
+        'max'    : times[-1]
+    }, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    print text
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
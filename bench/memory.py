@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+'''How much memory each request takes, while queued and while in flight.
+
+For each kind of request, a fresh process makes `--requests` of them (each
+with its own url, and headers like a crawler would send), and measures how
+much its resident set grew. It then makes a servicer for each, as though
+they were all in flight at once (but without connecting anywhere), and
+measures again. The results are reported as JSON, in bytes per request:
+
+    python bench/memory.py --requests 200000
+'''
+
+import os
+import gc
+import sys
+import json
+import resource
+import argparse
+import subprocess
+
+def rss():
+    '''The current resident set size, in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Not Linux. The peak is close enough, since we only ever grow
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return sys.platform == 'darwin' and usage or usage * 1024
+
+def measure(kind, count):
+    '''Measure this kind of request, and print the results'''
+    import downpour
+    from downpour.BaseRequestServicer import BaseRequestServicer
+    cls = getattr(downpour, kind)
+
+    gc.collect()
+    start = rss()
+    requests = [cls('http://host%i.example.com/path/%i.html' % (i % 1000, i),
+        headers={'Accept': 'text/html', 'Accept-Language': 'en'}) for i in xrange(count)]
+    gc.collect()
+    queued = rss()
+    servicers = [BaseRequestServicer(request, 'rogerbot/1.0') for request in requests]
+    gc.collect()
+    flight = rss()
+
+    print json.dumps({
+        'request'           : kind,
+        'requests'          : count,
+        'queuedBytes'       : float(queued - start) / count,
+        'inFlightBytes'     : float(flight - queued) / count
+    })
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the memory used per request')
+    parser.add_argument('--requests', type=int, default=100000, help='Number of requests')
+    parser.add_argument('--kinds', default='BaseRequest,SlimRequest', help='Request classes to measure')
+    parser.add_argument('--output', default=None, help='Write the results JSON here')
+    # This is used internally to measure each kind in its own process
+    parser.add_argument('--measure', default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.measure:
+        return measure(options.measure, options.requests)
+
+    argv = [sys.executable, os.path.abspath(__file__)] + (argv or sys.argv[1:])
+    results = []
+    for kind in options.kinds.split(','):
+        output = subprocess.check_output(argv + ['--measure', kind])
+        results.append(json.loads(output.strip().split('\n')[-1]))
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    print text
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,491 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''The twisted client factory that services downpour requests. This lives
+apart from the rest of downpour because importing twisted.web.client also
+installs the default reactor, and so it's only imported when a fetcher
+actually starts making requests.'''
+
+import time
+import urlparse
+from twisted.web import client
+from twisted.internet import ssl, defer
+from twisted.python.failure import Failure
+from downpour import Auth, AuthException, Timing, UserPreemptionError, parse, environProxy, reactor
+from downpour import ConnectTimeout, FirstByteTimeout, IdleTimeout, DeadlineTimeout, soonest
+from downpour import logger, requestLogger
+
+class TimedContextFactory(ssl.ClientContextFactory):
+    '''A client context factory that notes when the TLS handshake is done'''
+    def __init__(self, timing):
+        self.timing = timing
+
+    def getContext(self):
+        context = ssl.ClientContextFactory.getContext(self)
+        context.set_info_callback(self.info)
+        return context
+
+    def info(self, connection, where, ret):
+        from OpenSSL import SSL
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            self.timing.mark('secured')
+
+class PageGetter(client.HTTPPageGetter):
+    '''Twisted only follows 301, 302 and 303. 307 and 308 are the same as
+    302 and 301, except that the method can't change, which is what twisted
+    does for 301 anyway.'''
+    # Whether we've handed over the response, and how much of its body
+    # we've kept (a request can ask for only the start of it)
+    ended = False
+    kept  = 0
+
+    def handleStatus_301(self):
+        '''Twisted connects to where we're redirected itself, but if we're
+        racing addresses, the factory has to'''
+        location = self.headers.get('location')
+        if (self.factory.eyeballs is None or not location or not self.followRedirect or
+            self.factory._redirectCount + 1 >= self.factory.redirectLimit):
+            return client.HTTPPageGetter.handleStatus_301(self)
+        self.factory._redirectCount += 1
+        self._completelyDone = False
+        self.factory.setURL(location[0])
+        self.factory.reconnect()
+        self.quietLoss = True
+        self.transport.loseConnection()
+
+    def handleStatus_303(self):
+        '''Twisted switches to GET, but a HEAD request stays one'''
+        if self.factory.method != 'HEAD':
+            self.factory.method = 'GET'
+        return self.handleStatus_301()
+
+    def handleStatus_206(self):
+        '''Only part of the body, which is what we asked for'''
+        if not self.quietLoss:
+            self.factory.partial(self.headers.get('content-range'))
+
+    def handleStatus_307(self):
+        return self.handleStatus_301()
+
+    def handleStatus_308(self):
+        return self.handleStatus_301()
+
+    def handleStatus_401(self):
+        '''If we've got credentials for the challenge, try again with them'''
+        if not self.factory.authenticate(self.status, self.headers):
+            return self.handleStatusDefault()
+        self._completelyDone = False
+        self.factory.retry()
+        self.quietLoss = True
+        self.transport.loseConnection()
+
+    def handleStatus_407(self):
+        return self.handleStatus_401()
+
+    def dataReceived(self, data):
+        # Once we've given up on this connection (say, it's redirecting),
+        # what's left of it doesn't count
+        if not self.quietLoss:
+            self.factory.received()
+        return client.HTTPPageGetter.dataReceived(self, data)
+
+    def handleEndHeaders(self):
+        client.HTTPPageGetter.handleEndHeaders(self)
+        # A response to HEAD has no body, whatever its headers say, so
+        # there's no need to wait for the server to close the connection
+        if self.factory.method == 'HEAD' and not self.quietLoss:
+            self.handleResponseEnd()
+            self.quietLoss = True
+
+    def handleResponsePart(self, data):
+        '''Keep no more of the body than the request asked for, and once we
+        have that much, stop reading it (in case the server ignored Range)'''
+        if self.ended or self.quietLoss:
+            return
+        prefix = self.factory.prefix
+        self.kept += len(data)
+        if prefix is None or self.kept < prefix or (self.kept == prefix and self.length == 0):
+            return client.HTTPPageGetter.handleResponsePart(self, data)
+        client.HTTPPageGetter.handleResponsePart(self, data[:len(data) - (self.kept - prefix)])
+        self.factory.truncate()
+        # What's missing isn't a partial download, since we didn't want it
+        self.length = None
+        self.handleResponseEnd()
+        self.quietLoss = True
+
+    def handleResponseEnd(self):
+        self.ended = True
+        return client.HTTPPageGetter.handleResponseEnd(self)
+
+class BaseRequestServicer(client.HTTPClientFactory):
+    '''This class services requests, providing the request with
+    additional callbacks beyond those typically provided. For
+    example, it's by way of this class that `onHeaders`, `onURL`,
+    and `onStatus` are supported.'''
+    protocol = PageGetter
+    redirectCodes = ('301', '302', '307', '308')
+
+    def __init__(self, request, agent, redirects=None, chain=None, proxy=None, credentials=None, timeouts=None,
+        eyeballs=None):
+        '''Provide the request to service, and the user agent to identify with.
+        If a redirect cache is provided, redirects are recorded in it. If the
+        chain of urls that the request is known to redirect through is given,
+        it's fetched from the last one. If a proxy is given, every hop goes
+        through it. Credentials default to those registered with `Auth`.
+        Timeouts (by phase) apply where they're shorter than the request's.
+        If given a downpour.HappyEyeballs.HappyEyeballs, every hop races the
+        addresses of its host. If the request only wants the headers, it's
+        made with HEAD, and if it wants a prefix of the body, with Range.'''
+        self.request          = request
+        self.chosen           = proxy
+        self.credentials      = credentials or Auth.credentials
+        self.eyeballs         = eyeballs
+        self.challenged       = False
+        self.preempted        = False
+        # Credentials the request carries itself are left alone
+        self.explicit         = any(k.lower() == 'authorization' for k in (request.headers or {}))
+        self.redirects        = redirects
+        self.current          = None
+        self.status           = None
+        chain                 = chain or [request.url]
+        self.request.cached   = True
+        self.request.time     = -time.time()
+        self.request.encoding = None
+        self.request.truncated = False
+        self.prefix           = None if request.head else request.prefix
+        self.request.timing   = Timing(request.queued)
+        # Each phase has its own timer. Connecting (which includes resolving)
+        # and waiting for the first byte are timed on every hop, and idling
+        # whenever we're reading the response.
+        timeouts              = timeouts or {}
+        self.connectTimeout   = soonest(request.connectTimeout, timeouts.get('connect'))
+        self.firstByteTimeout = soonest(request.firstByteTimeout, timeouts.get('firstByte'))
+        self.idleTimeout      = soonest(request.idleTimeout, timeouts.get('idle'))
+        self.deadline         = soonest(request.timeout, timeouts.get('deadline'))
+        self.timers           = {}
+        self.connector        = None
+        self.p                = None
+        # Other requests for the same thing can follow this one, and get the
+        # same callbacks. Those they missed are replayed when they join. Each
+        # has a Deferred for the result, and they're (request, Deferred).
+        self.followers        = []
+        self.events           = []
+        # The hops we're skipping are still reported to the request
+        for url in chain[:-1]:
+            try:
+                self.tell('onURL', url)
+            except:
+                logger.exception('%s onURL failed', self.request.url)
+        client.HTTPClientFactory.__init__(self, url=chain[-1], agent=agent, headers=request.headers, timeout=0,
+            followRedirect=request.followRedirect, redirectLimit=request.redirectLimit, postdata=self.request.data,
+            method=request.head and 'HEAD' or 'GET')
+        # If the server doesn't do ranges, we stop reading once we have this
+        # much anyway, but it saves both of us sending the rest
+        if self.prefix:
+            self.headers.setdefault('Range', 'bytes=0-%i' % (self.prefix - 1))
+        # The deadline covers everything, but not a moment after we're done
+        self.timer('deadline', self.deadline, DeadlineTimeout)
+        self.deferred.addBoth(self.stopTimers)
+
+    def setURL(self, url):
+        '''Called when redirection occurs, with the new url.
+        This method is aware of the `*_proxy` environment
+        variables, and so if present, it will override the
+        default action, but the redirected url will still appear
+        as the argument to the request callback.'''
+        # Especially on redirects, the url can lack a domain name
+        url = urlparse.urljoin(self.current or self.request.url, url)
+        # If we're here because of a redirect, remember it
+        if self.redirects is not None and self.current and self.status in self.redirectCodes and self.request.data is None:
+            self.redirects.record(self.current, url, self.status)
+        self.current = url
+        self.request.timing.hop(url)
+        self.stopTimers(None, 'firstByte', 'idle')
+        self.timer('connect', self.connectTimeout, ConnectTimeout)
+        try:
+            self.tell('onURL', url)
+        except UserPreemptionError as e:
+            self.cancel(e)
+        except:
+            logger.exception('%s onURL failed', self.request.url)
+        scheme, host, port, path = parse(url)
+        self.proxy = self.chosen or environProxy(scheme) or self.request.proxy
+        # If a proxy is specified in the environment, or for this
+        # particular request, service it with that proxy
+        if self.proxy:
+            scheme, host, port, path = parse(self.proxy)
+            self.scheme = scheme
+            self.host = host
+            self.port = port
+            self.path = url
+            self.url = url
+            # Now, let's get an auth if there is any for the proxy
+            auth = self.credentials.preempt(self.proxy, self.method, url)
+            if auth:
+                self.headers.setdefault('Proxy-Authorization', auth)
+        else:
+            try:
+                client.HTTPClientFactory.setURL(self, url)
+            except TypeError:
+                # Twisted does not like to accept unicode strings. So,
+                # if it decides to be stupid, then we'll try to encode the
+                # url as utf-8
+                client.HTTPClientFactory.setURL(self, url.encode('utf-8'))
+        # If we know what this host will ask for, send it up front
+        self.preempt(url)
+        requestLogger.debug('URL: %s', self.url)
+
+    def preempt(self, url):
+        '''Authenticate the request for url before we're challenged, if we can'''
+        if self.explicit:
+            return
+        auth = self.credentials.preempt(url, self.method, parse(url)[3])
+        if auth:
+            self.headers['Authorization'] = auth
+            self.preempted = True
+        elif self.preempted:
+            # Don't send one host's credentials along to the next
+            del self.headers['Authorization']
+            self.preempted = False
+
+    def authenticate(self, status, headers):
+        '''Got a 401 or 407 with these headers. If we can answer the challenge
+        (and haven't already tried), then add the headers to do so.'''
+        if self.challenged:
+            return False
+        self.challenged = True
+        try:
+            if status == '407':
+                auth = self.credentials.challenge(self.proxy, headers, self.method, self.path)
+            else:
+                auth = self.credentials.challenge(self.current, headers, self.method, parse(self.current)[3])
+        except AuthException as e:
+            logger.warn('%s : %s', self.request.url, e)
+            return False
+        self.headers.update(auth)
+        return bool(auth)
+
+    def retry(self):
+        '''Make the request for the current url again'''
+        self.request.timing.hop(self.current)
+        self.stopTimers(None, 'firstByte', 'idle')
+        self.timer('connect', self.connectTimeout, ConnectTimeout)
+        self.reconnect()
+
+    def reconnect(self):
+        '''Connect to the current host (or proxy)'''
+        contextFactory = None
+        if self.scheme == 'https':
+            contextFactory = TimedContextFactory(self.request.timing)
+        port = self.port or (contextFactory and 443 or 80)
+        if self.eyeballs is not None:
+            return self.eyeballs.connect(self.host, port, self, contextFactory, self.request.timing)
+        elif contextFactory is not None:
+            return reactor.connectSSL(self.host, port, self, contextFactory)
+        else:
+            return reactor.connectTCP(self.host, port, self)
+
+    def gotHeaders(self, headers):
+        '''Received headers, a dictionary of lists.'''
+        try:
+            # This request is marked as cached iff every request was served out
+            # of the cache specified, and it was a hit.
+            cached = self.proxy and ('HIT from %s' % self.host) in ';'.join(headers.get('x-cache', ''))
+            self.request.cached = self.request.cached and cached
+            # Set the request's encoding, if applicable
+            self.request.encoding = ';'.join(headers.get('content-encoding', ['identity']))
+            self.tell('onHeaders', headers)
+        except UserPreemptionError as e:
+            self.cancel(e)
+        except:
+            logger.exception('%s onHeaders failed', self.request.url)
+        # The general gotHeaders stuff
+        try:
+            # Friggin' client.HTTPClientFactory likes to die here when confronted
+            # with invalid set cookie headers. Sure, maybe that's the best practice,
+            # but maybe it's just stupid
+            client.HTTPClientFactory.gotHeaders(self, headers)
+        except:
+            # Ignore all the cookie stuff
+            pass
+
+    def gotStatus(self, version, status, message):
+        '''Received the HTTP version, status and status message.'''
+        self.request.timing.mark('firstByte')
+        try:
+            self.tell('onStatus', version, status, message)
+        except UserPreemptionError as e:
+            self.cancel(e)
+        except:
+            logger.exception('%s onStatus failed', self.request.url)
+        client.HTTPClientFactory.gotStatus(self, version, status, message)
+
+    def buildProtocol(self, *args, **kwargs):
+        '''In order to facilitate user preemption, we need to remember
+        the protocol we made. So, save it and pass through.'''
+        self.request.timing.mark('connected')
+        self.stopTimers(None, 'connect')
+        self.timer('firstByte', self.firstByteTimeout, FirstByteTimeout)
+        self.p = client.HTTPClientFactory.buildProtocol(self, *args, **kwargs)
+        return self.p
+
+    def startedConnecting(self, connector):
+        '''We're about to connect (and, on redirects, resolve)'''
+        # A race marks when it's connecting itself, once it's resolved
+        if not getattr(connector, 'resolving', False):
+            self.request.timing.mark('connecting')
+        self.connector = connector
+
+    def received(self):
+        '''Some of the response arrived, so it's no longer idle'''
+        self.stopTimers(None, 'firstByte')
+        if self.idleTimeout:
+            idle = self.timers.get('idle')
+            if idle is not None and idle.active():
+                idle.reset(self.idleTimeout)
+            else:
+                self.timer('idle', self.idleTimeout, IdleTimeout)
+
+    def timer(self, name, seconds, error):
+        '''Time out with this error if the timer isn't stopped in time'''
+        self.stopTimers(None, name)
+        if seconds:
+            self.timers[name] = reactor.callLater(seconds, self.expire, error, seconds)
+
+    def stopTimers(self, result, *names):
+        '''Stop these timers (all of them, by default), passing the result
+        through, so that it can be a callback'''
+        for name in (names or self.timers.keys()):
+            call = self.timers.pop(name, None)
+            if call is not None and call.active():
+                call.cancel()
+        return result
+
+    def expire(self, error, seconds):
+        '''A timer went off, so give up on this request'''
+        self.stopTimers(None)
+        failure = Failure(error(self.current or self.url, seconds))
+        requestLogger.debug('%s', failure.value)
+        if self.connector is not None and self.connector.state == 'connecting':
+            self.clientConnectionFailed(None, failure)
+            self.connector.stopConnecting()
+        elif self.p is not None and getattr(self.p.transport, 'connected', False):
+            self.noPage(failure)
+            self.p.quietLoss = True
+            self.p.transport.loseConnection()
+        else:
+            # Still resolving, so there's no connection to wait for
+            self.clientConnectionFailed(None, failure)
+
+    def partial(self, ranges):
+        '''Got a 206 with this Content-Range. Unless that's everything there
+        is, the body's truncated.'''
+        try:
+            span, _, total = ranges[0].rpartition('/')
+            end = int(span.rpartition('-')[2])
+            self.request.truncated = total.strip() == '*' or end + 1 < int(total)
+        except (TypeError, IndexError, ValueError):
+            self.request.truncated = True
+
+    def truncate(self):
+        '''We stopped reading the body before the end of it'''
+        self.request.truncated = True
+
+    def page(self, page):
+        '''Got the whole response'''
+        self.request.timing.mark('end')
+        client.HTTPClientFactory.page(self, page)
+
+    def noPage(self, reason):
+        '''Failed to get the response'''
+        self.request.timing.mark('end')
+        client.HTTPClientFactory.noPage(self, reason)
+
+    def tell(self, name, *args):
+        '''Call this callback on the request, and on those following it. Only
+        the request's own exceptions (like cancelling) are passed on.'''
+        self.events.append((name, args))
+        for request, d in list(self.followers):
+            self.call(request, name, args)
+        return getattr(self.request, name)(*args)
+
+    def follow(self, request):
+        '''Give this request the same callbacks as ours, from now on. Returns
+        a Deferred that fires with our result (or sooner, if it cancels).'''
+        d = defer.Deferred()
+        request.time = -time.time()
+        request.timing = Timing(request.queued)
+        self.followers.append((request, d))
+        for name, args in self.events:
+            if d.called:
+                break
+            self.call(request, name, args)
+        return d
+
+    def call(self, request, name, args):
+        try:
+            getattr(request, name)(*args)
+        except UserPreemptionError as e:
+            # A follower cancelling only lets go of the transfer
+            self.detach(request, e)
+        except Exception:
+            logger.exception('%s %s failed', request.url, name)
+
+    def detach(self, request, err):
+        '''Stop following this request, and fail it with err'''
+        for pair in self.followers:
+            if pair[0] is request:
+                self.followers.remove(pair)
+                pair[1].errback(Failure(err))
+                return
+
+    def fanout(self, result):
+        '''Hand our result to those following us'''
+        followers, self.followers = self.followers, []
+        for request, d in followers:
+            request.encoding  = self.request.encoding
+            request.cached    = self.request.cached
+            request.truncated = self.request.truncated
+            # Their own timing, with the milestones of the transfer we shared
+            request.timing.hops = [dict(hop) for hop in self.request.timing.hops]
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def finished(self, result):
+        '''Everything's done with this request, so let go of it and of the
+        protocol (which refers back to us), so that they can be freed as
+        soon as the last reference to us is gone'''
+        self.p = None
+        self.request = None
+        self.followers = []
+        return result
+
+    def cancel(self, err):
+        '''If the user needs to preempt the transfer. For example, if looking
+        at the content headers, we decide we don't want to get the file.'''
+        self.noPage(Failure(err))
+        self.p.quietLoss = True
+        self.p.transport.loseConnection()
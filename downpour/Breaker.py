@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+'''Stop fetching from hosts that are down, until they come back'''
+
+import time
+import threading
+from downpour import logger
+from downpour.Keys import Cache
+from twisted.web import error
+from twisted.internet import defer, error as net
+from twisted.python.failure import Failure
+
+class CircuitOpenError(Exception):
+    '''A request wasn't fetched, because its host's circuit is open'''
+    def __init__(self, key, until):
+        Exception.__init__(self, key, until)
+        self.key   = key
+        self.until = until
+
+    def __str__(self):
+        return 'Circuit open for %s for another %.1fs' % (self.key, max(self.until - time.time(), 0))
+
+class Circuit(object):
+    '''How one host has been doing. Once it's open, `until` is when the next
+    probe can go.'''
+    def __init__(self):
+        self.failures = 0
+        self.until    = None
+
+class Breaker(object):
+    '''A circuit breaker for each host. After `failures` connect failures,
+    DNS errors or timeouts in a row, its circuit opens, and the rest of its
+    requests are failed right away (in 'fail' mode) or held back (in 'park'
+    mode) instead of each waiting out its timeout. Every `cooldown` seconds
+    a single request is let through as a probe, and if it gets a response,
+    of any status, the circuit closes again.'''
+    # The failures that say the host can't be reached, as opposed to ones
+    # that it gave us
+    trips = (net.DNSLookupError, net.ConnectError, net.TimeoutError, defer.TimeoutError)
+    modes = ('fail', 'park')
+
+    def __init__(self, failures=5, cooldown=60, mode='fail', size=100000):
+        if mode not in self.modes:
+            raise ValueError('Unknown circuit breaker mode %s' % mode)
+        self.failures = failures
+        self.cooldown = cooldown
+        self.mode     = mode
+        # Only hosts that have failed lately have circuits
+        self.circuits = Cache(size)
+        self.lock     = threading.Lock()
+        # Running totals
+        self.opened   = 0
+        self.shed     = 0
+
+    def __len__(self):
+        '''How many circuits are open'''
+        with self.circuits.lock:
+            return len([c for c in self.circuits.items.values() if c.until is not None])
+
+    def until(self, key):
+        '''When the next request for this key can go: 0 if it can now'''
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit.until is None:
+            return 0
+        return circuit.until
+
+    def allow(self, key):
+        '''Whether to fetch a request for this key. While its circuit is open,
+        this is only true once per `cooldown`, for the probe.'''
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit.until is None:
+            return True
+        now = time.time()
+        with self.lock:
+            if circuit.until > now:
+                return False
+            # Until we hear back from the probe, hold the rest back
+            circuit.until = now + self.cooldown
+            return True
+
+    def success(self, key):
+        '''A request for this key got a response'''
+        circuit = self.circuits.pop(key)
+        if circuit is not None and circuit.until is not None:
+            logger.info('Closing circuit for %s', key)
+
+    def failure(self, key):
+        '''A request for this key couldn't reach it. Returns whether the
+        circuit is (now) open.'''
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if circuit is None:
+                circuit = Circuit()
+                self.circuits.set(key, circuit)
+            circuit.failures += 1
+            if circuit.until is None and circuit.failures < self.failures:
+                return False
+            if circuit.until is None:
+                logger.warn('Opening circuit for %s after %i failures', key, circuit.failures)
+                self.opened += 1
+            # A failed probe keeps it open for another cooldown
+            circuit.until = time.time() + self.cooldown
+            return True
+
+    def record(self, key, result):
+        '''Feed the outcome of a request (its body, or a Failure) for this key
+        to its circuit. Failures other than `trips` don't count either way.'''
+        if not isinstance(result, Failure):
+            self.success(key)
+        elif isinstance(result.value, self.trips):
+            self.failure(key)
+        elif isinstance(result.value, error.Error):
+            # An HTTP error status still means it's up
+            self.success(key)
+
+    def error(self, key):
+        '''The failure to give the requests that are shed for this key'''
+        self.shed += 1
+        return Failure(CircuitOpenError(key, self.until(key)))
+
+    def stats(self):
+        return {
+            'open'  : len(self),
+            'opened': self.opened,
+            'shed'  : self.shed
+        }
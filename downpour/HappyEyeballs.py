@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+'''Connect to whichever of a host's addresses answers first'''
+
+import time
+import socket
+from downpour import logger
+from downpour.Keys import Cache
+from twisted.internet import abstract, defer, error, protocol
+from twisted.python.failure import Failure
+
+def interleave(first, second):
+    '''Alternate between the items of two lists, starting with the first'''
+    result = []
+    for i in range(max(len(first), len(second))):
+        result.extend(first[i:i + 1] + second[i:i + 1])
+    return result
+
+class Attempt(protocol.ClientFactory):
+    '''One address being tried as part of a race'''
+    def __init__(self, race, address, index):
+        self.race      = race
+        self.address   = address
+        # How many were tried before this one
+        self.index     = index
+        self.connector = None
+
+    def buildProtocol(self, addr):
+        return self.race.won(self, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.race.failed(self, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.race.winner is self:
+            self.race.factory.clientConnectionLost(self.race, reason)
+
+class Race(object):
+    '''Connecting a factory to one of the addresses of a host. To the factory,
+    it's the connector, and it's 'connecting' until an attempt wins.'''
+    def __init__(self, eyeballs, host, port, factory, contextFactory=None, timing=None):
+        self.eyeballs       = eyeballs
+        self.host           = host
+        self.port           = port
+        self.factory        = factory
+        self.contextFactory = contextFactory
+        self.timing         = timing
+        self.state          = 'connecting'
+        self.resolving      = True
+        self.pending        = []
+        self.attempts       = []
+        self.tried          = 0
+        self.winner         = None
+        self.failure        = None
+        self.staggered      = None
+
+    def __repr__(self):
+        return '<Race %s:%s>' % (self.host, self.port)
+
+    def start(self):
+        self.factory.startedConnecting(self)
+        if self.timing:
+            self.timing.mark('resolving')
+        d = self.eyeballs.resolve(self.host, self.port)
+        d.addCallbacks(self.resolved, self.lose)
+        return self
+
+    def resolved(self, addresses):
+        self.resolving = False
+        if self.state != 'connecting':
+            return
+        if self.timing:
+            self.timing.mark('resolved')
+            self.timing.mark('connecting')
+        self.pending = list(addresses)
+        self.next()
+
+    def next(self):
+        '''Start on the next address, and if it hasn't connected in a little
+        while, the one after that'''
+        if self.staggered is not None and self.staggered.active():
+            self.staggered.cancel()
+        if not self.pending:
+            if not self.attempts:
+                self.lose(self.failure or Failure(error.DNSLookupError(self.host)))
+            return
+        from downpour import reactor
+        attempt = Attempt(self, self.pending.pop(0), self.tried)
+        self.attempts.append(attempt)
+        self.tried += 1
+        if self.contextFactory is not None:
+            attempt.connector = reactor.connectSSL(attempt.address[1], self.port, attempt, self.contextFactory)
+        else:
+            attempt.connector = reactor.connectTCP(attempt.address[1], self.port, attempt)
+        if self.pending:
+            self.staggered = reactor.callLater(self.eyeballs.stagger, self.next)
+
+    def won(self, attempt, addr):
+        if self.state != 'connecting':
+            return None
+        self.state  = 'connected'
+        self.winner = attempt
+        self.stop(attempt)
+        self.eyeballs.worked(self.host, attempt.address, attempt.index > 0)
+        return self.factory.buildProtocol(addr)
+
+    def failed(self, attempt, reason):
+        if attempt in self.attempts:
+            self.attempts.remove(attempt)
+        if self.state != 'connecting':
+            return
+        self.failure = reason
+        self.eyeballs.failed(self.host, attempt.address)
+        # Don't wait to try the next one
+        self.next()
+
+    def stop(self, keep=None):
+        '''Give up on every attempt (but this one)'''
+        if self.staggered is not None and self.staggered.active():
+            self.staggered.cancel()
+        self.pending = []
+        for attempt in list(self.attempts):
+            if attempt is not keep and attempt.connector.state == 'connecting':
+                attempt.connector.stopConnecting()
+
+    def lose(self, reason):
+        if self.state != 'connecting':
+            return
+        self.state = 'disconnected'
+        self.factory.clientConnectionFailed(self, reason)
+
+    def stopConnecting(self):
+        if self.state != 'connecting':
+            raise error.NotConnectingError()
+        self.lose(Failure(error.UserError()))
+        self.stop()
+
+class HappyEyeballs(object):
+    '''Connects to a host by resolving all of its addresses, and racing them:
+    IPv6 and IPv4 alternate, and each attempt gets a head start of `stagger`
+    seconds before the next begins (or none, if it fails). The address that
+    won is remembered for each host, and tried first next time. Resolved
+    addresses are kept for `ttl` seconds.'''
+    def __init__(self, stagger=0.25, ttl=300, size=100000, getaddrinfo=socket.getaddrinfo):
+        self.stagger     = stagger
+        self.ttl         = ttl
+        self.getaddrinfo = getaddrinfo
+        # host => (expiry, addresses), and host => the address that worked
+        self.addresses   = Cache(size)
+        self.winners     = Cache(size)
+        # Running totals
+        self.races       = 0
+        self.fallbacks   = 0
+
+    def lookup(self, host, port):
+        '''All of the (family, address) pairs for this host, in the order
+        the resolver gives them. This blocks.'''
+        found = []
+        for family, socktype, proto, name, sockaddr in self.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            if family in (socket.AF_INET, socket.AF_INET6) and (family, sockaddr[0]) not in found:
+                found.append((family, sockaddr[0]))
+        return found
+
+    def resolve(self, host, port):
+        '''A Deferred of the (family, address) pairs to try for this host,
+        in the order to try them'''
+        from downpour import reactor
+        from twisted.internet.threads import deferToThreadPool
+        if abstract.isIPAddress(host):
+            return defer.succeed([(socket.AF_INET, host)])
+        if abstract.isIPv6Address(host):
+            return defer.succeed([(socket.AF_INET6, host)])
+        cached = self.addresses.get(host)
+        if cached is not None and cached[0] > time.time():
+            return defer.succeed(self.order(host, cached[1]))
+        d = deferToThreadPool(reactor, reactor.getThreadPool(), self.lookup, host, port)
+        d.addErrback(self.unresolved, host)
+        return d.addCallback(self.remember, host)
+
+    def unresolved(self, failure, host):
+        failure.trap(socket.error)
+        raise error.DNSLookupError(host, failure.getErrorMessage())
+
+    def remember(self, addresses, host):
+        if not addresses:
+            raise error.DNSLookupError(host)
+        self.addresses.set(host, (time.time() + self.ttl, addresses))
+        return self.order(host, addresses)
+
+    def order(self, host, addresses):
+        '''The families alternate, starting with IPv6 unless IPv4 worked last
+        time, and the address that worked last time goes first'''
+        v6 = [a for a in addresses if a[0] == socket.AF_INET6]
+        v4 = [a for a in addresses if a[0] == socket.AF_INET]
+        winner = self.winners.get(host)
+        if winner is not None and winner[0] == socket.AF_INET:
+            ordered = interleave(v4, v6)
+        else:
+            ordered = interleave(v6, v4)
+        if winner in ordered:
+            ordered.remove(winner)
+            ordered.insert(0, winner)
+        return ordered
+
+    def worked(self, host, address, fallback=False):
+        self.races += 1
+        if fallback:
+            self.fallbacks += 1
+            logger.debug('Connected to %s at %s after others failed to', host, address[1])
+        self.winners.set(host, address)
+
+    def failed(self, host, address):
+        if self.winners.get(host) == address:
+            self.winners.pop(host)
+
+    def connect(self, host, port, factory, contextFactory=None, timing=None):
+        '''Connect the factory to whichever of host's addresses is first to
+        answer, over TLS if there's a contextFactory. The factory's timing
+        (if given) is marked as we resolve and connect.'''
+        return Race(self, host, port, factory, contextFactory, timing).start()
+
+    def stats(self):
+        return {
+            'hosts'    : len(self.winners.items),
+            'races'    : self.races,
+            'fallbacks': self.fallbacks
+        }
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''Consistent hashing, to spread keys across a number of nodes'''
+
+import bisect
+import hashlib
+
+class HashRing(object):
+    '''Each node is placed at `replicas` points around a ring, and a key
+    belongs to the first node clockwise from where the key hashes to. So,
+    adding or removing a node only moves the keys between it and its
+    neighbors, about 1/N of them.'''
+    def __init__(self, nodes=None, replicas=160):
+        self.replicas = replicas
+        self.nodes    = []
+        self.ring     = []
+        self.points   = {}
+        for node in (nodes or []):
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, node):
+        '''Put this node on the ring'''
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            point = self.hash('%s#%i' % (node, i))
+            self.points[point] = node
+            bisect.insort(self.ring, point)
+
+    def remove(self, node):
+        '''Take this node off of the ring'''
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        for i in range(self.replicas):
+            point = self.hash('%s#%i' % (node, i))
+            if self.points.get(point) == node:
+                del self.points[point]
+                self.ring.remove(point)
+
+    def get(self, key):
+        '''The node this key belongs to'''
+        if not self.ring:
+            return None
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        index = bisect.bisect(self.ring, self.hash(key)) % len(self.ring)
+        return self.points[self.ring[index]]
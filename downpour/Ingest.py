@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''Read requests from files a line at a time, so that they can be fed to a
+fetcher without ever holding all of them in memory'''
+
+import sys
+import gzip
+import json
+from downpour import BaseRequest, logger
+
+def open_(path):
+    '''Open path for reading (or stdin for '-'), decompressing it if it's
+    gzipped, whatever it's called'''
+    if path == '-':
+        return sys.stdin
+    f = open(path, 'rb')
+    magic = f.read(2)
+    f.seek(0)
+    if magic == '\x1f\x8b':
+        return gzip.GzipFile(fileobj=f)
+    return f
+
+def lines(path):
+    '''Each line in path, stripped, skipping blank lines and # comments'''
+    f = open_(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict((utf8(k), utf8(v)) for k, v in value.iteritems())
+    return value
+
+def text(path, cls=BaseRequest):
+    '''A request for each url in path, one per line'''
+    for line in lines(path):
+        yield cls(line)
+
+def jsonl(path, cls=BaseRequest):
+    '''A request for each line of JSON in path, which is either just the url,
+    or an object with the `url`, and optionally the `headers`, `data` and
+    `proxy` to make it with. Lines that aren't any of those are skipped.'''
+    for number, line in enumerate(lines(path)):
+        try:
+            record = utf8(json.loads(line))
+            if isinstance(record, basestring):
+                yield cls(record)
+            else:
+                yield cls(record['url'], data=record.get('data'),
+                    proxy=record.get('proxy'), headers=record.get('headers'))
+        except (ValueError, KeyError, TypeError):
+            logger.warn('Skipping record %i of %s : %s', number + 1, path, line[:100])
+
+formats = {
+    'text' : text,
+    'jsonl': jsonl
+}
+
+def read(path, cls=BaseRequest, format=None):
+    '''Requests from path, in the given format, or if none is given, JSONL if
+    it's named like it (.jsonl, or .json, possibly with .gz), and text if not'''
+    if format is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        format = name.endswith(('.jsonl', '.json')) and 'jsonl' or 'text'
+    return formats[format](path, cls)
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''Ways of deciding which politeness key a url falls under. Politeness
+(the crawl delay, and the cap on parallel requests) applies per key, so
+the key should be at the level that matters to the remote server: the
+hostname, the registered domain (so that a site's thousands of
+subdomains share a slot) or the address the hostname resolves to (so
+that thousands of hostnames on one shared host do).'''
+
+import os
+import time
+import socket
+import urlparse
+import threading
+from collections import OrderedDict
+
+class Cache(object):
+    '''A small, thread-safe LRU of the most recent `size` lookups'''
+    def __init__(self, size=100000):
+        self.size  = size
+        self.items = OrderedDict()
+        self.lock  = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+def hostname(url):
+    return urlparse.urlparse(url.strip()).hostname
+
+class HostnameKey(object):
+    '''Every hostname is its own key'''
+    def __call__(self, url):
+        return 'domain:%s' % hostname(url)
+
+class PublicSuffixList(object):
+    '''The rules from publicsuffix.org, by default from the copy bundled
+    with downpour, to find the domain a hostname is registered under.'''
+    bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat')
+
+    def __init__(self, path=None):
+        self.rules      = set()
+        self.wildcards  = set()
+        self.exceptions = set()
+        with open(path or self.bundled) as f:
+            for line in f:
+                rule = line.strip().split(' ', 1)[0]
+                if not rule or rule.startswith('//'):
+                    continue
+                # Hostnames in urls are usually punycoded, so we'll have
+                # the rules both ways
+                forms = set([rule])
+                try:
+                    forms.add(rule.decode('utf-8').encode('idna'))
+                except UnicodeError:
+                    pass
+                for form in forms:
+                    if form.startswith('!'):
+                        self.exceptions.add(form[1:])
+                    elif form.startswith('*.'):
+                        self.wildcards.add(form[2:])
+                    else:
+                        self.rules.add(form)
+
+    def suffix(self, host):
+        '''The public suffix of this hostname'''
+        labels = host.lower().strip('.').split('.')
+        for i in range(len(labels)):
+            candidate = '.'.join(labels[i:])
+            if candidate in self.exceptions:
+                return '.'.join(labels[i + 1:])
+            if candidate in self.rules or '.'.join(labels[i + 1:]) in self.wildcards:
+                return candidate
+        # If nothing else, the rule is *
+        return labels[-1]
+
+    def registered(self, host):
+        '''The registered domain of this hostname (one label more than its
+        public suffix). A public suffix, or an address, is its own.'''
+        host = host.lower().strip('.')
+        if all(part.isdigit() for part in host.split('.')) or ':' in host:
+            return host
+        suffix = self.suffix(host)
+        if host == suffix:
+            return host
+        return host[:-len(suffix) - 1].rsplit('.', 1)[-1] + '.' + suffix
+
+class DomainKey(object):
+    '''Hostnames under the same registered domain share a key'''
+    def __init__(self, suffixes=None, size=100000):
+        self.suffixes = suffixes
+        self.cache    = Cache(size)
+        self.lock     = threading.Lock()
+
+    def __call__(self, url):
+        host = hostname(url) or ''
+        key = self.cache.get(host)
+        if key is None:
+            with self.lock:
+                # The list is only loaded when we need it
+                if self.suffixes is None:
+                    self.suffixes = PublicSuffixList()
+            key = 'domain:%s' % self.suffixes.registered(host)
+            self.cache.set(host, key)
+        return key
+
+class AddressKey(object):
+    '''Hostnames that resolve to the same address share a key. Lookups are
+    cached for `ttl` seconds, but a miss resolves the hostname then and
+    there (blocking), so this is best when hostnames repeat a lot. Use
+    `cached` to find out first whether it would. If a hostname doesn't
+    resolve, it gets a key of its own.'''
+    def __init__(self, ttl=3600, size=100000, resolve=socket.gethostbyname):
+        self.ttl     = ttl
+        self.cache   = Cache(size)
+        self.resolve = resolve
+
+    def cached(self, url):
+        '''This url's key, if its hostname's been looked up lately, or None'''
+        found = self.cache.get(hostname(url) or '')
+        if found and found[1] > time.time():
+            return found[0]
+        return None
+
+    def __call__(self, url):
+        key = self.cached(url)
+        if key is not None:
+            return key
+        host = hostname(url) or ''
+        now = time.time()
+        try:
+            key = 'domain:%s' % self.resolve(host)
+        except (socket.error, UnicodeError):
+            key = 'domain:%s' % host
+        self.cache.set(host, (key, now + self.ttl))
+        return key
+
+strategies = {
+    'hostname': HostnameKey,
+    'domain'  : DomainKey,
+    'address' : AddressKey
+}
+
+def strategy(key=None):
+    '''A key strategy by name ('hostname', 'domain' or 'address'), or the
+    provided one (a callable of a url), or the default ('hostname')'''
+    if callable(key):
+        return key
+    try:
+        return strategies[key or 'hostname']()
+    except KeyError:
+        raise ValueError('Unknown key strategy %s' % repr(key))
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''Throughput and latency metrics for fetchers'''
+
+import time
+import bisect
+import threading
+
+class Histogram(object):
+    '''A fixed-bucket histogram, cumulative in the Prometheus sense only
+    when rendered. Quantiles are estimated by interpolating in buckets.'''
+    # Default buckets (in seconds) are tuned for HTTP latencies
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.buckets)
+        # One more count than bucket, for +Inf
+        self.counts  = [0] * (len(self.buckets) + 1)
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''Estimate the q-th quantile (0 <= q <= 1)'''
+        if not self.count:
+            return None
+        rank  = q * self.count
+        seen  = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        # It's in the +Inf bucket, and the best we can say is the last bound
+        return self.buckets[-1]
+
+class Metrics(object):
+    '''Counters, gauges and histograms, keyed by name and labels. Fetchers
+    feed these as requests complete; you can read them with `snapshot`,
+    have snapshots delivered periodically with `every`, or serve them in
+    the Prometheus text format with `listen`.'''
+    def __init__(self, buckets=None, maxHosts=100):
+        self.buckets    = buckets
+        self.counters   = {}
+        self.gauges     = {}
+        self.histograms = {}
+        # The number of distinct hosts to label. Everything else is
+        # lumped together as 'other', to keep the cardinality bounded.
+        self.maxHosts   = maxHosts
+        self.hosts      = set()
+        self.lock       = threading.Lock()
+        # For computing rates between snapshots
+        self.started    = time.time()
+        self.last       = (self.started, {})
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def host(self, host):
+        '''The label to use for the provided host'''
+        with self.lock:
+            if host in self.hosts:
+                return host
+            if len(self.hosts) < self.maxHosts:
+                self.hosts.add(host)
+                return host
+        return 'other'
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram(self.buckets)
+            h.observe(value)
+
+    def timed(self, name, **labels):
+        '''A context manager that observes how long its body took'''
+        return _Timed(self, name, labels)
+
+    # Fetcher-facing hooks
+    def request(self, host, status, size, total, connect=None, ttfb=None):
+        '''Record a finished request. The status is a string like '200',
+        or None if we never got one.'''
+        status = (status and (status[0] + 'xx')) or 'error'
+        host   = self.host(host)
+        self.inc('downpour_requests_total', status=status)
+        self.inc('downpour_bytes_total', size or 0)
+        self.observe('downpour_request_seconds', total, status=status, host=host)
+        if connect is not None:
+            self.observe('downpour_connect_seconds', connect, status=status, host=host)
+        if ttfb is not None:
+            self.observe('downpour_ttfb_seconds', ttfb, status=status, host=host)
+
+    def phases(self, breakdown):
+        '''Record a request's timing breakdown (see downpour.Timing)'''
+        for phase, value in breakdown.items():
+            if value is not None:
+                self.observe('downpour_phase_seconds', value, phase=phase)
+
+    def pool(self, inFlight, size):
+        self.set('downpour_pool_in_flight', inFlight)
+        self.set('downpour_pool_size', size)
+
+    def snapshot(self):
+        '''A plain dictionary summarizing everything, including rates
+        of the counters since the last snapshot was taken.'''
+        now = time.time()
+        with self.lock:
+            counters   = dict(self.counters)
+            gauges     = dict(self.gauges)
+            histograms = dict((k, (h.count, h.sum, h.quantile(0.5), h.quantile(0.9),
+                h.quantile(0.99))) for k, h in self.histograms.items())
+        then, previous = self.last
+        self.last = (now, counters)
+        elapsed = (now - then) or 1e-9
+
+        def totals(name):
+            # Sum a counter across all of its labels
+            current = sum(v for (n, l), v in counters.items() if n == name)
+            before  = sum(v for (n, l), v in previous.items() if n == name)
+            return current, (current - before) / elapsed
+
+        requests, requestRate = totals('downpour_requests_total')
+        received, byteRate    = totals('downpour_bytes_total')
+        return {
+            'time'             : now,
+            'uptime'           : now - self.started,
+            'requests'         : requests,
+            'requestsPerSecond': requestRate,
+            'bytes'            : received,
+            'bytesPerSecond'   : byteRate,
+            'counters'         : dict((_name(k), v) for k, v in counters.items()),
+            'gauges'           : dict((_name(k), v) for k, v in gauges.items()),
+            'histograms'       : dict((_name(k), {
+                'count': c, 'sum': s, 'p50': p50, 'p90': p90, 'p99': p99
+            }) for k, (c, s, p50, p90, p99) in histograms.items())
+        }
+
+    def render(self):
+        '''Everything in the Prometheus text exposition format'''
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(k[0] for k in values)):
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    for key in sorted(k for k in values if k[0] == name):
+                        lines.append('%s %s' % (_name(key), _number(values[key])))
+            for name in sorted(set(k[0] for k in self.histograms)):
+                lines.append('# TYPE %s histogram' % name)
+                for key in sorted(k for k in self.histograms if k[0] == name):
+                    h, labels = self.histograms[key], key[1]
+                    cumulative = 0
+                    for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                        cumulative += count
+                        le = (bound == '+Inf' and bound) or _number(bound)
+                        lines.append('%s %i' % (_name((name + '_bucket', labels + (('le', le),))), cumulative))
+                    lines.append('%s %s' % (_name((name + '_sum', labels)), _number(h.sum)))
+                    lines.append('%s %i' % (_name((name + '_count', labels)), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def listen(self, port=9100, interface='127.0.0.1'):
+        '''Serve `render` at http://interface:port/metrics'''
+        from twisted.internet import reactor
+        from twisted.web import server, resource
+
+        metrics = self
+        class MetricsResource(resource.Resource):
+            isLeaf = True
+            def render_GET(self, request):
+                request.setHeader('content-type', 'text/plain; version=0.0.4')
+                return metrics.render()
+
+        root = resource.Resource()
+        root.putChild('metrics', MetricsResource())
+        return reactor.listenTCP(port, server.Site(root), interface=interface)
+
+    def every(self, period, callback):
+        '''Invoke callback with a snapshot every `period` seconds. Returns
+        the LoopingCall, which you can `stop`.'''
+        from twisted.internet import task
+
+        def invoke():
+            try:
+                callback(self.snapshot())
+            except Exception:
+                from downpour import logger
+                logger.exception('Metrics snapshot callback failed')
+
+        call = task.LoopingCall(invoke)
+        call.start(period, now=False)
+        return call
+
+class _Timed(object):
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name    = name
+        self.labels  = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _name(key):
+    '''Render a (name, labels) key the way Prometheus would'''
+    name, labels = key
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels))
@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''Find out what's keeping the reactor busy, while it's running'''
+
+import os
+import sys
+import time
+import signal
+import thread
+import threading
+from collections import deque
+from downpour import logger
+
+def describe(frame):
+    '''A frame as `file:function`'''
+    return '%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+def stack(frame, limit=100):
+    '''The names of the frames in this stack, from the outermost in'''
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append(describe(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+class Profiler(object):
+    '''Samples the stacks of a thread (or of every thread, other than its
+    own) every `interval` seconds, and counts how often each was seen. The
+    counts are written out as collapsed stacks (`outer;inner;leaf count`,
+    one per line), which is what flamegraph.pl and speedscope read.'''
+    def __init__(self, interval=0.005, ident=None):
+        self.interval = interval
+        self.ident    = ident
+        self.counts   = {}
+        self.samples  = 0
+        self.thread   = None
+        self.running  = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread  = threading.Thread(target=self.run, name='downpour-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        mine = thread.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == mine or (self.ident is not None and ident != self.ident):
+                    continue
+                key = ';'.join(stack(frame))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join('%s %i\n' % pair for pair in sorted(self.counts.items()))
+
+    def dump(self, path):
+        '''Write what's been sampled to path, and start over'''
+        text, count = self.collapsed(), len(self.counts)
+        self.counts, self.samples = {}, 0
+        with open(path, 'w') as f:
+            f.write(text)
+        logger.info('Wrote %i stacks to %s', count, path)
+        return path
+
+class Monitor(object):
+    '''Measures how late the reactor is to run a call scheduled every
+    `interval` seconds. If it's more than `threshold` late, something is
+    blocking it, and a watchdog thread catches what: the reactor thread's
+    stack is logged, and kept (with how long the stall lasted) in `stalls`.
+    Lag is also observed in `metrics`, if given. A sampling profiler can be
+    started and stopped with a signal (`profileOn`), or through a local
+    control socket (`listen`).'''
+    def __init__(self, interval=0.1, threshold=0.25, metrics=None, directory='.', keep=100):
+        self.interval  = interval
+        self.threshold = threshold
+        self.metrics   = metrics
+        self.directory = directory
+        # The reactor thread, when it last checked in, and how late it was
+        self.ident     = None
+        self.beat      = None
+        self.lag       = 0.0
+        self.maxLag    = 0.0
+        # The most recent stalls, as (when, seconds, stack)
+        self.stalls    = deque(maxlen=keep)
+        self.stalled   = None
+        self.profiler  = None
+        self.call      = None
+        self.watchdog  = None
+        self.running   = False
+
+    def start(self):
+        '''Start measuring (the reactor needn't be running yet)'''
+        from downpour import reactor
+        self.running = True
+        self.beat    = None
+        self.call    = reactor.callLater(self.interval, self.tick, time.time() + self.interval)
+        self.watchdog = threading.Thread(target=self.watch, name='downpour-watchdog')
+        self.watchdog.daemon = True
+        self.watchdog.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        if self.profiler is not None:
+            self.profiler.stop()
+        # It notices within an interval, and the reactor shouldn't wait longer
+        if self.watchdog is not None:
+            self.watchdog.join(self.interval * 2)
+            self.watchdog = None
+
+    def tick(self, expected):
+        '''Runs on the reactor thread, `lag` seconds later than it should have'''
+        from downpour import reactor
+        now = time.time()
+        self.ident  = thread.get_ident()
+        self.beat   = now
+        self.lag    = max(now - expected, 0.0)
+        self.maxLag = max(self.maxLag, self.lag)
+        if self.metrics:
+            self.metrics.observe('downpour_reactor_lag_seconds', self.lag)
+        if self.running:
+            self.call = reactor.callLater(self.interval, self.tick, now + self.interval)
+
+    def watch(self):
+        '''Runs on its own thread, looking out for the reactor falling behind'''
+        while self.running:
+            time.sleep(self.interval)
+            beat = self.beat
+            if beat is None or self.ident is None:
+                continue
+            late = time.time() - beat - self.interval
+            if late > self.threshold:
+                if self.stalled is None or self.stalled[0] != beat:
+                    # A new stall. See what the reactor is doing.
+                    frame = sys._current_frames().get(self.ident)
+                    names = frame and stack(frame) or []
+                    self.stalled = [beat, late, names]
+                    self.stalls.append(self.stalled)
+                    logger.warn('Reactor blocked for %fs in %s', late, ' <- '.join(reversed(names[-8:])))
+                    if self.metrics:
+                        self.metrics.inc('downpour_reactor_stalls_total')
+                else:
+                    self.stalled[1] = late
+            elif self.stalled is not None and self.stalled[0] != beat:
+                logger.warn('Reactor was blocked for %fs', self.stalled[1])
+                self.stalled = None
+
+    def profile(self, interval=0.005):
+        '''Start profiling the reactor thread (or every thread, if the
+        reactor hasn't started yet)'''
+        if self.profiler is None or not self.profiler.running:
+            self.profiler = Profiler(interval, self.ident)
+            self.profiler.start()
+            logger.warn('Started profiling')
+        return self.profiler
+
+    def unprofile(self, path=None):
+        '''Stop profiling, and write the collapsed stacks to path (by default,
+        a timestamped file in `directory`). Returns the path.'''
+        if self.profiler is None:
+            return None
+        self.profiler.stop()
+        path = path or os.path.join(self.directory,
+            'downpour-%i-%s.collapsed' % (os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+        self.profiler.dump(path)
+        self.profiler = None
+        return path
+
+    def toggle(self, *args):
+        '''Start profiling if we're not, and stop and write it out if we are'''
+        if self.profiler is not None and self.profiler.running:
+            return self.unprofile()
+        self.profile()
+
+    def profileOn(self, signum=signal.SIGUSR2):
+        '''Toggle the profiler whenever the process gets this signal'''
+        signal.signal(signum, self.toggle)
+
+    def status(self):
+        return {
+            'lag'      : self.lag,
+            'maxLag'   : self.maxLag,
+            'stalls'   : len(self.stalls),
+            'profiling': self.profiler is not None and self.profiler.running
+        }
+
+    def listen(self, path):
+        '''Accept commands on a unix socket at path, one per line: `status`,
+        `stalls`, `profile` and `unprofile` (which replies with the path
+        the stacks were written to). For example:
+            echo profile | nc -U /tmp/downpour.sock'''
+        import json
+        from downpour import reactor
+        from twisted.internet import protocol
+        from twisted.protocols import basic
+
+        monitor = self
+        class Control(basic.LineReceiver):
+            delimiter = '\n'
+
+            def lineReceived(self, line):
+                command = line.strip()
+                try:
+                    if command == 'status':
+                        reply = monitor.status()
+                    elif command == 'stalls':
+                        reply = list(monitor.stalls)
+                    elif command == 'profile':
+                        monitor.profile()
+                        reply = 'profiling'
+                    elif command == 'unprofile':
+                        reply = monitor.unprofile()
+                    else:
+                        reply = 'unknown command: %s' % command
+                except Exception as e:
+                    logger.exception('Monitor command %s failed', command)
+                    reply = 'error: %s' % e
+                self.sendLine(json.dumps(reply))
+
+        factory = protocol.ServerFactory()
+        factory.protocol = Control
+        if os.path.exists(path):
+            os.remove(path)
+        return reactor.listenUNIX(path, factory)
@@ -23,15 +23,135 @@
 
 '''Politely (per pay-level-domain) fetch urls'''
 
-from downpour import BaseFetcher, RobotsRequest, logger, reactor
+from downpour import BaseFetcher, BaseRequest, RobotsRequest, logger, requestLogger, reactor
+from downpour import Keys
+from downpour.Robots import Robots
+from downpour.HashRing import HashRing
+from twisted.internet import task
+from twisted.python.failure import Failure
 
 import qr
+import os
 import sys
 import time
-import reppy
 import redis
+import socket
 import urlparse
 import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+def connectionPool(maxConnections=None, unix_socket_path=None, **kwargs):
+    '''Make a redis connection pool from the same arguments redis.Redis
+    takes, including `unix_socket_path`, with at most `maxConnections`'''
+    if unix_socket_path:
+        kwargs.pop('host', None)
+        kwargs.pop('port', None)
+        return redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+            max_connections=maxConnections, path=unix_socket_path, **kwargs)
+    return redis.ConnectionPool(max_connections=maxConnections, **kwargs)
+
+# Lua scripts that change a domain queue and the pending count together, so
+# that the two can't disagree, even if a worker dies part way through. While
+# the count is being rebuilt (the `counting` key is set), each domain queue
+# is counted the first time it's touched, either by one of these, or by the
+# scan (see `PoliteFetcher.scan`), and `counted` remembers that it has been.
+# What these count is also added up in `touched`, for the scan to collect.
+prelude = '''
+    local function touch(key)
+        if redis.call('exists', 'counting') == 1 and redis.call('sadd', 'counted', key) == 1 then
+            local length = redis.call('llen', key)
+            redis.call('incrby', 'pending', length)
+            redis.call('incrby', 'touched', length)
+        end
+    end
+'''
+scripts = {
+    # Push ARGV[i] onto KEYS[i], returning the lengths of the queues
+    'push': '''
+        local lengths = {}
+        for i, key in ipairs(KEYS) do
+            touch(key)
+            lengths[i] = redis.call('lpush', key, ARGV[i])
+        end
+        redis.call('incrby', 'pending', #KEYS)
+        return lengths''',
+    # Pop the next request off of KEYS[1]
+    'pop': '''
+        touch(KEYS[1])
+        local packed = redis.call('rpop', KEYS[1])
+        if packed then redis.call('decr', 'pending') end
+        return packed''',
+    # Move the next request off of KEYS[1] onto the lease list KEYS[2]
+    'take': '''
+        touch(KEYS[1])
+        local packed = redis.call('rpoplpush', KEYS[1], KEYS[2])
+        if packed then redis.call('decr', 'pending') end
+        return packed''',
+    # Put the leased ARGV[1] back at the front of KEYS[1], and forget its
+    # deadline (in KEYS[2]) and its key (in KEYS[3])
+    'requeue': '''
+        touch(KEYS[1])
+        redis.call('rpush', KEYS[1], ARGV[1])
+        redis.call('incr', 'pending')
+        redis.call('zrem', KEYS[2], ARGV[1])
+        redis.call('hdel', KEYS[3], ARGV[1])''',
+    # Take everything off of KEYS[1]
+    'drain': '''
+        touch(KEYS[1])
+        local packed = redis.call('lrange', KEYS[1], 0, -1)
+        if #packed > 0 then
+            redis.call('del', KEYS[1])
+            redis.call('decrby', 'pending', #packed)
+        end
+        return packed''',
+    # Keep only the ARGV[1] most recently pushed requests on KEYS[1]
+    'trim': '''
+        touch(KEYS[1])
+        local before = redis.call('llen', KEYS[1])
+        redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+        local removed = before - redis.call('llen', KEYS[1])
+        if removed > 0 then redis.call('decrby', 'pending', removed) end
+        return removed''',
+    # Start rebuilding the count if there isn't one (or finish the rebuild
+    # a worker started). Returns whether it's being rebuilt.
+    'begin': '''
+        if redis.call('exists', 'pending') == 0 then
+            redis.call('set', 'counting', 1)
+            redis.call('set', 'pending', 0)
+        end
+        return redis.call('exists', 'counting')''',
+    # Count those of KEYS that haven't been, returning how many that added
+    'count': '''
+        if redis.call('exists', 'counting') == 0 then return 0 end
+        local added = 0
+        for i, key in ipairs(KEYS) do
+            if redis.call('sadd', 'counted', key) == 1 then
+                added = added + redis.call('llen', key)
+            end
+        end
+        redis.call('incrby', 'pending', added)
+        return added'''
+}
+registered = {}
+
+def script(r, name, keys, args=()):
+    '''Run one of our scripts with r (loading it, if r's node doesn't have it)'''
+    try:
+        s = registered[name]
+    except KeyError:
+        s = registered.setdefault(name, r.register_script(prelude + scripts[name]))
+    return s(keys, args, client=r)
+
+# qr queues look up (and, for new arguments, make) a connection pool and a
+# client for themselves. These queues are instead handed the client they
+# should use, so that everything a fetcher does goes through one pool, and
+# making one is just setting three attributes.
+class Queue(qr.Queue):
+    def __init__(self, key, r):
+        self.key        = key
+        self.redis      = r
+        self.serializer = pickle
 
 class Counter(object):
     @staticmethod
@@ -72,6 +192,72 @@ class Counter(object):
         # logger.debug('Len %s; Removed: %d; zcard = %d' % (key, removed, card))
         return card
 
+# In reliable mode, a request popped off of a domain queue is not simply
+# forgotten until it's done. Instead, it's atomically moved (RPOPLPUSH)
+# onto a per-worker lease list, and given a deadline. When the request
+# is done, the lease is acknowledged and removed. If the worker dies in
+# the meantime, a reaper (any worker) notices either the expired deadline
+# or the missing worker heartbeat, and pushes the request back onto the
+# front of the domain queue it came from. Like the flight counters, the
+# bookkeeping around the atomic move is not itself atomic, but LREM is
+# used as the arbiter so that a lease is only ever requeued once.
+class Lease(object):
+    @staticmethod
+    def take(r, worker, key, timeout):
+        '''Move the next request from `key` onto the worker's lease list,
+        returning the packed request (or None if the queue is empty)'''
+        packed = script(r, 'take', [key, 'lease:' + worker])
+        if packed is None:
+            return None
+        with r.pipeline() as p:
+            o = p.zadd('lease:%s:deadlines' % worker, **{packed: time.time() + timeout})
+            o = p.hset('lease:%s:keys' % worker, packed, key)
+            o = p.sadd('leases', worker)
+            o = p.execute()
+        return packed
+
+    @staticmethod
+    def release(r, worker, packed):
+        '''Acknowledge a leased request. Returns whether it was held'''
+        with r.pipeline() as p:
+            o = p.lrem('lease:' + worker, packed, 1)
+            o = p.zrem('lease:%s:deadlines' % worker, packed)
+            o = p.hdel('lease:%s:keys' % worker, packed)
+            removed, o, o = p.execute()
+        return bool(removed)
+
+    @staticmethod
+    def heartbeat(r, worker, ttl):
+        '''Let the reapers know this worker is still alive'''
+        with r.pipeline() as p:
+            o = p.sadd('leases', worker)
+            o = p.setex('worker:' + worker, 1, int(ttl))
+            o = p.execute()
+
+    @staticmethod
+    def reap(r, worker, keyFor, everything=False):
+        '''Requeue the expired leases of `worker` (or all of them if the
+        worker is dead or `everything` is set). `keyFor` recovers the
+        domain key of a packed request whose key mapping never got
+        written. Returns the list of domain keys that had requests put
+        back onto them (and counted as pending again).'''
+        if everything or not r.exists('worker:' + worker):
+            expired = r.lrange('lease:' + worker, 0, -1)
+        else:
+            expired = r.zrangebyscore('lease:%s:deadlines' % worker, 0, time.time())
+        keys = []
+        for packed in expired:
+            key = r.hget('lease:%s:keys' % worker, packed) or keyFor(packed)
+            # Whoever manages to remove it from the lease list owns it.
+            if r.lrem('lease:' + worker, packed, 1):
+                script(r, 'requeue',
+                    [key, 'lease:%s:deadlines' % worker, 'lease:%s:keys' % worker], [packed])
+                keys.append(key)
+        # Forget about dead workers once they hold nothing
+        if not r.exists('worker:' + worker) and not r.llen('lease:' + worker):
+            r.srem('leases', worker)
+        return keys
+
 # XXX - This is unacceptably chummy with the underlying implementation,
 # but it is efficient. Always keep *something* in the underlying Redis
 # set, possibly a placeholder, while a PLD is being worked on. Moreover,
@@ -83,6 +269,11 @@ class PLDQueue(qr.PriorityQueue):
     _PH = sys.float_info.max
     _PH_MIN = sys.float_info.max * 0.99 # very lenient!
 
+    def __init__(self, key, r):
+        self.key        = key
+        self.redis      = r
+        self.serializer = pickle
+
     # Only push if not already there or is a placeholder.
     def push_unique(self, value, score):
         v = self.redis.zscore(self.key, self._pack(value))
@@ -94,6 +285,21 @@ class PLDQueue(qr.PriorityQueue):
         if self.redis.zscore(self.key, self._pack(value)) is None:
             self.push(value, score)
 
+    # As push_init, for many values, in two round trips.
+    def extend_init(self, values, score):
+        packed = [self._pack(value) for value in values]
+        with self.redis.pipeline(transaction=False) as pipe:
+            for value in packed:
+                o = pipe.zscore(self.key, value)
+            scores = pipe.execute()
+        missing = [value for value, s in zip(packed, scores) if s is None]
+        if missing:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for value in missing:
+                    o = pipe.zadd(self.key, value, score)
+                o = pipe.execute()
+        return len(missing)
+
     # Just look, don't touch. Hide placeholders.
     def peek(self, withscores=False):
         v, s = qr.PriorityQueue.peek(self, withscores=True)
@@ -120,16 +326,141 @@ class PLDQueue(qr.PriorityQueue):
             raise ValueError('Attempt to clear an active PLD.')
         self.redis.zrem(self.key, packed)
 
+# The frontier can be split across several redis nodes, by consistent
+# hashing of the domain key. Each node (a shard) holds its own plds, the
+# domain queues that hash to it, and their flight counters, leases and
+# pending count, exactly as a single node would.
+class Shard(object):
+    def __init__(self, name, pool, queueCache=10000):
+        self.name     = name
+        self.pool     = pool
+        self.r        = redis.Redis(connection_pool=pool)
+        self.pldQueue = PLDQueue('plds', self.r)
+        # The most recently used domain queues, so that we're not making
+        # a new one for every push and pop
+        self.queues     = OrderedDict()
+        self.queueCache = queueCache
+        self.queueLock  = threading.Lock()
+
+    @staticmethod
+    def fromURL(url, maxConnections=None, queueCache=10000):
+        '''A shard for a redis url (redis://host:port/db or unix://path)'''
+        pool = redis.ConnectionPool.from_url(url, max_connections=maxConnections)
+        return Shard(url, pool, queueCache)
+
+    def __repr__(self):
+        return '<Shard %s>' % self.name
+
+    def queue(self, key):
+        '''The queue for this domain key'''
+        with self.queueLock:
+            try:
+                q = self.queues.pop(key)
+            except KeyError:
+                q = Queue(key, self.r)
+                if len(self.queues) >= self.queueCache:
+                    self.queues.popitem(last=False)
+            self.queues[key] = q
+            return q
+
+    def keys(self, count=1000):
+        '''Generate the domain keys on this shard, a chunk at a time'''
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.r.scan(cursor or 0, match='domain:*', count=count)
+            yield keys
+
+    def pending(self):
+        '''How many requests are waiting in this shard's domain queues'''
+        return max(int(self.r.get('pending') or 0), 0)
+
+    def count(self, keys):
+        '''How many requests are waiting in these domain queues'''
+        with self.r.pipeline(transaction=False) as p:
+            for key in keys:
+                o = p.llen(key)
+            return sum(p.execute())
+
+    def recount(self, count=1000):
+        '''Reset the pending count from the lengths of the domain queues.
+        This is O(N) in the number of domains, and it's only exact if no
+        one is pushing or popping in the meantime.'''
+        total = sum(self.count(keys) for keys in self.keys(count))
+        with self.r.pipeline() as p:
+            o = p.set('pending', total)
+            o = p.delete('counting', 'counted', 'touched')
+            o = p.execute()
+        return total
+
+def move(source, destination, key):
+    '''Move a domain queue, and its place in the schedule, between shards.
+    The requests are copied before they're deleted, so a failure part way
+    through can duplicate them, but not lose them.'''
+    packed = source.pldQueue._pack(key)
+    with source.r.pipeline() as p:
+        o = p.lrange(key, 0, -1)
+        o = p.zscore('plds', packed)
+        values, score = p.execute()
+    if values:
+        # Oldest requests are at the tail, and they're popped first
+        with destination.r.pipeline() as p:
+            o = p.rpush(key, *values)
+            o = p.incr('pending', len(values))
+            o = p.execute()
+    if score is not None:
+        if score >= PLDQueue._PH_MIN:
+            score = time.time()
+        destination.pldQueue.push_init(key, score)
+    with source.r.pipeline() as p:
+        o = p.delete(key)
+        o = p.zrem('plds', packed)
+        o = p.decr('pending', len(values))
+        o = p.execute()
+    return len(values)
+
+def reshard(old, new, key=None, count=1000):
+    '''Move every domain queue onto the shard it belongs on, now that the
+    shards are `new` (a list of redis urls) rather than `old`. Stop the
+    workers first. Leases are requeued before anything's moved (`key` is
+    the workers' key strategy), and any shards that are only in `old` are
+    left empty. Returns how many requests were moved.'''
+    strategy = Keys.strategy(key)
+    keyFor = lambda packed: strategy(pickle.loads(packed).url)
+    shards = [Shard.fromURL(url) for url in old + [u for u in new if u not in old]]
+    named  = dict((shard.name, shard) for shard in shards)
+    ring   = HashRing(new)
+    moved  = 0
+    for shard in shards:
+        for worker in shard.r.smembers('leases'):
+            keys = Lease.reap(shard.r, worker, keyFor, everything=True)
+            if keys:
+                shard.pldQueue.extend_init(set(keys), time.time())
+        for keys in shard.keys(count):
+            for key in keys:
+                owner = ring.get(key)
+                if owner != shard.name:
+                    moved += move(shard, named[owner], key)
+        logger.info('Finished resharding %s (%i moved so far)', shard.name, moved)
+    return moved
+
 class PoliteFetcher(BaseFetcher):
     # This is the maximum number of parallel requests we can make
     # to the same key
     maxParallelRequests = 5
 
     def __init__(self, poolSize=10, agent=None, stopWhenDone=False,
-        delay=2, allowAll=False, use_lock=None, **kwargs):
+        delay=2, allowAll=False, use_lock=None, reliable=False,
+        leaseTimeout=None, worker=None, reapPeriod=30, metrics=None,
+        reactorName=None, scanCount=1000, queueCache=10000,
+        maxConnections=None, shards=None, owns=None, robots=None, key=None,
+        redirects=None, proxies=None, credentials=None, sink=None, threads=None,
+        breaker=None, timeouts=None, eyeballs=None, coalesce=False, **kwargs):
 
         # First, call the parent constructor
-        BaseFetcher.__init__(self, poolSize, agent, stopWhenDone)
+        BaseFetcher.__init__(self, poolSize, agent, stopWhenDone,
+            metrics=metrics, reactorName=reactorName, redirects=redirects,
+            proxies=proxies, credentials=credentials, sink=sink, threads=threads,
+            breaker=breaker, timeouts=timeouts, eyeballs=eyeballs, coalesce=coalesce)
 
         # Import DownpourLock only if use_lock specified, because it uses
         # *NIX-specific features. We use one lock for the pldQueue and one
@@ -145,32 +476,54 @@ class PoliteFetcher(BaseFetcher):
             self.req_lock = threading.RLock()
         self.twi_lock = threading.RLock()  # Twisted reactor lock
 
-        # Include a priority queue of plds
-        self.pldQueue = PLDQueue('plds', **kwargs)
-        # Make sure that there is an entry in the plds for
-        # each domain waiting to be fetched. Also, include
-        # the number of urls from each domain in the count
-        # of remaining urls to be fetched.
-        self.r = redis.Redis(**kwargs)
-        # Redis has a pipeline feature that allows for bulk
-        # requests, the result of which is a list of the
-        # result of each individual request. Thus, only get
-        # the length of each of the queues in the pipeline
-        # as we're just going to set remaining to the sum
-        # of the lengths of each of the domain queues.
-        with self.r.pipeline() as p:
-            for key in self.r.keys('domain:*'):
-                with self.pld_lock:
-                    self.pldQueue.push_init(key, 0)
-                p.llen(key)
-            self.remaining = sum(p.execute())
+        # The frontier can be split across several redis nodes (`shards`,
+        # a list of redis urls), by consistent hashing of the domain key,
+        # and this worker pulls from those it `owns` (all of them, by
+        # default) in turn. Otherwise, it's a single node, and kwargs are
+        # what you'd give redis.Redis (and may name a unix socket). Each
+        # node gets one connection pool, which all of its queues share.
+        if shards:
+            self.shards = [Shard.fromURL(url, maxConnections, queueCache) for url in shards]
+        else:
+            self.shards = [Shard('default', connectionPool(maxConnections, **kwargs), queueCache)]
+        self.ring  = HashRing([shard.name for shard in self.shards])
+        self.named = dict((shard.name, shard) for shard in self.shards)
+        self.owned = [shard for shard in self.shards if not owns or shard.name in owns]
+        self.turn  = 0
+        # How requests are grouped for politeness: by 'hostname' (the
+        # default), registered 'domain', resolved 'address', or a callable
+        # that takes a url and returns its key
+        self.keyFor = Keys.strategy(key)
+        # The first shard also keeps the queue of incoming requests
+        self.r        = self.shards[0].r
+        self.pldQueue = self.shards[0].pldQueue
+        self.scanCount = scanCount
+        # The number of requests waiting in the domain queues is kept in
+        # Redis, and updated as requests are pushed and popped, so that
+        # every worker agrees on it, and len() is a single GET. If it's
+        # missing, the queues predate it, and so we count them once, as
+        # they're scanned (see `scan`), which is what `counting` is for.
+        self.counting = set()
+        for shard in self.owned:
+            if script(shard.r, 'begin', []):
+                logger.warn('No pending count on %s. Counting.', shard.name)
+                self.counting.add(shard)
+        self.remaining = self.pending()
+        # How many requests are on their way to the domain queues from one
+        # of our scheduler threads, having had to have their keys looked up
+        self.keying = 0
+        # Make sure that there is an entry in the plds for each domain
+        # waiting to be fetched. This walks the keyspace a chunk at a
+        # time in the background (rather than with a blocking KEYS), so
+        # that fetching can begin right away.
+        self.scanner = task.cooperate(self.scan())
         # For whatever reason, pushing key names back into the
         # priority queue has been problematic. As such, we'll
         # set them aside as they fail, and then retry them at
         # some point. Like when the next request finishes.
         self.retries = []
         # Now make a queue for incoming requests
-        self.requests = qr.Queue('request', **kwargs)
+        self.requests = Queue('request', self.r)
         self.delay = float(delay)
         # This is used when we have to impose a delay before
         # servicing the next available request.
@@ -179,42 +532,129 @@ class PoliteFetcher(BaseFetcher):
         # This is a way to ignore the allow/disallow directives
         # For example, if you're checking for allow in other places
         self.allowAll = allowAll
-        self.userAgentString = reppy.getUserAgentString(self.agent)
+        # The robots.txt rules we know about, compiled, by domain. Requests
+        # that they disallow are rejected when they're pushed, or if we
+        # didn't know the rules then, when they're popped.
+        self.robots   = robots or Robots(self.agent)
+        self.rejected = 0
+        # In reliable mode, popped requests are leased to this worker
+        # until they're done, and the leases of dead (or slow) workers
+        # are periodically requeued. By default, a lease lasts as long
+        # as the in-flight counters consider a request to be in flight.
+        self.reliable = reliable
+        if self.reliable:
+            self.worker       = worker or '%s:%i' % (socket.gethostname(), os.getpid())
+            self.leaseTimeout = leaseTimeout or (BaseRequest.timeout * 2)
+            self.reapPeriod   = reapPeriod
+            # Anything held under this worker name is from a previous life
+            for shard in self.owned:
+                self.requeue(shard, Lease.reap(shard.r, self.worker, self._leaseKey, everything=True))
+            self.reaper = task.LoopingCall(self.deferToPool, self.reap)
+            self.reaper.start(self.reapPeriod, now=True)
+        # Periodically sample the round trip time to Redis
+        if self.metrics:
+            self.pinger = task.LoopingCall(self.deferToPool, self.ping)
+            self.pinger.start(10, now=True)
 
     def __len__(self):
-        ''''''
-        return len(self.pldQueue) + len(self.requests)
+        '''How many requests are waiting, in the domain queues or not. Until
+        they've been counted, there may be more than we know of, and so
+        there's at least one.'''
+        count = self.pending() + len(self.requests) + self.keying
+        return max(count, 1) if self.counting else count
+
+    def pending(self):
+        '''How many requests are waiting in the domain queues we own'''
+        return sum(shard.pending() for shard in self.owned)
+
+    def recount(self):
+        '''Reset the pending counts of the shards we own'''
+        return sum(shard.recount(self.scanCount) for shard in self.owned)
+
+    def scan(self):
+        '''Make sure every domain queue is scheduled, and count those on the
+        shards that have no pending count. This is a generator, run
+        cooperatively by the reactor, that yields after each chunk.'''
+        found = 0
+        for shard in self.owned:
+            counted = 0
+            try:
+                for keys in shard.keys(self.scanCount):
+                    with self.pld_lock:
+                        found += shard.pldQueue.extend_init(keys, 0)
+                    if shard in self.counting and keys:
+                        added = script(shard.r, 'count', keys)
+                        counted += added
+                        with self.lock:
+                            self.remaining += added
+                    yield
+                if shard in self.counting:
+                    # Every queue that was there has been counted, by us or
+                    # by whatever touched it first
+                    with shard.r.pipeline() as p:
+                        o = p.get('touched')
+                        o = p.delete('counting', 'counted', 'touched')
+                        touched, o = p.execute()
+                    with self.lock:
+                        self.remaining += int(touched or 0)
+                    logger.info('Counted %i pending requests on %s', counted + int(touched or 0), shard.name)
+            except Exception:
+                logger.exception('Scanning for domain queues on %s failed', shard.name)
+            finally:
+                self.counting.discard(shard)
+        logger.info('Scheduled %i unscheduled domain queues', found)
 
     def idle(self):
         '''Returns whether or not this fetcher can handle more work'''
-        # Look at when the next item can be fetched
-        next, when = self.pldQueue.peek(withscores=True)
-        # If there is no next item available, then we're idle
-        if not next:
-            return True
-        # Alternatively, we'd only idle if the next request can not
-        # yet be serviced.
-        return when > time.time()
-
-    def getKey(self, req):
-        # This actually considers the whole domain name, including subdomains, uniquely
-        # This aliasing is just in case we want to change that scheme later, easily
-        return 'domain:%s' % urlparse.urlparse(req.url.strip()).hostname
+        # We'd only idle if there's no next item available, or if it
+        # can not yet be serviced, on every shard we own
+        now = time.time()
+        for shard in self.owned:
+            next, when = shard.pldQueue.peek(withscores=True)
+            if next and when <= now:
+                return False
+        return True
+
+    def shard(self, key):
+        '''The shard this domain key belongs to'''
+        return self.named[self.ring.get(key)]
+
+    def queue(self, key):
+        '''The queue for this domain key'''
+        return self.shard(key).queue(key)
+
+    def getKey(self, req, lookup=True):
+        # The politeness key for this request, according to our strategy.
+        # Keys must start with 'domain:', which is how we find the queues.
+        # Without `lookup`, a key that would have to be looked up (see
+        # `Keys.AddressKey`) is just the hostname's.
+        cached = getattr(self.keyFor, 'cached', None)
+        if lookup or cached is None:
+            return self.keyFor(req.url)
+        return cached(req.url) or 'domain:%s' % Keys.hostname(req.url)
+
+    def lookups(self, requests):
+        '''Whether finding these requests' keys means looking them up (see
+        `Keys.AddressKey`) where that would hold up the reactor'''
+        cached = getattr(self.keyFor, 'cached', None)
+        if cached is None or not self.threads or self.onPool():
+            return False
+        return any(cached(r.url) is None for r in requests)
 
     def allowed(self, url):
-        '''Are we allowed to fetch this url/urls?'''
-        logger.warn('Allowed? %s' % url)
-        return self.allowAll or reppy.allowed(url, self.agent, self.userAgentString)
+        '''Are we allowed to fetch this url? If we don't know the robots.txt
+        rules for it yet, we assume so (and check again before fetching).'''
+        return self.allowAll or self.robots.allowed(url) is not False
 
     def crawlDelay(self, request):
         '''How long to wait before getting the next page from this domain?'''
         # No delay for requests that were serviced from cache
         if request.cached:
-            logger.debug('Using delay of %fs' % 0.0)
+            requestLogger.debug('Using delay of %fs', 0.0)
             return 0
         # Return the crawl delay for this particular url if there is one
-        ret = (self.allowAll and self.delay) or reppy.crawlDelay(request.url, self.agent) or self.delay
-        logger.debug('Using delay of %fs' % ret)
+        ret = (self.allowAll and self.delay) or self.robots.crawlDelay(request.url) or self.delay
+        requestLogger.debug('Using delay of %fs', ret)
         return ret
 
     # Event callbacks
@@ -228,85 +668,278 @@ class PoliteFetcher(BaseFetcher):
         #   request, since subsequent requests will like depend on
         #   it.
         # self.pldQueue.push(request._originalKey, time.time() + self.crawlDelay(request))
-        with self.pld_lock:
-            if isinstance(request, RobotsRequest):
-                self.pldQueue.push_unique(request._originalKey, time.time() + self.crawlDelay(request))
-            # If this request would bring down our parallel requests
-            # down from the maximum, then we should immediately requeue
-            # the original key to reduce latency.
-            if Counter.remove(self.r, request) == (self.maxParallelRequests - 1):
-                self.pldQueue.push_unique(request._originalKey, time.time() + self.crawlDelay(request))
+        # These are round trips to redis, and so with threads, they happen
+        # on one of them.
+        self.deferToPool(self.settle, request)
+
+    def settle(self, request):
+        '''Bring down the flight count for this request's domain key'''
+        try:
+            shard = self.shard(request._originalKey)
+            with self.pld_lock:
+                if isinstance(request, RobotsRequest):
+                    shard.pldQueue.push_unique(request._originalKey, time.time() + self.crawlDelay(request))
+                # If this request would bring down our parallel requests
+                # down from the maximum, then we should immediately requeue
+                # the original key to reduce latency.
+                if Counter.remove(shard.r, request) == (self.maxParallelRequests - 1):
+                    shard.pldQueue.push_unique(request._originalKey, time.time() + self.crawlDelay(request))
+        except Exception:
+            logger.exception('Settling %s failed', request.url)
 
     # When we try to pop off an empty queue
     def onEmptyQueue(self, key):
         pass
 
+    # When robots.txt disallows a request, instead of fetching it
+    def onDisallowed(self, request):
+        pass
+
+    def reject(self, request):
+        '''Don't fetch this request, because robots.txt disallows it'''
+        self.rejected += 1
+        requestLogger.debug('Disallowed by robots.txt: %s', request.url)
+        if self.metrics:
+            self.metrics.inc('downpour_disallowed_total')
+        try:
+            self.onDisallowed(request)
+        except Exception:
+            logger.exception('onDisallowed failed for %s', request.url)
+
+    def discard(self, request):
+        '''Reject a request that had been counted as remaining'''
+        with self.lock:
+            self.remaining -= 1
+        self.reject(request)
+
+    #################
+    # Reliable mode
+    #################
+    def reap(self):
+        '''Keep our own leases alive, and requeue the expired leases of
+        every worker (including ourselves).'''
+        for shard in self.owned:
+            try:
+                Lease.heartbeat(shard.r, self.worker, self.reapPeriod * 3)
+                for worker in shard.r.smembers('leases'):
+                    self.requeue(shard, Lease.reap(shard.r, worker, self._leaseKey))
+            except Exception:
+                logger.exception('Reaping leases on %s failed', shard.name)
+
+    def ping(self):
+        '''Record the round trip time to Redis'''
+        for shard in self.shards:
+            try:
+                with self.metrics.timed('downpour_redis_seconds'):
+                    shard.r.ping()
+            except Exception:
+                logger.exception('Pinging %s failed', shard.name)
+
+    def requeue(self, shard, keys):
+        '''Make sure the provided domain keys are scheduled'''
+        for key in keys:
+            logger.warn('Requeued expired lease for %s', key)
+            with self.pld_lock:
+                shard.pldQueue.push_init(key, time.time())
+
+    def _leaseKey(self, packed):
+        # Recover the domain key for a packed request
+        return self.getKey(self.requests._unpack(packed))
+
+    def _done(self, request):
+        '''Acknowledge the lease on this request alongside the usual
+        bookkeeping. The lease is acked whether it succeeded or not.'''
+        if self.reliable and getattr(request, '_lease', None):
+            self.deferToPool(self.ack, request)
+        return BaseFetcher._done(self, request)
+
+    def ack(self, request):
+        '''Acknowledge the lease on this request'''
+        try:
+            if not Lease.release(self.shard(request._originalKey).r, self.worker, request._lease):
+                logger.warn('Lease on %s was lost', request.url)
+        except Exception:
+            logger.exception('Releasing lease failed for %s', request.url)
+
+    def circuitKey(self, request):
+        # Circuits are by politeness key. What's popped carries it with it,
+        # and this is on the reactor, so it's never looked up here.
+        return getattr(request, '_originalKey', None) or self.getKey(request, lookup=False)
+
+    def drain(self, shard, key):
+        '''Take everything waiting for this key off of its queue, and fail it'''
+        q = shard.queue(key)
+        with self.req_lock:
+            packed = script(shard.r, 'drain', [key])
+        requests = [q._unpack(v) for v in packed]
+        for request in requests:
+            request._originalKey = key
+        if requests:
+            logger.warn('Failing %i requests for %s', len(requests), key)
+            self.callOnReactor(self.shed, key, requests)
+
     # How many are in flight from this particular key?
     def inFlight(self, key):
-        return Counter.len(self.r, key)
+        return Counter.len(self.shard(key).r, key)
 
     #################
     # Insertion to our queue
     #################
     def extend(self, requests):
-        count = 0
-        t = time.time()
-        for r in requests:
-            count += self.push(r) or 0
-        return count
+        # Check robots.txt for the whole batch at once
+        requests = list(requests)
+        if self.allowAll:
+            verdicts = [True] * len(requests)
+        else:
+            verdicts = self.robots.check([r.url for r in requests])
+        allowed = []
+        for r, verdict in zip(requests, verdicts):
+            if verdict is False:
+                self.callOnReactor(self.reject, r)
+            else:
+                allowed.append(r)
+        return self._push(*allowed)
 
     def grow(self, upto=10000):
-        count = 0
-        t = time.time()
-        with self.req_lock:
-            r = self.requests.pop()
-        while r and count < upto:
-            count += self.push(r) or 0
-            with self.req_lock:
-                r = self.requests.pop()
-        logger.debug('Grew by %i' % count)
+        '''Move what's arrived on the incoming queue onto the domain queues.
+        It's a few round trips to redis, and so with threads, it happens on
+        one of them.'''
+        return self.deferToPool(self.admit, upto).addBoth(self._grown)
+
+    def _grown(self, count):
+        if isinstance(count, Failure):
+            logger.error('Growing failed: %s', count.getTraceback())
+            count = 0
+        count += self.top()
+        logger.debug('Grew by %i', count)
         return BaseFetcher.grew(self, count)
 
+    def admit(self, upto=10000, batch=1000):
+        '''Move up to `upto` requests from the incoming queue onto their
+        domain queues, `batch` at a time. Returns how many were pushed.'''
+        count, taken = 0, 0
+        while taken < upto:
+            size = min(batch, upto - taken)
+            # The oldest requests are at the tail
+            with self.req_lock:
+                with self.r.pipeline() as p:
+                    o = p.lrange(self.requests.key, -size, -1)
+                    o = p.ltrim(self.requests.key, 0, -size - 1)
+                    packed, o = p.execute()
+            if not packed:
+                break
+            taken += len(packed)
+            count += self.extend([self.requests._unpack(v) for v in reversed(packed)])
+            if len(packed) < size:
+                break
+        return count
+
     def trim(self, request, trim):
-        # Then, trim that list
+        # Keep only the `trim` most recently pushed requests for this
+        # request's domain, and keep the pending count honest
+        key = self.getKey(request)
+        shard = self.shard(key)
         with self.req_lock:
-            qr.Queue(self.getKey(request)).trim(trim)
+            removed = script(shard.r, 'trim', [key], [trim])
+        with self.lock:
+            self.remaining -= removed
 
-    # This is one of two places where we use pld_lock inside of a req_lock.
     def push(self, request):
-        key = self.getKey(request)
-        q = qr.Queue(key)
-        with self.req_lock:
-            if not len(q):
-                with self.pld_lock:
-                    self.pldQueue.push_init(key, time.time())
-            q.push(request)
-        self.remaining += 1
-        return 1
-
-    # Here we use twi_lock inside pld_lock, and pld_lock inside req_lock.
-    # Don't use locks-in-locks in the reverse order anywhere, or downpour
-    # might deadlock.
+        if not self.allowed(request.url):
+            self.callOnReactor(self.reject, request)
+            return 0
+        return self._push(request)
+
+    def _push(self, *requests):
+        '''Push these onto their domain queues. If their keys have to be
+        looked up (see `lookups`), that happens on one of our scheduler
+        threads, and they're counted as `keying` until they're there.'''
+        now = time.time()
+        for request in requests:
+            request.queued = now
+        if not self.lookups(requests):
+            self.route(requests)
+            with self.lock:
+                self.remaining += len(requests)
+            return len(requests)
+        with self.lock:
+            self.remaining += len(requests)
+            self.keying    += len(requests)
+        self.deferToPool(self.route, requests).addBoth(self._routed, requests)
+        return len(requests)
+
+    def _routed(self, result, requests):
+        '''Requests pushed from one of our scheduler threads are on their
+        domain queues (or failed to get there)'''
+        with self.lock:
+            self.keying -= len(requests)
+            if isinstance(result, Failure):
+                self.remaining -= len(requests)
+        if isinstance(result, Failure):
+            logger.error('Pushing %i requests failed: %s', len(requests), result.getTraceback())
+        self.serveNext()
+
+    # This is one of two places where we use pld_lock inside of a req_lock.
+    def route(self, requests):
+        '''Push these onto their domain queues, in one round trip per shard
+        (and one more round trip to schedule those queues that were empty)'''
+        now = time.time()
+        byShard = {}
+        for request in requests:
+            key = self.getKey(request)
+            byShard.setdefault(self.shard(key), []).append((key, request))
+        for shard, pairs in byShard.items():
+            with self.req_lock:
+                lengths = script(shard.r, 'push', [key for key, request in pairs],
+                    [self.requests._pack(request) for key, request in pairs])
+                # A queue with only what we just pushed on it was empty
+                empty = set(key for (key, request), length in zip(pairs, lengths) if length == 1)
+                if empty:
+                    with self.pld_lock:
+                        shard.pldQueue.extend_init(empty, now)
+
+    def wake(self, when):
+        '''Serve the next request at `when`. If we're already waiting, don't
+        schedule a double callLater. This has to be on the reactor thread.'''
+        with self.twi_lock:
+            delay = max(when - time.time(), 0)
+            if not (self.timer and self.timer.active()):
+                self.timer = reactor.callLater(delay, self.serveNext)
+            elif self.timer.getTime() > when:
+                # Another shard will be ready sooner
+                self.timer.reset(delay)
+
+    # Here we use twi_lock inside pld_lock, and pld_lock inside req_lock,
+    # and the fetcher's own lock may be held around all of them (popping
+    # without threads). Don't use locks-in-locks in the reverse order
+    # anywhere, or downpour might deadlock.
     def pop(self, polite=True):
-        '''Get the next request'''
+        '''Get the next request, from each of the shards we own in turn'''
+        for i in range(len(self.owned)):
+            shard = self.owned[(self.turn + i) % len(self.owned)]
+            request = self.popFrom(shard, polite)
+            if request:
+                self.turn = (self.turn + i + 1) % len(self.owned)
+                return request
+        return None
+
+    def popFrom(self, shard, polite=True):
+        '''Get the next request from this shard'''
         while True:
 
             # First, we pop the next thing in pldQueue *if* it's not a
             # premature fetch (and a race condition is not detected).
             with self.pld_lock:
                 # Get the next plds we might want to fetch from
-                next, when = self.pldQueue.peek(withscores=True)
+                next, when = shard.pldQueue.peek(withscores=True)
                 if not next:
                     # logger.debug('Nothing in pldQueue.')
                     return None
                 # If the next-fetchable is too soon, wait. If we're
                 # already waiting, don't schedule a double callLater.
-                now = time.time()
-                if polite and when > now:
-                    with self.twi_lock:
-                        if not (self.timer and self.timer.active()):
-                            logger.debug('Waiting %f seconds on %s' % (when - now, next))
-                            self.timer = reactor.callLater(when - now, self.serveNext)
+                if polite and when > time.time():
+                    logger.debug('Waiting until %f on %s', when, next)
+                    self.callOnReactor(self.wake, when)
                     return None
                 # If we get here, we don't need to wait. However, the
                 # multithreaded nature of Twisted means that something
@@ -316,11 +949,22 @@ class PoliteFetcher(BaseFetcher):
                     if not (self.timer and self.timer.active()):
                         self.timer = None
                 # We know the time has passed (we peeked) so pop it.
-                next = self.pldQueue.pop()
+                next = shard.pldQueue.pop()
+
+            # If this key's circuit is open, nothing more is fetched from
+            # it until it's next probed. In park mode, the key just waits
+            # until then, and otherwise, everything waiting for it fails,
+            # leaving its queue empty.
+            if self.breaker is not None and not self.breaker.allow(next):
+                if self.breaker.mode == 'park':
+                    with self.pld_lock:
+                        shard.pldQueue.push_unique(next, self.breaker.until(next))
+                    continue
+                self.drain(shard, next)
 
             # Get the queue pertaining to the PLD of interest and
             # acquire a request lock for it.
-            q = qr.Queue(next)
+            q = shard.queue(next)
             with self.req_lock:
                 if len(q):
                     # If we've already saturated our parallel requests, then we'll
@@ -328,26 +972,50 @@ class PoliteFetcher(BaseFetcher):
                     # There is logic elsewhere so that if one of these requests
                     # completes before this small amount of time elapses, then it
                     # will be advanced accordingly.
-                    if Counter.len(self.r, next) >= self.maxParallelRequests:
-                        logger.debug('maxParallelRequests exceeded for %s' % next)
+                    if Counter.len(shard.r, next) >= self.maxParallelRequests:
+                        logger.debug('maxParallelRequests exceeded for %s', next)
                         with self.pld_lock:
-                            self.pldQueue.push_unique(next, time.time() + 20)
+                            shard.pldQueue.push_unique(next, time.time() + 20)
                         continue
                     # If the robots for this particular request is not fetched
                     # or it's expired, then we'll have to make a request for it
                     v = q.peek()
                     domain = urlparse.urlparse(v.url).netloc
-                    robot = reppy.findRobot('http://' + domain)
-                    if not self.allowAll and (not robot or robot.expired):
-                        logger.debug('Making robots request for %s' % next)
-                        r = RobotsRequest('http://' + domain + '/robots.txt')
+                    if not self.allowAll and not self.robots.find('http://' + domain):
+                        logger.debug('Making robots request for %s', next)
+                        r = RobotsRequest('http://' + domain + '/robots.txt', robots=self.robots)
                         r._originalKey = next
                         # Increment the number of requests we currently have in flight
-                        Counter.put(self.r, r)
+                        Counter.put(shard.r, r)
                         return r
                     else:
-                        logger.debug('Popping next request from %s' % next)
-                        v = q.pop()
+                        requestLogger.debug('Popping next request from %s', next)
+                        if self.reliable:
+                            packed = Lease.take(shard.r, self.worker, next, self.leaseTimeout)
+                            if packed is None:
+                                # Someone beat us to it. Look at it again soon.
+                                with self.pld_lock:
+                                    shard.pldQueue.push_unique(next, time.time())
+                                continue
+                            v = q._unpack(packed)
+                            v._lease = packed
+                        else:
+                            packed = script(shard.r, 'pop', [next])
+                            if packed is None:
+                                with self.pld_lock:
+                                    shard.pldQueue.push_unique(next, time.time())
+                                continue
+                            v = q._unpack(packed)
+                        # We may not have known the robots.txt rules when this
+                        # was pushed. If they disallow it, move right along.
+                        if not self.allowed(v.url):
+                            if self.reliable:
+                                Lease.release(shard.r, self.worker, packed)
+                            # Our lock can't be taken inside of req_lock
+                            self.callOnReactor(self.discard, v)
+                            with self.pld_lock:
+                                shard.pldQueue.push_unique(next, time.time())
+                            continue
                         # This was the source of a rather difficult-to-track bug
                         # wherein the pld queue would slowly drain, despite there
                         # being plenty of logical queues to draw from. The problem
@@ -359,41 +1027,40 @@ class PoliteFetcher(BaseFetcher):
                         # for the original hostname.
                         v._originalKey = next
                         # Increment the number of requests we currently have in flight
-                        Counter.put(self.r, v)
+                        Counter.put(shard.r, v)
                         # At this point, we should also schedule the next request
                         # to this domain.
                         with self.pld_lock:
-                            self.pldQueue.push_unique(next, time.time() + self.crawlDelay(v))
+                            shard.pldQueue.push_unique(next, time.time() + self.crawlDelay(v))
                         return v
                 else:
                     try:
-                        if Counter.len(self.r, next) == 0:
-                            logger.debug('Calling onEmptyQueue for %s' % next)
-                            self.onEmptyQueue(next)
+                        if Counter.len(shard.r, next) == 0:
+                            logger.debug('Calling onEmptyQueue for %s', next)
+                            self.callOnReactor(self.onEmptyQueue, next)
                             try:
                                 with self.pld_lock:
-                                    self.pldQueue.clear_ph(next)
+                                    shard.pldQueue.clear_ph(next)
                             except ValueError:
-                                logger.error('pldQueue.clear_ph failed for %s' % next)
+                                logger.error('pldQueue.clear_ph failed for %s', next)
                         else:
                             # Otherwise, we should try again in a little bit, and
                             # see if the last request has finished.
                             with self.pld_lock:
-                                self.pldQueue.push_unique(next, time.time() + 20)
-                            logger.debug('Requests still in flight for %s. Waiting' % next)
+                                shard.pldQueue.push_unique(next, time.time() + 20)
+                            logger.debug('Requests still in flight for %s. Waiting', next)
                     except Exception:
-                        logger.exception('onEmptyQueue failed for %s' % next)
+                        logger.exception('onEmptyQueue failed for %s', next)
                     continue
 
         logger.debug('Returning None (should not happen).')
         return None
 
 if __name__ == '__main__':
-    import logging
-    from downpour import BaseRequest
+    from downpour import BaseRequest, configureLogging
 
     # Turn on logging
-    logger.setLevel(logging.DEBUG)
+    configureLogging()
 
     q = qr.Queue('requests')
     with file('urls.txt') as f:
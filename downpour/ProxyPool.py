@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''A pool of proxies to spread requests across'''
+
+import time
+import threading
+from downpour import logger
+
+class Proxy(object):
+    '''One proxy in the pool, and how it's been doing'''
+    def __init__(self, url, weight=1, limit=None):
+        self.url         = url
+        self.weight      = float(weight)
+        # At most this many requests through this proxy at once
+        self.limit       = limit
+        self.outstanding = 0
+        # Consecutive failures, and when it can be used again if ejected
+        self.failures    = 0
+        self.ejected     = 0
+        # Running totals
+        self.requests    = 0
+        self.errors      = 0
+        self.ejections   = 0
+        self.bytes       = 0
+        self.seconds     = 0.0
+
+    def __repr__(self):
+        return '<Proxy %s>' % self.url
+
+    def available(self, now):
+        return self.ejected <= now and (self.limit is None or self.outstanding < self.limit)
+
+    def load(self):
+        '''How busy this proxy would be with one more request, for its weight'''
+        return (self.outstanding + 1) / self.weight
+
+    def stats(self):
+        return {
+            'weight'     : self.weight,
+            'outstanding': self.outstanding,
+            'requests'   : self.requests,
+            'errors'     : self.errors,
+            'ejections'  : self.ejections,
+            'ejected'    : self.ejected > time.time(),
+            'bytes'      : self.bytes,
+            'latency'    : self.requests and (self.seconds / self.requests) or None,
+            'throughput' : self.seconds and (self.bytes / self.seconds) or None
+        }
+
+class ProxyPool(object):
+    '''Proxies, each with a weight and optionally a limit on how many requests
+    can go through it at once. Each request goes to the available proxy with
+    the fewest outstanding requests for its weight. A proxy that fails
+    `failures` times in a row is ejected for `cooldown` seconds.'''
+    def __init__(self, proxies=(), failures=5, cooldown=60, limit=None):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.limit    = limit
+        self.proxies  = []
+        self.lock     = threading.Lock()
+        # Where to start looking, so that ties are spread around
+        self.turn     = 0
+        if isinstance(proxies, dict):
+            proxies = proxies.items()
+        for proxy in proxies:
+            if isinstance(proxy, basestring):
+                self.add(proxy)
+            else:
+                self.add(*proxy)
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def add(self, url, weight=1, limit=None):
+        with self.lock:
+            self.proxies.append(Proxy(url, weight, limit or self.limit))
+
+    def remove(self, url):
+        with self.lock:
+            self.proxies = [p for p in self.proxies if p.url != url]
+
+    def wait(self):
+        '''How long until a proxy is available: 0 if one is now, or None if
+        we're waiting on requests in flight through them to finish'''
+        now = time.time()
+        with self.lock:
+            if any(p.available(now) for p in self.proxies):
+                return 0
+            ejected = [p.ejected for p in self.proxies if p.ejected > now]
+            if len(ejected) == len(self.proxies) and ejected:
+                return min(ejected) - now
+            return None
+
+    def acquire(self):
+        '''The proxy to send the next request through, or None if none are
+        available. Every acquired proxy must be released.'''
+        now = time.time()
+        with self.lock:
+            count = len(self.proxies)
+            best  = None
+            for i in xrange(count):
+                proxy = self.proxies[(self.turn + i) % count]
+                if proxy.available(now) and (best is None or proxy.load() < best.load()):
+                    best = proxy
+            if best is not None:
+                self.turn = (self.turn + 1) % count
+                best.outstanding += 1
+            return best
+
+    def cancel(self, proxy):
+        '''Give back an acquired proxy that no request ended up going through.
+        Unlike `release`, it doesn't count towards its stats.'''
+        with self.lock:
+            proxy.outstanding -= 1
+
+    def release(self, proxy, seconds, size=0, ok=True):
+        '''A request through this proxy is done, having taken this long and
+        gotten size bytes. If it failed in a way that's the proxy's fault,
+        then ok is False.'''
+        with self.lock:
+            proxy.outstanding -= 1
+            proxy.requests    += 1
+            proxy.seconds     += seconds
+            proxy.bytes       += size
+            if ok:
+                proxy.failures = 0
+                return
+            proxy.errors   += 1
+            proxy.failures += 1
+            if proxy.failures >= self.failures:
+                logger.warn('Ejecting proxy %s for %is after %i failures', proxy.url, self.cooldown, proxy.failures)
+                proxy.failures   = 0
+                proxy.ejections += 1
+                proxy.ejected    = time.time() + self.cooldown
+
+    def stats(self):
+        '''A dictionary of each proxy's stats'''
+        with self.lock:
+            return dict((p.url, p.stats()) for p in self.proxies)
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''Logging handlers and filters that keep logging off of the hot path'''
+
+import Queue
+import random
+import logging
+import threading
+
+class QueueHandler(logging.Handler):
+    '''Hands records off to a background thread, which passes them on to
+    the target handlers. The queue is bounded, and if it's full, records
+    are dropped (and counted in `dropped`) rather than blocking. Records
+    are only formatted by the background thread.'''
+    def __init__(self, targets, size=10000):
+        logging.Handler.__init__(self)
+        self.targets = list(targets)
+        self.dropped = 0
+        self.queue   = Queue.Queue(size)
+        self.thread  = threading.Thread(target=self.run, name='downpour-logging')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def dispatch(self, record):
+        for target in self.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            try:
+                self.dispatch(record)
+            except Exception:
+                self.handleError(record)
+
+    def flush(self):
+        for target in self.targets:
+            target.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            # Drain what's there, and then stop
+            self.queue.put(None)
+            self.thread.join(5)
+        for target in self.targets:
+            target.close()
+        logging.Handler.close(self)
+
+class SampleFilter(logging.Filter):
+    '''Let through only a fraction of records, except for exceptions'''
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        return record.exc_info or random.random() < self.rate
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''Remember where urls redirect to, so that we can skip the hops'''
+
+import time
+from downpour.Keys import Cache
+
+class RedirectCache(object):
+    '''A bounded map of url => redirect target. Permanent redirects (301
+    and 308) are remembered until they fall out of the cache, and the
+    temporary ones (302 and 307) for `ttl` seconds. If a redis client is
+    provided, the map is also kept there (under `prefix`), to be shared
+    between workers and restarts.'''
+    permanent = (301, 308)
+    temporary = (302, 307)
+
+    def __init__(self, size=100000, ttl=3600, redis=None, prefix='redirect:'):
+        self.ttl    = ttl
+        self.cache  = Cache(size)
+        self.redis  = redis
+        self.prefix = prefix
+
+    def record(self, url, target, status):
+        '''The url redirected to target with this status'''
+        status = int(status)
+        if status in self.permanent:
+            expires = None
+        elif status in self.temporary:
+            expires = time.time() + self.ttl
+        else:
+            return
+        self.cache.set(url, (target, expires))
+        if self.redis is not None:
+            if expires is None:
+                self.redis.set(self.prefix + url, target)
+            else:
+                self.redis.setex(self.prefix + url, target, int(self.ttl))
+
+    def forget(self, url):
+        self.cache.pop(url)
+        if self.redis is not None:
+            self.redis.delete(self.prefix + url)
+
+    def get(self, url):
+        '''Where url redirects to, if we know'''
+        found = self.cache.get(url)
+        if found:
+            target, expires = found
+            if expires is None or expires > time.time():
+                return target
+            self.cache.pop(url)
+        if self.redis is not None:
+            target = self.redis.get(self.prefix + url)
+            if target:
+                # We don't know how long it has left, so keep it for at most
+                # one ttl locally
+                self.cache.set(url, (target, time.time() + self.ttl))
+                return target
+        return None
+
+    def resolve(self, url, limit=10):
+        '''The chain of urls that url is known to redirect through, starting
+        with url and ending with where it should be fetched from'''
+        chain = [url]
+        target = self.get(url)
+        while target and len(chain) <= limit:
+            if target in chain:
+                # A loop. Fetch it for real, and find out what's going on.
+                return [url]
+            chain.append(target)
+            target = self.get(target)
+        return chain
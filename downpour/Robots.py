@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''An in-memory cache of robots.txt rules, compiled per domain'''
+
+import re
+import time
+import urllib
+import urlparse
+import threading
+from collections import OrderedDict
+
+def agentToken(agent):
+    '''The token to look for in robots.txt. For 'MyAgent/1.0', 'myagent'.'''
+    return re.sub(r'(\S+?)(\/.+)?', r'\1', agent).lower()
+
+def unquote(path):
+    # Unquote, except for encoded slashes, which are a different path
+    return urllib.unquote(path.replace('%2f', '%252f').replace('%2F', '%252F'))
+
+def translate(pattern):
+    '''A robots.txt path pattern (with * and $) as a regular expression'''
+    return re.escape(unquote(pattern)).replace('\\*', '.*').replace('\\$', '$')
+
+class Rules(object):
+    '''The rules from one robots.txt for one user agent. The longest
+    matching pattern wins (and allow wins ties), so the patterns are
+    sorted that way and compiled into alternations, the first match of
+    which is the decision. Python 2 caps a pattern at 100 groups, so
+    there are as many alternations as it takes.'''
+    chunk = 90
+
+    def __init__(self, rules=None, crawlDelay=None, sitemaps=None, ttl=3600 * 3):
+        self.crawlDelay = crawlDelay
+        self.sitemaps   = sitemaps or []
+        self.expires    = time.time() + ttl
+        rules = sorted(rules or [], key=lambda rule: (len(rule[0]), rule[1]), reverse=True)
+        self.matchers = []
+        for i in range(0, len(rules), self.chunk):
+            some = rules[i:i + self.chunk]
+            matcher = re.compile('|'.join('(%s)' % translate(pattern) for pattern, allow in some))
+            self.matchers.append((matcher, [allow for pattern, allow in some]))
+
+    @property
+    def expired(self):
+        return time.time() > self.expires
+
+    def allowed(self, url):
+        '''May we fetch this url (or path)?'''
+        parsed = urlparse.urlparse(url)
+        path = unquote(urlparse.urlunparse(('', '', parsed.path or '/', parsed.params, parsed.query, '')))
+        if path == '/robots.txt':
+            return True
+        for matcher, allows in self.matchers:
+            match = matcher.match(path)
+            if match:
+                return allows[match.lastindex - 1]
+        return True
+
+    @staticmethod
+    def parse(text, agent, ttl=3600 * 3):
+        '''Get the Rules in robots.txt `text` that apply to `agent` (a
+        token, as from agentToken). A group that names the agent is used
+        if there is one, and otherwise the group for *.'''
+        groups  = {}
+        current = None
+        names   = []
+        sitemaps = []
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            key, colon, value = line.partition(':')
+            if not colon:
+                continue
+            key, value = key.strip().lower(), value.strip()
+            if key in ('user-agent', 'useragent'):
+                # Consecutive user agent lines share one group
+                if current is not None:
+                    names, current = [], None
+                names.append(value.lower())
+            elif key == 'sitemap':
+                sitemaps.append(value)
+            elif names:
+                if current is None:
+                    current = {'rules': [], 'delay': None}
+                    for name in names:
+                        groups.setdefault(name, current)
+                if key == 'disallow' and value:
+                    current['rules'].append((value, False))
+                elif key == 'allow' and value:
+                    current['rules'].append((value, True))
+                elif key == 'crawl-delay':
+                    try:
+                        current['delay'] = float(value)
+                    except ValueError:
+                        pass
+        group = groups.get(agent) or groups.get('*') or {'rules': [], 'delay': None}
+        return Rules(group['rules'], group['delay'], sitemaps, ttl)
+
+class Robots(object):
+    '''The rules for the most recent `size` domains we've seen, for one
+    user agent. A domain's rules are unknown until they're recorded (by a
+    RobotsRequest, for example), and again once they've expired.'''
+    def __init__(self, agent='rogerbot/1.0', ttl=3600 * 3, size=100000):
+        self.agent = agentToken(agent)
+        self.ttl   = ttl
+        self.size  = size
+        self.rules = OrderedDict()
+        self.lock  = threading.Lock()
+
+    def __len__(self):
+        return len(self.rules)
+
+    @staticmethod
+    def key(url):
+        return urlparse.urlparse(url).netloc.lower()
+
+    def record(self, url, rules):
+        '''Remember the rules for url's domain'''
+        key = self.key(url)
+        with self.lock:
+            self.rules.pop(key, None)
+            self.rules[key] = rules
+            if len(self.rules) > self.size:
+                self.rules.popitem(last=False)
+        return rules
+
+    def parse(self, url, text, ttl=None):
+        '''Record the contents of the robots.txt at url'''
+        return self.record(url, Rules.parse(text, self.agent, ttl or self.ttl))
+
+    def find(self, url):
+        '''The current rules for url's domain, or None if we don't know'''
+        key = self.key(url)
+        with self.lock:
+            rules = self.rules.pop(key, None)
+            if rules is None or rules.expired:
+                return None
+            self.rules[key] = rules
+            return rules
+
+    def allowed(self, url):
+        '''True or False, or None if we don't know yet'''
+        rules = self.find(url)
+        return rules and rules.allowed(url)
+
+    def check(self, urls):
+        '''The `allowed` verdicts for many urls, looking each domain up once'''
+        found = {}
+        verdicts = []
+        for url in urls:
+            key = self.key(url)
+            if key not in found:
+                found[key] = self.find(url)
+            rules = found[key]
+            verdicts.append(rules and rules.allowed(url))
+        return verdicts
+
+    def crawlDelay(self, url):
+        '''The crawl delay for url's domain, if we know of one'''
+        rules = self.find(url)
+        return rules and rules.crawlDelay
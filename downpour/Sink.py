@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''Write what's fetched to rotating, compressed files, in the background'''
+
+import os
+import json
+import time
+import uuid
+import zlib
+import gzip
+import struct
+import threading
+from downpour import logger
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def compress(data, level=6):
+    '''Data as a gzip member (concatenated members make a valid gzip file)'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class Records(object):
+    '''A simple format: each record is the length of its metadata (as JSON)
+    and of its body, and then each of those. Each batch is a gzip member.'''
+    extension = '.records.gz'
+    lengths   = struct.Struct('>II')
+
+    def header(self):
+        return ''
+
+    def pack(self, records):
+        chunks = []
+        for record in records:
+            body = record.get('body') or ''
+            meta = json.dumps(dict((k, v) for k, v in record.iteritems() if k != 'body'))
+            chunks.extend((self.lengths.pack(len(meta), len(body)), meta, body))
+        return compress(''.join(chunks))
+
+    @classmethod
+    def read(cls, path):
+        '''Each record in a file written in this format'''
+        f = gzip.open(path, 'rb')
+        try:
+            while True:
+                lengths = f.read(cls.lengths.size)
+                if len(lengths) < cls.lengths.size:
+                    return
+                meta, body = cls.lengths.unpack(lengths)
+                record = json.loads(f.read(meta))
+                record['body'] = f.read(body)
+                yield record
+        finally:
+            f.close()
+
+class WARC(object):
+    '''WARC/1.0 response records, each its own gzip member so that they can
+    be read individually. Failures that got no response are left out.'''
+    extension = '.warc.gz'
+
+    def header(self):
+        from downpour import __version__
+        fields = 'software: downpour/%s\r\nformat: WARC File Format 1.0\r\n' % __version__
+        return compress(self.record('warcinfo', None, 'application/warc-fields', fields))
+
+    def record(self, kind, url, contentType, block):
+        lines = [
+            'WARC/1.0',
+            'WARC-Type: %s' % kind,
+            'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+            'WARC-Date: %s' % time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())]
+        if url:
+            lines.append('WARC-Target-URI: %s' % utf8(url))
+        lines.extend([
+            'Content-Type: %s' % contentType,
+            'Content-Length: %i' % len(block),
+            '', ''])
+        return '\r\n'.join(lines) + block + '\r\n\r\n'
+
+    def pack(self, records):
+        chunks = []
+        for record in records:
+            if not record.get('status'):
+                continue
+            lines = ['%s %s %s' % (record.get('version') or 'HTTP/1.1', record['status'], record.get('message') or '')]
+            for key, values in (record.get('headers') or {}).iteritems():
+                lines.extend('%s: %s' % (key, value) for value in values)
+            block = '\r\n'.join(lines) + '\r\n\r\n' + (record.get('body') or '')
+            chunks.append(compress(self.record('response', record['url'],
+                'application/http; msgtype=response', block)))
+        return ''.join(chunks)
+
+formats = {
+    'records': Records,
+    'warc'   : WARC
+}
+
+class Sink(object):
+    '''Collects records of what's been fetched (url, status, headers, timing
+    and body), and a background thread writes them out in batches of at
+    least `batchBytes` (or every `interval` seconds) to files in `directory`,
+    starting a new one every `rotateBytes`. Files are named `<prefix>-...`
+    and end in `.open` until they're complete. Once `maxBytes` are waiting
+    to be written, the sink is `full()`, and fetchers hold off on making
+    more requests until it's caught up.'''
+    def __init__(self, directory, format='warc', prefix='downpour', batchBytes=1024 * 1024,
+        maxBytes=64 * 1024 * 1024, rotateBytes=1024 * 1024 * 1024, interval=1.0):
+        self.directory   = directory
+        self.format      = formats[format]()
+        self.prefix      = prefix
+        self.batchBytes  = batchBytes
+        self.maxBytes    = maxBytes
+        self.rotateBytes = rotateBytes
+        self.interval    = interval
+        # Records waiting to be written, and how big they are
+        self.buffer      = []
+        self.buffered    = 0
+        self.condition   = threading.Condition()
+        self.closed      = False
+        # Called (from the writer thread) when a full sink has room again
+        self.drained     = None
+        self.blocked     = False
+        # Running totals
+        self.records     = 0
+        self.written     = 0
+        self.dropped     = 0
+        self.files       = []
+        self.out         = None
+        self.path        = None
+        self.size        = 0
+        self.sequence    = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.thread = threading.Thread(target=self.run, name='downpour-sink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def full(self):
+        '''Whether we're waiting on the writer to catch up'''
+        if self.buffered >= self.maxBytes:
+            self.blocked = True
+            return True
+        return False
+
+    def write(self, record):
+        '''Add a record (a dictionary with at least the `url`) to be written.
+        This never blocks, even when full.'''
+        size = len(record.get('body') or '') + 512
+        with self.condition:
+            self.buffer.append(record)
+            self.buffered += size
+            if self.buffered >= self.batchBytes:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Wait for a whole batch, but not for too long
+                if self.buffered < self.batchBytes and not self.closed:
+                    self.condition.wait(self.interval)
+                batch, self.buffer = self.buffer, []
+                self.buffered = 0
+                closed = self.closed
+            if batch:
+                try:
+                    self.flush(batch)
+                except Exception:
+                    logger.exception('Could not write %i records', len(batch))
+                    self.dropped += len(batch)
+            if self.blocked and self.drained:
+                self.blocked = False
+                self.drained()
+            if closed:
+                self.finish()
+                return
+
+    def flush(self, batch):
+        '''Write a batch of records to the current file'''
+        data = self.format.pack(batch)
+        if self.out is None:
+            self.open()
+        self.out.write(data)
+        self.out.flush()
+        self.size    += len(data)
+        self.records += len(batch)
+        self.written += len(data)
+        if self.size >= self.rotateBytes:
+            self.finish()
+
+    def open(self):
+        self.sequence += 1
+        name = '%s-%s-%05i-%i%s' % (self.prefix, time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+            self.sequence, os.getpid(), self.format.extension)
+        self.path = os.path.join(self.directory, name)
+        self.out  = open(self.path + '.open', 'wb')
+        self.size = 0
+        header = self.format.header()
+        self.out.write(header)
+        self.size += len(header)
+
+    def finish(self):
+        '''Close the current file, if there is one'''
+        if self.out is not None:
+            self.out.close()
+            os.rename(self.path + '.open', self.path)
+            self.files.append(self.path)
+            self.out = None
+
+    def close(self):
+        '''Write everything that's waiting, and close the current file'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
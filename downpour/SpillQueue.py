@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2011 SEOmoz
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+'''A FIFO queue of requests that spills to disk'''
+
+import os
+import mmap
+import struct
+import threading
+import cPickle as pickle
+from collections import deque
+from downpour import logger
+
+# Each record is its length, followed by the encoded request
+header = struct.Struct('>I')
+
+def encode(request):
+    return pickle.dumps(request, pickle.HIGHEST_PROTOCOL)
+
+class Segment(object):
+    '''An append-only file of records, memory-mapped for reading'''
+    def __init__(self, path):
+        self.path = path
+        self.map  = None
+        self.size = 0
+
+    def remap(self):
+        '''Map whatever has been written to the file so far'''
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return self.size
+        if size > self.size:
+            self.close()
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.size = size
+        return self.size
+
+    def record(self, offset):
+        '''The record at offset, and where the next one starts, or None if
+        there isn't a whole one there'''
+        end = offset + header.size
+        if end > self.size:
+            return None
+        length, = header.unpack(self.map[offset:end])
+        if end + length > self.size:
+            return None
+        return self.map[end:end + length], end + length
+
+    def count(self, offset):
+        '''How many whole records there are from offset on'''
+        count = 0
+        while True:
+            end = offset + header.size
+            if end > self.size:
+                return count
+            length, = header.unpack(self.map[offset:end])
+            offset = end + length
+            if offset > self.size:
+                return count
+            count += 1
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map  = None
+            self.size = 0
+
+class SpillQueue(object):
+    '''A first-in, first-out queue that can stand in for BaseFetcher's list
+    of requests. Requests are encoded and appended to segment files in
+    `path` (a new one every `segmentSize` bytes), and only a window of up
+    to `window` of them is decoded and kept in memory at a time. How far
+    it's been read is saved every `sync` pops (and on close), so that a new
+    queue on the same path picks up from there. Requests popped since the
+    last save are popped again, so callbacks should be idempotent.'''
+    def __init__(self, path, window=1000, segmentSize=64 * 1024 * 1024, sync=1000,
+        encode=encode, decode=pickle.loads):
+        self.path        = path
+        self.window      = window
+        self.segmentSize = segmentSize
+        self.sync        = sync
+        self.encode      = encode
+        self.decode      = decode
+        self.lock        = threading.RLock()
+        # Decoded requests, each with the position just past it
+        self.buffer      = deque()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        segments = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg'))
+        # Where we've popped up to, as of the last save
+        self.popped = self.load() or (segments and (segments[0], 0)) or (0, 0)
+        self.segments = [s for s in segments if s >= self.popped[0]]
+        # Where we've read up to, which is ahead of where we've popped by
+        # what's in the buffer
+        self.number  = self.popped[0]
+        self.reading = Segment(self.segmentPath(self.number))
+        self.offset  = self.popped[1]
+        self.unsaved = 0
+        # Rather than append to a segment that may end in a partial record,
+        # a restarted queue always starts a new one
+        self.writing = (self.segments and self.segments[-1] + 1) or self.popped[0]
+        self.segments.append(self.writing)
+        self.out     = open(self.segmentPath(self.writing), 'ab')
+        self.written = 0
+        self.count   = self.recount()
+
+    def segmentPath(self, number):
+        return os.path.join(self.path, '%012i.seg' % number)
+
+    def offsetPath(self):
+        return os.path.join(self.path, 'offset')
+
+    def load(self):
+        '''Where we'd popped up to when we last saved, if we ever did'''
+        try:
+            with open(self.offsetPath()) as f:
+                number, offset = f.read().split()
+                return int(number), int(offset)
+        except (IOError, ValueError):
+            return None
+
+    def save(self):
+        '''Save where we've popped up to, and remove what's all been popped'''
+        with self.lock:
+            path = self.offsetPath()
+            with open(path + '.tmp', 'w') as f:
+                f.write('%i %i' % self.popped)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + '.tmp', path)
+            self.unsaved = 0
+            while self.segments[0] < self.popped[0]:
+                try:
+                    os.remove(self.segmentPath(self.segments.pop(0)))
+                except OSError:
+                    logger.exception('Could not remove spilled segment')
+
+    def recount(self):
+        '''Count the requests that have yet to be popped'''
+        count = 0
+        for number in self.segments:
+            segment = Segment(self.segmentPath(number))
+            try:
+                segment.remap()
+                count += segment.count(number == self.popped[0] and self.popped[1] or 0)
+            finally:
+                segment.close()
+        return count
+
+    def __len__(self):
+        return self.count
+
+    def append(self, request):
+        with self.lock:
+            self.write(self.encode(request))
+            self.out.flush()
+            self.count += 1
+
+    def extend(self, requests):
+        with self.lock:
+            count = 0
+            for request in requests:
+                self.write(self.encode(request))
+                count += 1
+            self.out.flush()
+            self.count += count
+
+    def write(self, data):
+        if self.written >= self.segmentSize:
+            self.out.close()
+            self.writing += 1
+            self.segments.append(self.writing)
+            self.out = open(self.segmentPath(self.writing), 'ab')
+            self.written = 0
+        self.out.write(header.pack(len(data)))
+        self.out.write(data)
+        self.written += header.size + len(data)
+
+    def pop(self):
+        '''The oldest request. Like a list, raises IndexError if empty.'''
+        with self.lock:
+            if not self.buffer:
+                self.fill()
+                if not self.buffer:
+                    raise IndexError('pop from empty queue')
+            request, self.popped = self.buffer.popleft()
+            self.count -= 1
+            self.unsaved += 1
+            if self.unsaved >= self.sync:
+                self.save()
+            return request
+
+    def fill(self):
+        '''Read up to a window's worth of requests into memory'''
+        while len(self.buffer) < self.window:
+            found = self.reading.record(self.offset)
+            if found is None:
+                # Maybe more has been written since we mapped it
+                if self.number == self.writing:
+                    self.out.flush()
+                self.reading.remap()
+                found = self.reading.record(self.offset)
+            if found is None:
+                if self.number >= self.writing:
+                    # We've caught up with the writer
+                    return
+                # This segment is done (or ends in a record that was cut
+                # short by a crash), so on to the next
+                self.reading.close()
+                self.number += 1
+                self.reading = Segment(self.segmentPath(self.number))
+                self.offset  = 0
+                continue
+            data, self.offset = found
+            try:
+                self.buffer.append((self.decode(data), (self.number, self.offset)))
+            except Exception:
+                # We've already counted it, but can't use it
+                logger.exception('Could not decode spilled request')
+                self.count -= 1
+
+    def close(self):
+        '''Save our place, and release our files'''
+        with self.lock:
+            self.out.close()
+            self.reading.close()
+            # What's in the buffer hasn't been popped, so it'll be read again
+            self.save()
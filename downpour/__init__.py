@@ -29,62 +29,173 @@ __maintainer__ = 'Dan Lecocq'
 __email__      = 'dan@seomoz.org'
 __status__     = 'Development'
 
-# This tries to import the most efficient reactor
-# that's available on the system.
-try:
-    from twisted.internet import epollreactor
-    epollreactor.install()
-    print 'Using epoll reactor'
-except ImportError:
-    try:
-        from twisted.internet import kqreactor
-        kqreactor.install()
-        print 'Using kqueue reactor'
-    except ImportError:
-        print 'Using select reactor'
-
+# Importing downpour is meant to be cheap, and free of side effects. No
+# reactor is installed, nothing is printed or opened, and the heavier
+# pieces (twisted.web, and the redis / reppy politeness stack) are only
+# imported when they're first used.
 import os
 import re
+import sys
 import time
-import reppy
+import types
 import base64
+import hashlib
+import itertools
 import urlparse
 import threading
-import cPickle as pickle
-from twisted import internet
-from twisted.python import log
-from twisted.web import http, client, error
-from twisted.internet import reactor, ssl
+from twisted.web import error
+from twisted.internet import defer, abstract
 from twisted.python.failure import Failure
 
 # Logging
-# We'll have a stream handler and file handler enabled by default, and
-# you can select the level of debugging to affect verbosity
+# No handlers are installed unless you ask for them with `configureLogging`
+# (or by setting DOWNPOUR_LOGGING to 'development' or 'production'), and
+# you can select the level of debugging to affect verbosity. Messages that
+# are logged for every request go to the `downpour.requests` logger, which
+# can be sampled in production.
 import logging
 from logging import handlers
 logger = logging.getLogger('downpour')
-# Stream handler
+logger.addHandler(logging.NullHandler())
+requestLogger = logging.getLogger('downpour.requests')
 formatter = logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s:%(funcName)s@%(lineno)s => %(message)s')
-handler = logging.StreamHandler()
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
-# File handler to downpour.log
-handler = handlers.RotatingFileHandler('/var/log/downpour.log', 'a+', maxBytes=100 * 1024 * 1024, backupCount=10)
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+def configureLogging(mode='development', filename=None, level=None, sample=None, queueSize=10000):
+    '''Install handlers on downpour's logger.
+
+    In 'development' mode, everything at `level` (default DEBUG) goes to
+    stderr and, if provided, `filename`, synchronously. In 'production'
+    mode, the default level is INFO, only a `sample` (default 1%) of the
+    per-request messages are kept (exceptions always are), and records
+    are handed off to a background thread through a bounded queue, so
+    that the reactor never blocks on disk I/O. Returns the handlers.'''
+    from downpour.QueueHandler import QueueHandler, SampleFilter
+    production = (mode == 'production')
+    if level is None:
+        level = production and logging.INFO or logging.DEBUG
+    if sample is None:
+        sample = production and 0.01 or 1.0
+
+    installed = []
+    if filename:
+        installed.append(handlers.RotatingFileHandler(filename, 'a+',
+            maxBytes=100 * 1024 * 1024, backupCount=10))
+    if not production or not filename:
+        installed.append(logging.StreamHandler())
+    for handler in installed:
+        handler.setFormatter(formatter)
+    if production:
+        installed = [QueueHandler(installed, queueSize)]
+
+    # Remove anything we installed before, and install these
+    for old in [h for h in logger.handlers if getattr(h, '_downpour', False)]:
+        logger.removeHandler(old)
+        old.close()
+    for handler in installed:
+        handler._downpour = True
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    for old in list(requestLogger.filters):
+        if isinstance(old, SampleFilter):
+            requestLogger.removeFilter(old)
+    if sample < 1.0:
+        requestLogger.addFilter(SampleFilter(sample))
+    # Twisted has an observer for logging twisted's errors
+    global observer
+    if not observer:
+        from twisted.python import log
+        observer = log.PythonLoggingObserver()
+        observer.start()
+    return installed
+
+observer = None
+
+if os.environ.get('DOWNPOUR_LOGGING'):
+    configureLogging(os.environ['DOWNPOUR_LOGGING'], os.environ.get('DOWNPOUR_LOG_FILE'))
 
-# Twisted has an observer for logging twisted's errors
-observer = log.PythonLoggingObserver()
-observer.start()
+# Reactors
+# The most efficient reactor available is installed when the first fetcher
+# is made (or when you call `installReactor` yourself, to pick a different
+# one). Until then, `reactor` stands in for twisted's reactor, so that
+# `from downpour import reactor` doesn't install one just by importing it.
+reactors = ('epoll', 'kqueue', 'poll', 'select')
+
+def installReactor(name=None):
+    '''Install the named reactor (one of `reactors`), or the most efficient
+    one available. If a reactor's already installed, it's left alone (and a
+    warning's logged if it's not the one asked for). Returns the reactor.'''
+    if 'twisted.internet.reactor' not in sys.modules:
+        for candidate in (name and [name] or reactors):
+            module = (candidate == 'kqueue') and 'kqreactor' or (candidate + 'reactor')
+            try:
+                __import__('twisted.internet.' + module, fromlist=['install']).install()
+                logger.debug('Using %s reactor', candidate)
+                break
+            except ImportError:
+                if name:
+                    raise
+    from twisted.internet import reactor as installed
+    if name and name[:4] not in installed.__class__.__name__.lower():
+        logger.warn('Asked for the %s reactor, but %s is installed', name, installed.__class__.__name__)
+    return installed
+
+class LazyReactor(object):
+    '''Passes everything through to twisted's reactor, installing one the
+    first time it's needed.'''
+    def __getattr__(self, attr):
+        return getattr(installReactor(), attr)
+
+    def __repr__(self):
+        return '<LazyReactor>'
+
+reactor = LazyReactor()
 
 def parse(url):
+    '''Split a url into its scheme, host, port and path, the same way that
+    twisted.web.client does (without having to import it).'''
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    scheme, netloc, path, params, query, fragment = urlparse.urlparse(url.strip())
+    path = urlparse.urlunparse(('', '', path, params, query, fragment)) or '/'
+    host, port = netloc, (scheme == 'https') and 443 or 80
+    if ':' in host:
+        host, port = host.split(':')
+        try:
+            port = int(port)
+        except ValueError:
+            port = (scheme == 'https') and 443 or 80
+    return scheme, host, port, path
+
+def canonical(url):
+    '''The url in a form that's the same for every way of writing it: the
+    scheme and host lowercased, the default port dropped and an empty path
+    made into '/'.'''
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    parsed = urlparse.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or '').lower()
+    if ':' in netloc:
+        netloc = '[%s]' % netloc
     try:
-        return client._parse(url)
-    except TypeError:
-        return client._parse(url.encode('utf-8'))
+        port = parsed.port
+    except ValueError:
+        port = None
+    if port and port != {'http': 80, 'https': 443}.get(scheme):
+        netloc += ':%i' % port
+    if '@' in parsed.netloc:
+        netloc = parsed.netloc.rpartition('@')[0] + '@' + netloc
+    return urlparse.urlunsplit((scheme, netloc, parsed.path or '/', parsed.query, ''))
+
+# The `<scheme>_proxy` environment variables, read the first time they're needed
+environProxies = {}
+
+def environProxy(scheme):
+    '''The proxy the environment specifies for this scheme, if any'''
+    try:
+        return environProxies[scheme]
+    except KeyError:
+        return environProxies.setdefault(scheme, os.environ.get('%s_proxy' % scheme))
 
 class AuthException(Exception):
     def __init__(self, value):
@@ -94,92 +205,230 @@ class AuthException(Exception):
     def __str__(self):
         return str(self.value)
 
+# A name=value (or name="value") pair in an authentication challenge
+challengeParam = re.compile(r'([\w-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^,\s]*))')
+
+def parseChallenge(value):
+    '''Split a challenge into its (lowercased) scheme and its parameters'''
+    method, _, rest = value.strip().partition(' ')
+    params = {}
+    for name, quoted, plain in challengeParam.findall(rest):
+        params[name.lower()] = quoted and re.sub(r'\\(.)', r'\1', quoted) or plain
+    return method.lower(), params
+
+def md5hex(value):
+    return hashlib.md5(value).hexdigest()
+
+class Credentials(object):
+    '''User/pass pairs for hosts (and, optionally, realms). The lookup keys and
+    Basic headers are worked out once, when they're registered, and the realm
+    or Digest challenge each host last sent is remembered, so that requests
+    to it can be authenticated up front, rather than after a 401.'''
+    def __init__(self):
+        # key => (user, pass), and key => Basic header
+        self.auths   = {}
+        self.basics  = {}
+        # host key => the realm it last challenged with
+        self.realms  = {}
+        # host key => the last Digest challenge from it, and its nonce count
+        self.digests = {}
+        # host (or url) => host key
+        self.hosts   = {}
+        self.lock    = threading.Lock()
+
+    def hostKey(self, host):
+        '''The key for this host (or url), like `example.com:80`'''
+        try:
+            return self.hosts[host]
+        except KeyError:
+            pass
+        _scheme, _host, _port, _path = parse(host)
+        if _host == '':
+            _scheme, _host, _port, _path = parse('http://' + host)
+        key = _port and '%s:%s' % (_host, _port) or _host
+        if len(self.hosts) >= 10000:
+            self.hosts.clear()
+        self.hosts[host] = key
+        return key
+
+    def key(self, host, realm=None):
+        host = self.hostKey(host)
+        if realm:
+            return '%s:%s' % (host, realm)
+        return host
+
+    def register(self, host, realm, username, password):
+        '''Register a user/pass for a host/realm combination. If realm is None
+        or False, then this is the default for the host.'''
+        key = self.key(host, realm)
+        self.auths[key]  = (username, password)
+        self.basics[key] = 'Basic %s' % base64.b64encode('%s:%s' % (username, password)).strip()
+
+    def unregister(self, host, realm=None):
+        key = self.key(host, realm)
+        self.basics.pop(key, None)
+        return self.auths.pop(key, None)
+
+    def get(self, host, realm=None):
+        '''The user/pass pair for this host/realm, or the host's default'''
+        pair = self.auths.get(self.key(host, realm))
+        if not pair or not pair[0]:
+            pair = self.auths.get(self.key(host, None), (None, None))
+        return pair
+
+    def basic(self, host, realm=None):
+        '''The Basic header for this host/realm, if we have credentials'''
+        return self.basics.get(self.key(host, realm)) or self.basics.get(self.key(host, None))
+
+    def preempt(self, url, method='GET', uri=None):
+        '''The header value to authenticate a request for url with, before
+        being asked to, or None if we don't know of one'''
+        if not self.auths:
+            return None
+        host = self.hostKey(url)
+        state = self.digests.get(host)
+        if state:
+            return self.respond(state, method, uri or parse(url)[3])
+        return self.basic(host, self.realms.get(host))
+
+    def challenge(self, host, headers, method='GET', uri='/'):
+        '''Answer the challenge in these response headers. Returns a
+        dictionary of the request headers to add, which is empty if we don't
+        have credentials for it.'''
+        challenges = headers.get('proxy-authenticate')
+        if challenges:
+            name = 'Proxy-Authorization'
+        else:
+            challenges = headers.get('www-authenticate') or headers.get('authenticate')
+            if not challenges:
+                return {}
+            name = 'Authorization'
+
+        # Digest is the stronger of the two, if both are offered
+        parsed = [parseChallenge(c) for c in challenges]
+        parsed.sort(key=lambda pair: pair[0] != 'digest')
+        scheme, params = parsed[0]
+        if scheme == 'digest':
+            signature = self.digestAuth(params, host, method, uri)
+        elif scheme == 'basic':
+            signature = self.basicAuth(params, host)
+        else:
+            raise AuthException('Unsupported Auth method: %s' % scheme)
+
+        if signature:
+            return { name: signature }
+        return {}
+
+    def basicAuth(self, params, host):
+        realm = params.get('realm', None)
+        signature = self.basic(host, realm)
+        if signature:
+            self.realms[self.hostKey(host)] = realm
+        return signature
+
+    def digestAuth(self, params, host, method, uri):
+        realm = params.get('realm', '')
+        username, password = self.get(host, realm)
+        if not (username and password):
+            return None
+        algorithm = params.get('algorithm', 'MD5')
+        if algorithm.upper() not in ('MD5', 'MD5-SESS'):
+            raise AuthException('Unsupported Digest algorithm: %s' % algorithm)
+        qop = [q.strip() for q in params.get('qop', '').split(',')]
+        state = {
+            'username' : username,
+            'realm'    : realm,
+            'nonce'    : params.get('nonce', ''),
+            'opaque'   : params.get('opaque'),
+            'algorithm': params.get('algorithm'),
+            'sess'     : algorithm.upper() == 'MD5-SESS',
+            'qop'      : 'auth' in qop and 'auth' or None,
+            # This part of the response doesn't change with the nonce count
+            'ha1'      : md5hex('%s:%s:%s' % (username, realm, password)),
+            'nc'       : 0
+        }
+        # A new challenge (including one saying our nonce is stale) replaces
+        # the old one, and starts the count again
+        self.digests[self.hostKey(host)] = state
+        return self.respond(state, method, uri)
+
+    def respond(self, state, method, uri):
+        '''The Digest header for the next request under this challenge'''
+        with self.lock:
+            state['nc'] += 1
+            nc = '%08x' % state['nc']
+        cnonce = os.urandom(8).encode('hex')
+        ha1 = state['ha1']
+        if state['sess']:
+            ha1 = md5hex('%s:%s:%s' % (ha1, state['nonce'], cnonce))
+        ha2 = md5hex('%s:%s' % (method, uri))
+        if state['qop']:
+            response = md5hex(':'.join((ha1, state['nonce'], nc, cnonce, state['qop'], ha2)))
+        else:
+            response = md5hex('%s:%s:%s' % (ha1, state['nonce'], ha2))
+        fields = [('username', state['username']), ('realm', state['realm']),
+            ('nonce', state['nonce']), ('uri', uri), ('response', response)]
+        if state['opaque'] is not None:
+            fields.append(('opaque', state['opaque']))
+        fields = ['%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in fields]
+        if state['algorithm']:
+            fields.append('algorithm=%s' % state['algorithm'])
+        if state['qop']:
+            fields.extend(['qop=%s' % state['qop'], 'nc=%s' % nc, 'cnonce="%s"' % cnonce])
+        return 'Digest %s' % ', '.join(fields)
+
 class Auth(object):
     # The purpose of this class is to manage HTTP Authentication user/pass
-    # pairs, and to generate request headers associated with HTTP Auth
-    _auths = {}
+    # pairs, and to generate request headers associated with HTTP Auth. It
+    # keeps them in a registry shared by every fetcher that isn't given one
+    # of its own
+    credentials = Credentials()
+    _auths = credentials.auths
 
     @staticmethod
     def _makeKey(host, realm=None):
         # Given a host, realm, generate the key to store this under
-        _scheme, _host, _port, _path = parse(host)
-        if _host == '':
-            _scheme, _host, _port, _path = parse('http://' + host)
-        if _port:
-            _host = '%s:%s' % (_host, _port)
-        if realm:
-            return '%s:%s' % (_host, realm)
-        return _host
+        return Auth.credentials.key(host, realm)
 
     @staticmethod
     def register(host, realm, username, password):
         # Register a user/pass for a host/realm combination.
         # If realm is None or False, then this is the default for the
         # provided host.
-        Auth._auths[Auth._makeKey(host, realm)] = (username, password)
+        Auth.credentials.register(host, realm, username, password)
 
     @staticmethod
     def unregister(host, realm=None):
         # Remove a user/pass for a host/realm combination
-        return Auth._auths.pop(Auth._makeKey(host, realm), None)
+        return Auth.credentials.unregister(host, realm)
 
     @staticmethod
     def get(host, realm=None):
         # This gets the user/pass pair for the provided host/realm combination
         # If we can't find one for the specific realm, then we look for any
         # default user/pass pair registered for the host
-        pair = Auth._auths.get(Auth._makeKey(host, realm), (None, None))
-        if not pair[0]:
-            pair = Auth._auths.get(Auth._makeKey(host, None), (None, None))
-        return pair
+        return Auth.credentials.get(host, realm)
 
     @staticmethod
     def auth(host, request, headers):
-        # First, determine what kind of authentication has to happen
-        auth = headers.get('proxy-authenticate', [None])[0]
-        if auth:
-            # And save the request header name
-            authname = 'Proxy-Authorization'
-        else:
-            auth = headers.get('authenticate', [None])[0]
-            if auth:
-                # And save the request header name
-                authname = 'Authorization'
-            else:
-                return {}
-
-        # With all of that determine, we can do the source-agnostic work
-        chunks = auth.split(' ')
-        method = chunks.pop(0)
-        params = [r.strip().partition('=') for r in chunks]
-        params = dict((r[0], r[2].strip('"')) for r in params)
-
-        if method.lower() == 'basic':
-            signature = Auth.basicAuth(params, host, request, headers)
-        elif method.lower() == 'digest':
-            # signature = Auth.digestAuth(params, host, request, headers)
-            raise AuthException('Unsupported Auth method: Digest')
-        else:
-            raise AuthException('Unsupported Auth method: %s' % method)
-
-        if signature:
-            return { authname: signature }
-        else:
-            return {}
+        # Work out the headers that answer the challenge in these headers
+        method, uri = 'GET', '/'
+        if request is not None:
+            method = request.data is None and 'GET' or 'POST'
+            uri = parse(request.url)[3]
+        return Auth.credentials.challenge(host, headers, method, uri)
 
     @staticmethod
     def basicAuth(params, host, request, headers):
-        auth = Auth.get(host, params.get('realm', None))
-        if auth[0] and auth[1]:
-            raw  = '%s:%s' % auth
-            auth = 'Basic %s' % base64.b64encode(raw).strip()
-            return auth
-        else:
-            return None
+        return Auth.credentials.basicAuth(params, host)
 
     @staticmethod
     def digestAuth(params, host, request, headers):
-        return {}
+        method, uri = 'GET', '/'
+        if request is not None:
+            method = request.data is None and 'GET' or 'POST'
+            uri = parse(request.url)[3]
+        return Auth.credentials.digestAuth(params, host, method, uri)
 
 class UserPreemptionError(error.Error):
     '''The exception raised when a user cancels a request'''
@@ -193,137 +442,130 @@ class UserPreemptionError(error.Error):
     def __str__(self):
         return repr(self)
 
-class BaseRequestServicer(client.HTTPClientFactory):
-    '''This class services requests, providing the request with
-    additional callbacks beyond those typically provided. For
-    example, it's by way of this class that `onHeaders`, `onURL`,
-    and `onStatus` are supported.'''
-    def __init__(self, request, agent):
-        '''Provide the request to service, and the user agent to identify with.'''
-        self.request          = request
-        self.request.cached   = True
-        self.request.time     = -time.time()
-        self.request.encoding = None
-        client.HTTPClientFactory.__init__(self, url=request.url, agent=agent, headers=request.headers, timeout=request.timeout,
-            followRedirect=request.followRedirect, redirectLimit=request.redirectLimit, postdata=self.request.data)
-
-    def setURL(self, url):
-        '''Called when redirection occurs, with the new url.
-        This method is aware of the `*_proxy` environment
-        variables, and so if present, it will override the
-        default action, but the redirected url will still appear
-        as the argument to the request callback.'''
-        # Especially on redirects, the url can lack a domain name
-        url = urlparse.urljoin(self.request.url, url)
-        try:
-            self.request.onURL(url)
-        except UserPreemptionError as e:
-            self.cancel(e)
-        except:
-            logger.exception('%s onURL failed' % self.request.url)
-        scheme, host, port, path = parse(url)
-        self.proxy = os.environ.get('%s_proxy' % scheme) or self.request.proxy
-        # If a proxy is specified in the environment, or for this
-        # particular request, service it with that proxy
-        if self.proxy:
-            scheme, host, port, path = parse(self.proxy)
-            self.scheme = scheme
-            self.host = host
-            self.port = port
-            self.path = url
-            self.url = url
-            # Now, let's get an auth if there is any for the proxy
-            if port:
-                auth = Auth.basicAuth({}, '%s:%s' % (host, port), None, {})
-            else:
-                auth = Auth.basicAuth({}, host, None, {})
-            if auth:
-                self.headers.setdefault('Proxy-Authorization', auth)
-        else:
-            try:
-                client.HTTPClientFactory.setURL(self, url)
-            except TypeError:
-                # Twisted does not like to accept unicode strings. So,
-                # if it decides to be stupid, then we'll try to encode the
-                # url as utf-8
-                client.HTTPClientFactory.setURL(self, url.encode('utf-8'))
-        logger.debug('URL: %s' % self.url)
-
-    def gotHeaders(self, headers):
-        '''Received headers, a dictionary of lists.'''
-        try:
-            # This request is marked as cached iff every request was served out
-            # of the cache specified, and it was a hit.
-            cached = self.proxy and ('HIT from %s' % self.host) in ';'.join(headers.get('x-cache', ''))
-            self.request.cached = self.request.cached and cached
-            # Set the request's encoding, if applicable
-            self.request.encoding = ';'.join(headers.get('content-encoding', ['identity']))
-            self.request.onHeaders(headers)
-        except UserPreemptionError as e:
-            self.cancel(e)
-        except:
-            logger.exception('%s onHeaders failed' % self.request.url)
-        # The general gotHeaders stuff
-        try:
-            # Friggin' client.HTTPClientFactory likes to die here when confronted
-            # with invalid set cookie headers. Sure, maybe that's the best practice,
-            # but maybe it's just stupid
-            client.HTTPClientFactory.gotHeaders(self, headers)
-        except:
-            # Ignore all the cookie stuff
-            pass
+class RequestTimeout(defer.TimeoutError):
+    '''A request took too long. Which part of it took too long is told by
+    which of these it is.'''
+    phase = 'request'
 
-    def gotStatus(self, version, status, message):
-        '''Received the HTTP version, status and status message.'''
-        try:
-            self.request.onStatus(version, status, message)
-        except UserPreemptionError as e:
-            self.cancel(e)
-        except:
-            logger.exception('%s onStatus failed' % self.request.url)
-        client.HTTPClientFactory.gotStatus(self, version, status, message)
-
-    def buildProtocol(self, *args, **kwargs):
-        '''In order to facilitate user preemption, we need to remember
-        the protocol we made. So, save it and pass through.'''
-        self.p = client.HTTPClientFactory.buildProtocol(self, *args, **kwargs)
-        return self.p
-
-    def cancel(self, err):
-        '''If the user needs to preempt the transfer. For example, if looking
-        at the content headers, we decide we don't want to get the file.'''
-        self.noPage(Failure(err))
-        self.p.quietLoss = True
-        self.p.transport.loseConnection()
-
-class BaseRequest(object):
-    time           = 0
-    proxy          = None
-    timeout        = 45
-    # Any headers that should be sent with the request
-    headers        = {}
-    redirectLimit  = 10
-    followRedirect = 1
-    cached         = False
-    encoding       = 'identity'
-    
-    def __init__(self, url, data=None, proxy=None, headers=None):
-        self.url, fragment = urlparse.urldefrag(url)
-        self.data = data
-        if proxy:
-            self.proxy = proxy
-        if headers:
-            self.headers = headers
+    def __init__(self, url, seconds):
+        defer.TimeoutError.__init__(self, url, seconds)
+        self.url     = url
+        self.seconds = seconds
 
-    def __del__(self):
-        # For a brief while, I was having problems with memory leaks, and so
-        # I was printing this out in order to help make sure that requests
-        # were getting freed. It has been a long time since that ugly day, but
-        # this will stay as a reminder. FWIW, Python's garbage collection is
-        # based on reference counting, which cannot detect leaks in the form
-        # of isolated cliques with no external references (circular reference)
-        # logger.debug('Deleting request for %s' % self.url)
-        pass
+    def __str__(self):
+        return 'Timed out %s %s after %ss' % (self.phase, self.url, self.seconds)
+
+class ConnectTimeout(RequestTimeout):
+    '''Resolving and connecting took too long'''
+    phase = 'connecting to'
+
+class FirstByteTimeout(RequestTimeout):
+    '''Connected, but the response took too long to start'''
+    phase = 'waiting for'
+
+class IdleTimeout(RequestTimeout):
+    '''The response stopped arriving for too long'''
+    phase = 'reading'
+
+class DeadlineTimeout(RequestTimeout):
+    '''The whole request (with its redirects) took too long'''
+    phase = 'fetching'
+
+def soonest(*timeouts):
+    '''The shortest of these timeouts, ignoring those that aren't set'''
+    timeouts = [t for t in timeouts if t]
+    return timeouts and min(timeouts) or None
+
+class Timing(object):
+    '''A breakdown of where the time went while servicing a request. Each
+    hop (the original url, and then each redirect) records when it reached
+    each of its milestones, from which the phases are computed:
+
+        dns      => resolving to resolved
+        connect  => connecting to connected
+        tls      => connected to secured
+        ttfb     => secured (or connected) to firstByte
+        transfer => firstByte to end
+
+    Milestones that weren't observed (for example, DNS resolution for
+    redirects is done by twisted, and folded into `connect`) leave their
+    phases as None. In addition, we keep the time the request spent in the
+    queue (if the fetcher stamped it), decompressing, and in callbacks.'''
+    phases = ('queue', 'dns', 'connect', 'tls', 'ttfb', 'transfer', 'decompress', 'callback')
+
+    def __init__(self, queued=None):
+        self.queued     = queued
+        self.started    = time.time()
+        self.finished   = None
+        self.decompress = None
+        self.callback   = None
+        self.hops       = []
+
+    def hop(self, url):
+        '''We're starting on a new url'''
+        now = time.time()
+        if self.hops:
+            self.hops[-1].setdefault('end', now)
+        self.hops.append({'url': url, 'start': now})
+
+    def mark(self, milestone):
+        '''The current hop reached this milestone. Only the first counts.'''
+        if self.hops:
+            self.hops[-1].setdefault(milestone, time.time())
+
+    @staticmethod
+    def between(start, end):
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @staticmethod
+    def breakdownHop(hop):
+        '''The phases for a single hop'''
+        between = Timing.between
+        return {
+            'dns'     : between(hop.get('resolving'), hop.get('resolved')),
+            'connect' : between(hop.get('connecting'), hop.get('connected')),
+            'tls'     : between(hop.get('connected'), hop.get('secured')),
+            'ttfb'    : between(hop.get('secured') or hop.get('connected'), hop.get('firstByte')),
+            'transfer': between(hop.get('firstByte'), hop.get('end'))
+        }
+
+    def breakdown(self):
+        '''The phases, summed across all hops, as well as the total'''
+        result = dict((phase, None) for phase in self.phases)
+        for hop in self.hops:
+            for phase, value in self.breakdownHop(hop).items():
+                if value is not None:
+                    result[phase] = (result[phase] or 0) + value
+        result['queue']      = self.between(self.queued, self.started)
+        result['decompress'] = self.decompress
+        result['callback']   = self.callback
+        result['total']      = self.between(self.started, self.finished or time.time())
+        return result
+
+# Requests with the same headers share one dictionary of them
+internedHeaders = {}
+
+def internHeaders(headers):
+    '''The shared dictionary equal to headers, which mustn't be modified'''
+    if not headers:
+        return BaseRequest.headers
+    try:
+        key = frozenset(headers.iteritems())
+    except TypeError:
+        return headers
+    found = internedHeaders.get(key)
+    if found is None:
+        if len(internedHeaders) >= 10000:
+            internedHeaders.clear()
+        found = internedHeaders.setdefault(key, dict(headers))
+    return found
+
+class Callbacks(object):
+    '''The callbacks (and what wraps them) that every request has. It keeps
+    no state of its own, so that requests can decide how to store theirs.'''
+    __slots__ = ()
 
     def cancel(self, reason):
         '''If for any reason, you discover you don't want to fetch
@@ -347,13 +589,13 @@ class BaseRequest(object):
 
     def onStatus(self, version, status, message):
         if status != '200':
-            logger.error('%s Got status => (%s, %s, %s)' % (self.url, version, status, message))
+            requestLogger.error('%s Got status => (%s, %s, %s)', self.url, version, status, message)
         pass
 
     def onURL(self, url):
         self.time = -time.time()
         if self.url != url:
-            logger.debug('%s set => %s' % (self.url, url))
+            requestLogger.debug('%s set => %s', self.url, url)
         pass
 
     # Finished
@@ -368,19 +610,35 @@ class BaseRequest(object):
     def _success(self, response, fetcher):
         try:
             self.time += time.time()
-            logger.info('Successfully fetched %s in %fs' % (self.url, self.time))
+            requestLogger.info('Successfully fetched %s in %fs', self.url, self.time)
+            start = time.time()
             if self.encoding in ('gzip', 'x-gzip'):
                 import gzip
+                import zlib
                 from cStringIO import StringIO
-                logger.info('Decompressing gzip-encoded content')
-                response = gzip.GzipFile(fileobj=StringIO(response)).read()
+                requestLogger.debug('Decompressing gzip-encoded content')
+                if self.truncated:
+                    # Without the end of the stream, decompress what's there
+                    response = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(response)
+                else:
+                    response = gzip.GzipFile(fileobj=StringIO(response)).read()
             elif self.encoding in ('zlib', 'deflate'):
                 import zlib
-                logger.info('Decompressing deflate-encoded content')
-                response = zlib.decompress(response)
+                requestLogger.debug('Decompressing deflate-encoded content')
+                if self.truncated:
+                    response = zlib.decompressobj().decompress(response)
+                else:
+                    response = zlib.decompress(response)
+            if self.timing:
+                self.timing.decompress = time.time() - start
+            start = time.time()
             self.onSuccess(response, fetcher)
+            if self.timing:
+                self.timing.callback = time.time() - start
         except Exception as e:
             logger.exception('Request success handler failed')
+        if self.timing:
+            self.timing.finished = time.time()
         return self
 
     # Failed to made contact
@@ -390,40 +648,148 @@ class BaseRequest(object):
             try:
                 failure.raiseException()
             except:
-                logger.exception('Failed for %s in %fs' % (self.url, self.time))
+                requestLogger.exception('Failed for %s in %fs', self.url, self.time)
+            start = time.time()
             self.onError(failure, fetcher)
+            if self.timing:
+                self.timing.callback = time.time() - start
         except Exception as e:
             logger.exception('Request error handler failed')
+        if self.timing:
+            self.timing.finished = time.time()
         return Failure(self)
 
+class BaseRequest(Callbacks):
+    time           = 0
+    proxy          = None
+    # The deadline for the whole request, in seconds, and optional limits
+    # on how long connecting, waiting for the response and any pause in
+    # the middle of it can take
+    timeout          = 45
+    connectTimeout   = None
+    firstByteTimeout = None
+    idleTimeout      = None
+    # Only fetch the headers (with HEAD), or only the first `prefix` bytes
+    # of the body. If the body was cut short, it's `truncated`.
+    head           = False
+    prefix         = None
+    truncated      = False
+    # Any headers that should be sent with the request
+    headers        = {}
+    redirectLimit  = 10
+    followRedirect = 1
+    cached         = False
+    encoding       = 'identity'
+    # When the request was queued, and where the time went when serviced
+    queued         = None
+    timing         = None
+
+    # For a brief while, I was having problems with memory leaks, and so
+    # I was printing out when requests were deleted in order to help make
+    # sure that requests were getting freed. FWIW, Python's garbage collection
+    # is based on reference counting, which cannot detect leaks in the form
+    # of isolated cliques with no external references (circular reference).
+    # Worse, a clique with a __del__ can never be collected at all, and so
+    # there isn't one anymore.
+    def __init__(self, url, data=None, proxy=None, headers=None):
+        self.url, fragment = urlparse.urldefrag(url)
+        self.data = data
+        if proxy:
+            self.proxy = proxy
+        if headers:
+            self.headers = headers
+
+class SlimRequest(Callbacks):
+    '''A request that takes as little memory as it can, for when millions
+    are waiting. It has no __dict__, so subclasses that add attributes must
+    list them in their own __slots__. The timeout, redirect and partial fetch
+    settings are kept on the class, and requests with the same headers share
+    them.'''
+    __slots__ = ('url', 'data', 'proxy', 'headers', 'time', 'cached', 'encoding',
+        'truncated', 'queued', 'timing', '_originalKey', '_lease')
+    timeout          = 45
+    connectTimeout   = None
+    firstByteTimeout = None
+    idleTimeout      = None
+    redirectLimit  = 10
+    followRedirect = 1
+    head           = False
+    prefix         = None
+
+    def __init__(self, url, data=None, proxy=None, headers=None):
+        self.url, fragment = urlparse.urldefrag(url)
+        self.data     = data
+        self.proxy    = proxy
+        self.headers  = internHeaders(headers)
+        self.time     = 0
+        self.cached   = False
+        self.encoding = 'identity'
+        self.truncated = False
+        self.queued   = None
+        self.timing   = None
+
+    def __getstate__(self):
+        # Without a __dict__, pickle needs to be told what to save (which
+        # includes the __dict__ of any subclass that didn't use __slots__)
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            slots = getattr(cls, '__slots__', ())
+            for name in isinstance(slots, basestring) and (slots,) or slots:
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+        if 'headers' in state:
+            self.headers = internHeaders(self.headers)
+
 class RobotsRequest(BaseRequest):
     def __init__(self, url, *args, **kwargs):
+        # Where to record the rules we find (a downpour.Robots.Robots). If
+        # there isn't one, they're handed to reppy.
+        self.robots = kwargs.pop('robots', None)
         BaseRequest.__init__(self, url, *args, **kwargs)
         self.status = 200
         self.ttl    = 3600 * 3
 
+    def record(self, text):
+        if self.robots is not None:
+            self.robots.parse(self.url, text, self.ttl)
+        else:
+            import reppy
+            reppy.parse(text, url=self.url, autorefresh=False, ttl=self.ttl)
+
     def onStatus(self, version, status, message):
-        logger.warn('%s => Status %s' % (self.url, status))
+        logger.warn('%s => Status %s', self.url, status)
         self.status = int(status)
         if self.status == 401 or self.status == 403:
             # This means we're forbidden
-            reppy.parse('''User-agent: *\nDisallow: /''', url=self.url, autorefresh=False, ttl=self.ttl)
+            self.record('''User-agent: *\nDisallow: /''')
         elif self.status != 200:
             # This means we're going to act like there wasn't one
-            logger.warn('No robots.txt => %s' % self.url)
-            reppy.parse('', url=self.url, autorefresh=False, ttl=self.ttl)
+            logger.warn('No robots.txt => %s', self.url)
+            self.record('')
 
     def onSuccess(self, text, fetcher):
-        reppy.parse(text, url=self.url, autorefresh=False, ttl=self.ttl)
+        self.record(text)
 
     def onError(self, *args, **kwargs):
-        reppy.parse('', url=self.url, autorefresh=False, ttl=self.ttl)
+        # Non-200 statuses end up here, too, and we've already dealt
+        # with those that forbid us
+        if self.status != 401 and self.status != 403:
+            self.record('')
 
 class BaseFetcher(object):
-    def __init__(self, poolSize=10, agent=None, stopWhenDone=False, grow=5.0):
-        self.sslContext = ssl.ClientContextFactory()
-        # The base fetcher keeps track of requests as a list
-        self.requests = []
+    def __init__(self, poolSize=10, agent=None, stopWhenDone=False, grow=5.0, metrics=None, reactorName=None, redirects=None, proxies=None, credentials=None, queue=None, sink=None, threads=None, breaker=None, timeouts=None, eyeballs=None, coalesce=False):
+        # Pick the reactor now (the best available, unless one's named),
+        # before anything gets a chance to install the default one
+        installReactor(reactorName)
+        # The base fetcher keeps track of requests as a list, unless it's
+        # given something else with append, extend, pop and len (like a
+        # downpour.SpillQueue.SpillQueue)
+        self.requests = [] if queue is None else queue
         # A limit on the number of requests that can be in flight
         # at the same time
         self.poolSize = poolSize
@@ -435,11 +801,63 @@ class BaseFetcher(object):
         self.lock = threading.RLock()
         self.numFlight = 0
         self.processed = 0
-        self.remaining = 0
+        self.remaining = len(self.requests)
+        # What we're being fed requests from (see `feed`), how far ahead of
+        # those in flight to read it, and whether we're reading it now
+        self.feeding   = None
+        self.lookahead = 0
+        self.topping   = False
         # Use this user agent when making requests
         self.agent = agent or 'rogerbot/1.0'
         self.stopWhenDone = stopWhenDone
         self.period       = grow
+        # An optional downpour.Metrics.Metrics to feed as requests complete
+        self.metrics      = metrics
+        # An optional downpour.RedirectCache.RedirectCache, to remember where
+        # urls redirect to, and fetch them from there directly
+        self.redirects    = redirects
+        # An optional downpour.ProxyPool.ProxyPool to send requests through,
+        # the call to wake us up if all of its proxies are ejected, and the
+        # requests that are waiting on one of its proxies to come free
+        self.proxies      = proxies
+        self.proxyLater   = None
+        self.awaiting     = []
+        # An optional downpour.Credentials to authenticate requests with,
+        # instead of the ones registered with `Auth`
+        self.credentials  = credentials
+        # An optional downpour.Sink.Sink to write what's fetched to. When
+        # it's full, we wait for it to let us know it has room again.
+        self.sink         = sink
+        if sink is not None:
+            sink.drained  = lambda: reactor.callFromThread(self.serveNext)
+        # How many threads to pop requests on (and to do other blocking work
+        # for the scheduler on, see `deferToPool`), so that a queue that has
+        # to make a round trip, like redis, doesn't hold up the reactor. By
+        # default, requests are popped on the reactor thread, as they were.
+        # With threads, `pop` must be safe to call from them.
+        self.threads      = threads
+        self.pool         = None
+        self.popping      = 0
+        # An optional downpour.Breaker.Breaker, to stop fetching from hosts
+        # that can't be reached, and what it's holding back in park mode
+        self.breaker      = breaker
+        self.parked       = {}
+        self.checkLater   = None
+        # Timeouts for every request, by phase: 'connect', 'firstByte',
+        # 'idle' and 'deadline'. Where a request has its own, the shorter
+        # of the two applies.
+        self.timeouts     = timeouts or {}
+        # An optional downpour.HappyEyeballs.HappyEyeballs, to connect to
+        # whichever of a host's addresses answers first
+        self.eyeballs     = eyeballs
+        # Whether a request for something that's already being fetched (the
+        # same url, body and partial fetch mode) should wait for that fetch
+        # and get its callbacks, rather than fetching it again. Those in
+        # flight are kept by (canonical url, data, head, prefix), and
+        # `coalesced` counts the followers.
+        self.coalesce     = coalesce
+        self.inflight     = {}
+        self.coalesced    = 0
         # The object that represents our repeated call to grow
         self.growLater = reactor.callLater(self.period, self.grow, self.poolSize)
 
@@ -451,13 +869,21 @@ class BaseFetcher(object):
     # This is how we get the next request to service. Return None if there
     # is no next request to service. That doesn't have to mean that it's done
     def pop(self):
-        try:
-            return self.requests.pop()
-        except IndexError:
-            return None
+        while True:
+            try:
+                r = self.requests.pop()
+            except IndexError:
+                return None
+            if self.breaker is None:
+                return r
+            key = self.circuitKey(r)
+            if self.breaker.allow(key):
+                return r
+            self.callOnReactor(self.hold, key, [r])
 
     # This is how to fetch another request
     def push(self, request):
+        request.queued = time.time()
         self.requests.append(request)
         self.serveNext()
         with self.lock:
@@ -466,6 +892,9 @@ class BaseFetcher(object):
 
     # This is how to fetch several more requests
     def extend(self, requests):
+        now = time.time()
+        for request in requests:
+            request.queued = now
         self.requests.extend(requests)
         self.serveNext()
         with self.lock:
@@ -484,7 +913,49 @@ class BaseFetcher(object):
     # self.remaining updated. As such, it's recommended to internally make
     # calls to `extend` or `push` for that purpose
     def grow(self, count):
-        self.grew(0)
+        self.grew(self.top())
+
+    # This is how to fetch requests from an iterable, like a generator that
+    # reads them from a file, without reading it all up front.
+    def feed(self, requests, lookahead=None):
+        '''Fetch requests from this iterable, reading no further ahead of the
+        requests in flight than `lookahead` (twice the pool size by default)'''
+        with self.lock:
+            self.feeding   = iter(requests)
+            self.lookahead = lookahead or 2 * self.poolSize
+        return self.top()
+
+    def top(self):
+        '''Read more of what we're being fed, until `lookahead` requests are
+        waiting. Returns how many were added.'''
+        while True:
+            with self.lock:
+                if self.feeding is None or self.topping:
+                    return 0
+                wanted = self.lookahead - (self.remaining - self.numFlight)
+                if wanted <= 0:
+                    return 0
+                self.topping = True
+                batch = []
+                try:
+                    # What was read before it broke is kept
+                    batch.extend(itertools.islice(self.feeding, wanted))
+                except Exception:
+                    logger.exception('Reading what we are fed failed')
+                if len(batch) < wanted:
+                    # That's the last of them
+                    self.feeding = None
+            # Extending can take the queue's own locks, which mustn't be taken
+            # while we're holding ours (see `serveNext`)
+            try:
+                added = batch and self.extend(batch) or 0
+            finally:
+                with self.lock:
+                    self.topping = False
+            # If the queue turned away everything we read (robots.txt may
+            # disallow all of it), nothing will come back to ask for more
+            if added or not batch:
+                return added
 
     # This is how you let the fetcher know that you've grown by a certain
     # amount.
@@ -511,6 +982,9 @@ class BaseFetcher(object):
     def onError(self, request):
         pass
 
+    def onShed(self, key, requests):
+        pass
+
     # These are how you can start and stop the reactor. It's a convenience
     # so that you don't have to import reactor when you want to use this
     def start(self):
@@ -536,17 +1010,29 @@ class BaseFetcher(object):
                 self.numFlight -= 1
                 self.processed += 1
                 self.remaining -= 1
-                logger.info('Processed : %i | Remaining : %i | In Flight : %i' % (self.processed, self.remaining, self.numFlight))
+                requestLogger.info('Processed : %i | Remaining : %i | In Flight : %i', self.processed, self.remaining, self.numFlight)
+                if self.metrics:
+                    self.metrics.pool(self.numFlight, self.poolSize)
+            if self.metrics and request.timing:
+                self.metrics.phases(request.timing.breakdown())
             self.onDone(request)
         except Exception as e:
             logger.exception('BaseFetcher:onDone failed.')
         finally:
-            # If there are no more requests being serviced, and no requests
-            # waiting to be serviced, the perhaps it is time to stop.
-            if self.stopWhenDone and not self.numFlight and not len(self):
-                self.stop()
-                return
-            self.serveNext()
+            if not self.stopIfDone():
+                self.serveNext()
+
+    def stopIfDone(self):
+        '''If there are no more requests being serviced, and no requests
+        waiting to be serviced, the perhaps it is time to stop. A request
+        that's been popped on a scheduler thread, but not yet handed to
+        `_popped`, is counted in neither, so nothing may be being popped.
+        Nor may anything be waiting on a proxy.'''
+        if (self.stopWhenDone and not self.numFlight and not self.popping
+            and not self.awaiting and not len(self) and not self.top()):
+            self.stop()
+            return True
+        return False
 
     def _success(self, request):
         '''A request has completed successfully.'''
@@ -562,42 +1048,382 @@ class BaseFetcher(object):
         except Exception as e:
             logger.exception('BaseFetcher:onError failed.')
 
+    def _measure(self, result, factory):
+        '''Record the outcome of a request serviced by factory in our
+        metrics, passing the result through untouched.'''
+        try:
+            breakdown = factory.request.timing.breakdown()
+            self.metrics.request(urlparse.urlparse(factory.url).hostname,
+                getattr(factory, 'status', None),
+                isinstance(result, str) and len(result) or 0,
+                breakdown['total'], breakdown['connect'], breakdown['ttfb'])
+            if isinstance(result, Failure) and isinstance(result.value, RequestTimeout):
+                self.metrics.inc('downpour_timeouts_total', kind=type(result.value).__name__)
+        except Exception:
+            logger.exception('Recording metrics failed')
+        return result
+
+    def coalesceKey(self, request):
+        '''What has to match for requests to share a fetch: the url, body,
+        partial fetch mode, proxy and headers (or None, if it can't share)'''
+        try:
+            headers = frozenset((request.headers or {}).iteritems())
+        except TypeError:
+            return None
+        return (canonical(request.url), request.data, request.head, request.prefix,
+            request.proxy, headers)
+
+    def _fanout(self, result, factory, key):
+        '''Give the requests that followed factory's the same result,
+        passing it through untouched for factory's own request.'''
+        if self.inflight.get(key) is factory:
+            del self.inflight[key]
+        if isinstance(result, Failure) and result.check(UserPreemptionError) and factory.followers:
+            # Its own request was cancelled, but its followers still want it,
+            # and so they're fetched again (the first leading the rest)
+            followers, factory.followers = factory.followers, []
+            for r, d in followers:
+                with self.lock:
+                    self.numFlight -= 1
+                self.fetch(r)
+        else:
+            factory.fanout(result)
+        return result
+
+    def _record(self, result, factory):
+        '''Hand what was fetched (or how it failed) to our sink'''
+        try:
+            if isinstance(result, Failure):
+                body  = getattr(result.value, 'response', None)
+                error = result.getErrorMessage()
+            else:
+                body, error = result, None
+            self.sink.write({
+                'url'    : factory.url,
+                'status' : getattr(factory, 'status', None),
+                'version': getattr(factory, 'version', None),
+                'message': getattr(factory, 'message', None),
+                'headers': factory.response_headers,
+                'timing' : factory.request.timing and factory.request.timing.breakdown(),
+                'time'   : time.time(),
+                'body'   : isinstance(body, str) and body or None,
+                'error'  : error
+            })
+        except Exception:
+            logger.exception('Recording %s failed', factory.url)
+        return result
+
+    def reserveProxy(self):
+        '''Acquire a proxy for the next request, or None if none is available.
+        If they've all been ejected, check back when the first is let back in.'''
+        pooled = self.proxies.acquire()
+        if pooled is None:
+            wait = self.proxies.wait()
+            if wait and not (self.proxyLater and self.proxyLater.active()):
+                self.proxyLater = reactor.callLater(wait, self.serveNext)
+        return pooled
+
+    def unreserve(self, pooled):
+        '''Give back a proxy reserved for a request that won't be using it'''
+        if pooled is not None:
+            self.proxies.cancel(pooled)
+
+    def circuitKey(self, request):
+        '''The key of the circuit this request falls under: its hostname'''
+        return urlparse.urlparse(request.url).hostname
+
+    def _circuit(self, result, key):
+        '''Let the circuit for this key know how a request went'''
+        try:
+            self.breaker.record(key, result)
+        except Exception:
+            logger.exception('Recording circuit for %s failed', key)
+        return result
+
+    def hold(self, key, requests):
+        '''These requests weren't fetched, because the circuit for key is
+        open. In park mode, they're put back for when it's next probed, and
+        otherwise, they're failed.'''
+        if self.breaker.mode != 'park':
+            return self.shed(key, requests)
+        parked = self.parked.setdefault(key, [])
+        if not parked:
+            reactor.callLater(max(self.breaker.until(key) - time.time(), 0), self.unpark, key)
+        parked.extend(requests)
+
+    def unpark(self, key):
+        self.requests.extend(self.parked.pop(key, []))
+        self.serveNext()
+
+    def shed(self, key, requests):
+        '''Fail these requests right away, because the circuit for key is
+        open. Each request's own callbacks are called, but for the fetcher,
+        it's one call to `onShed` for all of them.'''
+        for r in requests:
+            r.time = -time.time()
+            r._error(self.breaker.error(key), self)
+            r._done(None, self)
+        with self.lock:
+            self.processed += len(requests)
+            self.remaining -= len(requests)
+        if self.metrics:
+            self.metrics.inc('downpour_shed_total', len(requests))
+        try:
+            self.onShed(key, requests)
+        except Exception:
+            logger.exception('BaseFetcher:onShed failed.')
+        # That might have been the last of them
+        if not (self.checkLater and self.checkLater.active()):
+            self.checkLater = reactor.callLater(0, self.stopIfDone)
+
+    def _release(self, result, proxy, start):
+        '''A request through a pooled proxy is done. Errors that come from the
+        proxy itself (it couldn't be reached, or it couldn't reach the site)
+        count against it, but errors from the site itself don't.'''
+        try:
+            if isinstance(result, Failure):
+                status = getattr(result.value, 'status', None)
+                ok = isinstance(result.value, error.Error) and status not in ('502', '504')
+                self.proxies.release(proxy, time.time() - start, 0, ok)
+            else:
+                self.proxies.release(proxy, time.time() - start, len(result or ''))
+        except Exception:
+            logger.exception('Releasing proxy %s failed', proxy.url)
+        return result
+
+    def connect(self, factory, scheme, host, port):
+        '''Resolve the host, and then connect the factory to it. Resolving
+        it ourselves lets us time DNS separately from connecting.'''
+        if self.eyeballs is not None:
+            return self.eyeballs.connect(host, port or (scheme == 'https' and 443 or 80), factory,
+                self.contextFactory(factory, scheme), factory.request.timing)
+        factory.request.timing.mark('resolving')
+        if abstract.isIPAddress(host):
+            d = defer.succeed(host)
+        else:
+            d = reactor.resolve(host)
+        d.addCallback(self._connect, factory, scheme, port)
+        d.addErrback(lambda failure: factory.clientConnectionFailed(None, failure))
+        return d
+
+    def _connect(self, address, factory, scheme, port):
+        if not factory.waiting:
+            # It timed out while we were resolving
+            return
+        factory.request.timing.mark('resolved')
+        if scheme == 'https':
+            return reactor.connectSSL(address, port or 443, factory, self.contextFactory(factory, scheme))
+        else:
+            return reactor.connectTCP(address, port or 80, factory)
+
+    def contextFactory(self, factory, scheme):
+        '''The TLS context for the factory's connection, if it needs one'''
+        if scheme == 'https':
+            from downpour.BaseRequestServicer import TimedContextFactory
+            return TimedContextFactory(factory.request.timing)
+        return None
+
+    def deferToPool(self, f, *args, **kwargs):
+        '''Call f on one of our scheduler threads, returning a Deferred that
+        fires on the reactor thread with its result. Without threads, it's
+        called right away.'''
+        if not self.threads:
+            return defer.maybeDeferred(f, *args, **kwargs)
+        from twisted.internet.threads import deferToThreadPool
+        if self.pool is None:
+            from twisted.python.threadpool import ThreadPool
+            self.pool = ThreadPool(1, self.threads, 'downpour-scheduler')
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        return deferToThreadPool(reactor, self.pool, f, *args, **kwargs)
+
+    def onPool(self):
+        '''Whether this is one of our scheduler threads'''
+        return self.pool is not None and threading.current_thread() in self.pool.threads
+
+    def callOnReactor(self, f, *args, **kwargs):
+        '''Call f on the reactor thread, even from one of our scheduler
+        threads, like timers and user callbacks must be'''
+        from twisted.python import threadable
+        if self.threads and not threadable.isInIOThread():
+            reactor.callFromThread(f, *args, **kwargs)
+        else:
+            f(*args, **kwargs)
+
+    def timedPop(self):
+        '''Pop the next request, timing how long it took'''
+        if self.metrics:
+            with self.metrics.timed('downpour_scheduler_seconds'):
+                return self.pop()
+        return self.pop()
+
+    def _popped(self, result, pooled=None):
+        '''A pop on one of our scheduler threads has come back, with the
+        proxy that was reserved for what it popped'''
+        with self.lock:
+            self.popping -= 1
+            if isinstance(result, Failure):
+                self.unreserve(pooled)
+                logger.error('Popping failed: %s', result.getTraceback())
+                return
+            if result is not None:
+                self.fetch(result, pooled)
+            else:
+                self.unreserve(pooled)
+        if result is None:
+            # Nothing's ready. If we're being fed, read some more, which
+            # will serve it. Otherwise, wait to be woken up, unless that
+            # was the last of it.
+            if not self.top():
+                self.stopIfDone()
+            return
+        self.serveNext()
+
     # This repeatedly services available requests while there are spots open
     # and there are requests to be serviced. If there are no queued requests,
     # then it will attempt to grow the queue with a call to `grow`, which
-    # must return by how much the queue grew.
+    # must return by how much the queue grew. With threads, the pops happen
+    # on them, no more than one per thread at a time, and `_popped` carries
+    # on from there. Our lock can be held while the queue takes its own locks
+    # (popping), but never the other way around, so it's let go of before
+    # reading more of what we're fed, which pushes onto the queue. With a
+    # pool of proxies, one is reserved before each pop, so that more isn't
+    # popped than the proxies can take. What's waiting on one goes first.
     def serveNext(self):
-        with self.lock:
-            while self.numFlight < self.poolSize:
-                r = self.pop()
-                if r == None:
+        while True:
+            with self.lock:
+                while self.numFlight + self.popping < self.poolSize:
+                    if self.sink is not None and self.sink.full():
+                        return
+                    pooled = None
+                    if self.proxies is not None:
+                        pooled = self.reserveProxy()
+                        if pooled is None:
+                            return
+                        if self.awaiting:
+                            self.fetch(self.awaiting.pop(0), pooled)
+                            continue
+                    if self.threads:
+                        if self.popping >= self.threads:
+                            self.unreserve(pooled)
+                            return
+                        self.popping += 1
+                        self.deferToPool(self.timedPop).addBoth(self._popped, pooled)
+                        continue
+                    r = self.timedPop()
+                    if r == None:
+                        self.unreserve(pooled)
+                        break
+                    self.fetch(r, pooled)
+                else:
                     return
-                logger.debug('Requesting %s' % r.url)
-                self.numFlight += 1
-                try:
-                    # This is the expansion of the short version getPage
-                    # and is taken from twisted's source
-                    scheme, host, port, path = parse(r.url)
-                    factory = BaseRequestServicer(r, self.agent)
-                    # If http_proxy or https_proxy, or whatever appropriate proxy
-                    # is set, then we should try to honor that. We do so simply
-                    # by overriding the host/port we'll connect to. The client
-                    # factory, BaseRequestServicer takes care of the rest
-                    proxy = os.environ.get('%s_proxy' % scheme) or r.proxy
-                    if proxy:
-                        scheme, host, port, path = parse(proxy)
-                    if scheme == 'https':
-                        from twisted.internet import ssl
-                        contextFactory = ssl.ClientContextFactory()
-                        reactor.connectSSL(host, port or 443, factory, contextFactory)
-                    else:
-                        reactor.connectTCP(host, port or 80, factory)
-                    factory.deferred.addCallback(r._success, self).addCallback(self._success)
-                    factory.deferred.addErrback(r._error, self).addErrback(self._error).addErrback(log.err)
-                    factory.deferred.addBoth(r._done, self).addBoth(self._done)
-                except:
-                    self.numFlight -= 1
-                    logger.exception('Unable to request %s' % r.url)
+            # Nothing's ready. If we're being fed, read some more
+            if not self.top():
+                return
+
+    def fetch(self, r, pooled=None):
+        '''Start fetching this request, which has just been popped, through
+        the proxy from our pool that was reserved for it, if any'''
+        from twisted.python import log
+        from downpour.BaseRequestServicer import BaseRequestServicer
+        with self.lock:
+            requestLogger.debug('Requesting %s', r.url)
+            self.numFlight += 1
+            if self.metrics:
+                self.metrics.pool(self.numFlight, self.poolSize)
+            try:
+                key = self.coalesce and self.coalesceKey(r) or None
+                if key is not None:
+                    leader = self.inflight.get(key)
+                    if leader is not None:
+                        # It still counts as in flight until its leader is done
+                        requestLogger.debug('Coalescing %s', r.url)
+                        self.unreserve(pooled)
+                        d = leader.follow(r)
+                        d.addCallback(r._success, self).addCallback(self._success)
+                        d.addErrback(r._error, self).addErrback(self._error).addErrback(log.err)
+                        d.addBoth(r._done, self).addBoth(self._done)
+                        self.coalesced += 1
+                        if self.metrics:
+                            self.metrics.inc('downpour_coalesced_total')
+                        return
+                # This is the expansion of the short version getPage
+                # and is taken from twisted's source
+                chain = [r.url]
+                if self.redirects is not None and r.data is None and r.followRedirect:
+                    chain = self.redirects.resolve(r.url, r.redirectLimit)
+                scheme, host, port, path = parse(chain[-1])
+                # Requests that don't name their own proxy go through the pool.
+                # One that has none reserved for it (a follower whose leader
+                # was cancelled) and can't get one waits for one, rather than
+                # going direct.
+                if self.proxies is not None and not r.proxy:
+                    pooled = pooled or self.reserveProxy()
+                    if pooled is None:
+                        self.numFlight -= 1
+                        self.awaiting.append(r)
+                        return
+                else:
+                    self.unreserve(pooled)
+                    pooled = None
+                factory = BaseRequestServicer(r, self.agent, self.redirects, chain,
+                    pooled and pooled.url, self.credentials, self.timeouts, self.eyeballs)
+                # If http_proxy or https_proxy, or whatever appropriate proxy
+                # is set, then we should try to honor that. We do so simply
+                # by overriding the host/port we'll connect to. The client
+                # factory, BaseRequestServicer takes care of the rest
+                proxy = pooled and pooled.url or environProxy(scheme) or r.proxy
+                if proxy:
+                    scheme, host, port, path = parse(proxy)
+                if key is not None:
+                    factory.deferred.addBoth(self._fanout, factory, key)
+                if pooled:
+                    factory.deferred.addBoth(self._release, pooled, time.time())
+                if self.breaker is not None:
+                    factory.deferred.addBoth(self._circuit, self.circuitKey(r))
+                if self.sink is not None:
+                    factory.deferred.addBoth(self._record, factory)
+                self.connect(factory, scheme, host, port)
+                if key is not None and not factory.deferred.called:
+                    self.inflight[key] = factory
+                if self.metrics:
+                    factory.deferred.addBoth(self._measure, factory)
+                factory.deferred.addCallback(r._success, self).addCallback(self._success)
+                factory.deferred.addErrback(r._error, self).addErrback(self._error).addErrback(log.err)
+                factory.deferred.addBoth(r._done, self).addBoth(self._done)
+                factory.deferred.addBoth(factory.finished)
+            except:
+                self.numFlight -= 1
+                logger.exception('Unable to request %s', r.url)
+
+# Now a few names for convenience. These are imported the first time that
+# they're used, so that you only pay for (and need) redis, qr and reppy if
+# you actually use the PoliteFetcher.
+lazy = {
+    'PoliteFetcher'      : 'downpour.PoliteFetcher',
+    'BaseRequestServicer': 'downpour.BaseRequestServicer',
+    'TimedContextFactory': 'downpour.BaseRequestServicer'
+}
+
+class LazyModule(types.ModuleType):
+    '''This module, but with the names in `lazy` imported on demand'''
+    def __getattr__(self, name):
+        if name not in lazy:
+            raise AttributeError(name)
+        module = __import__(lazy[name], fromlist=[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        # Importing a submodule sets it as an attribute of its package, but
+        # `downpour.PoliteFetcher` should remain the class, not the module
+        if name in lazy and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        types.ModuleType.__setattr__(self, name, value)
 
-# Now do a few imports for convenience
-from PoliteFetcher import PoliteFetcher
+# Hold on to the original module, or Python 2 clears its globals as soon as
+# it's replaced in sys.modules
+original = sys.modules[__name__]
+sys.modules[__name__] = LazyModule(__name__, __doc__)
+sys.modules[__name__].__dict__.update(original.__dict__)
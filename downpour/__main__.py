@@ -21,14 +21,41 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from downpour import BaseRequest, BaseFetcher, logger
-import logging
+'''Fetch the urls in some files: python -m downpour [options] urls.txt ...'''
 
-logger.setLevel(logging.DEBUG)
+import sys
+import argparse
+import itertools
+import downpour
+from downpour import Ingest
 
-# Read in a set of urls to fetch
-with file('urls.txt') as f:
-	reqs = [BaseRequest(u) for u in f.read().strip().split('\n')]
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m downpour', description='Fetch urls. Fast.')
+    parser.add_argument('paths', nargs='*', default=['urls.txt'],
+        help='Files of urls, one per line, or of JSON lines (possibly gzipped), or - for stdin')
+    parser.add_argument('--format', choices=sorted(Ingest.formats), default=None,
+        help='The format of the files, if it cannot be told from their names')
+    parser.add_argument('--pool', type=int, default=100, help='How many requests to make at once')
+    parser.add_argument('--lookahead', type=int, default=None,
+        help='How many requests to read ahead of those in flight')
+    parser.add_argument('--agent', default=None, help='The user agent to identify as')
+    parser.add_argument('--polite', action='store_true', help='Use the PoliteFetcher (which needs redis)')
+    parser.add_argument('--delay', type=float, default=2, help='The PoliteFetcher\'s crawl delay')
+    parser.add_argument('--logging', default='development', help='The logging mode')
+    options = parser.parse_args(argv)
 
-# Now start it!
-BaseFetcher(100, reqs).start()
\ No newline at end of file
+    downpour.configureLogging(options.logging)
+    if options.polite:
+        fetcher = downpour.PoliteFetcher(options.pool, options.agent, stopWhenDone=True, delay=options.delay)
+    else:
+        fetcher = downpour.BaseFetcher(options.pool, options.agent, stopWhenDone=True)
+
+    # Only as much of the files is read as the fetcher is ready for
+    requests = itertools.chain.from_iterable(
+        Ingest.read(path, format=options.format) for path in options.paths)
+    if fetcher.feed(requests, options.lookahead) or len(fetcher):
+        fetcher.start()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
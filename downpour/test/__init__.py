@@ -53,6 +53,28 @@ def run(fetcher, callback=None, *args, **kwargs):
         print 'PASSED'
         exit(0)
 
+def redisOptions(index=0):
+    '''Keyword arguments for a PoliteFetcher (or a redis.ConnectionPool) that
+    reach an empty redis. If DOWNPOUR_TEST_REDIS is a redis url, that's used
+    (offset by `index` databases, so that a test can have several), and is
+    flushed first. Otherwise, each call makes a separate in-memory fakeredis.
+    If there's neither, the test that asked is skipped.'''
+    import redis
+    url = os.environ.get('DOWNPOUR_TEST_REDIS')
+    if url:
+        pool = redis.ConnectionPool.from_url(url)
+        options = dict(pool.connection_kwargs, connection_class=pool.connection_class)
+        options['db'] = int(options.get('db', 0)) + index
+        redis.Redis(connection_pool=redis.ConnectionPool(**options)).flushdb()
+        return options
+    try:
+        import fakeredis
+        # Our scripts need Lua
+        import lupa
+    except ImportError:
+        raise unittest.SkipTest('Needs DOWNPOUR_TEST_REDIS, or fakeredis[lua]')
+    return {'connection_class': fakeredis.FakeConnection, 'server': fakeredis.FakeServer()}
+
 class UnittestRequest(BaseRequest):
     def __init__(self, name, *args, **kwargs):
         BaseRequest.__init__(self, *args, **kwargs)
@@ -42,6 +42,7 @@ setup(name       = 'downpour',
 	keywords     = 'Twisted, fetching, url, download, asynchronous',
 	license      = 'MIT',
 	packages     = ['downpour', 'downpour.test'],
+	package_data = {'downpour': ['public_suffix_list.dat']},
 	classifiers  = [
 		'License :: OSI Approved :: MIT License',
 		'Programming Language :: Python',
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+
+import time
+import logging
+import unittest
+from downpour import logger, requestLogger
+from downpour import BaseFetcher, BaseRequest, reactor
+from downpour.Breaker import Breaker, CircuitOpenError
+from twisted.web import error as web
+from twisted.internet import defer, error
+from twisted.python.failure import Failure
+
+logger.setLevel(logging.CRITICAL)
+requestLogger.setLevel(logging.CRITICAL)
+
+class Request(BaseRequest):
+    def __init__(self, url, errors):
+        BaseRequest.__init__(self, url)
+        self.errors = errors
+
+    def onError(self, failure, fetcher):
+        self.errors.append(failure.value)
+
+class Fetcher(BaseFetcher):
+    def __init__(self, *args, **kwargs):
+        BaseFetcher.__init__(self, *args, **kwargs)
+        self.shedding = []
+
+    def onShed(self, key, requests):
+        self.shedding.append((key, len(requests)))
+
+class TestBreaker(unittest.TestCase):
+    def test_open(self):
+        breaker = Breaker(failures=3, cooldown=60)
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertFalse(breaker.failure('a.com'))
+        self.assertFalse(breaker.failure('a.com'))
+        self.assertTrue(breaker.failure('a.com'))
+        self.assertFalse(breaker.allow('a.com'))
+        self.assertTrue(breaker.allow('b.com'))
+        self.assertEqual(len(breaker), 1)
+        self.assertTrue(breaker.until('a.com') > time.time() + 59)
+        self.assertEqual(breaker.until('b.com'), 0)
+
+    def test_probe(self):
+        breaker = Breaker(failures=1, cooldown=0.05)
+        breaker.failure('a.com')
+        self.assertFalse(breaker.allow('a.com'))
+        time.sleep(0.06)
+        # Exactly one probe goes through
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertFalse(breaker.allow('a.com'))
+        # A failed probe keeps it open, and a successful one closes it
+        breaker.failure('a.com')
+        self.assertFalse(breaker.allow('a.com'))
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow('a.com'))
+        breaker.success('a.com')
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertEqual(len(breaker), 0)
+        self.assertEqual(breaker.stats()['opened'], 1)
+
+    def test_record(self):
+        breaker = Breaker(failures=2)
+        # Only failures to reach the host count, and any response resets it
+        breaker.record('a.com', Failure(error.ConnectionRefusedError()))
+        breaker.record('a.com', 'Hello')
+        breaker.record('a.com', Failure(error.DNSLookupError()))
+        breaker.record('a.com', Failure(ValueError()))
+        self.assertTrue(breaker.allow('a.com'))
+        breaker.record('a.com', Failure(defer.TimeoutError()))
+        self.assertFalse(breaker.allow('a.com'))
+        breaker = Breaker(failures=1)
+        breaker.record('a.com', Failure(web.Error('404')))
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertRaises(ValueError, Breaker, mode='sideways')
+
+    def test_park(self):
+        fetcher = Fetcher(breaker=Breaker(failures=1, cooldown=60, mode='park'))
+        fetcher.breaker.failure('a.com')
+        errors = []
+        fetcher.requests.extend([Request('http://a.com/%i' % i, errors) for i in range(3)])
+        fetcher.requests.append(Request('http://b.com/', errors))
+        # The b.com request goes, while a.com's are held back
+        self.assertEqual(fetcher.pop().url, 'http://b.com/')
+        self.assertEqual(fetcher.pop(), None)
+        self.assertEqual(len(fetcher.parked['a.com']), 3)
+        self.assertEqual(errors, [])
+
+    def test_fail(self):
+        # This runs the reactor, and so has to be the only test that does.
+        # Nothing listens on port 1, so the first two requests are refused,
+        # and the rest are shed without trying.
+        fetcher = Fetcher(poolSize=1, stopWhenDone=True, breaker=Breaker(failures=2))
+        errors = []
+        fetcher.extend([Request('http://127.0.0.1:1/%i' % i, errors) for i in range(10)])
+        reactor.callLater(10, reactor.stop)
+        fetcher.start()
+        self.assertEqual(len(errors), 10)
+        self.assertEqual(len([e for e in errors if isinstance(e, CircuitOpenError)]), 8)
+        self.assertEqual(sum(count for key, count in fetcher.shedding), 8)
+        self.assertEqual(set(key for key, count in fetcher.shedding), set(['127.0.0.1']))
+        self.assertEqual(len(fetcher), 0)
+        self.assertEqual(fetcher.processed, 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+import logging
+import unittest
+from downpour import logger, requestLogger
+from downpour import BaseFetcher, BaseRequest, reactor, canonical
+from twisted.internet import protocol
+
+logger.setLevel(logging.CRITICAL)
+requestLogger.setLevel(logging.CRITICAL)
+
+class Slow(protocol.Protocol):
+    '''Counts its connections, and takes a moment to answer each'''
+    def connectionMade(self):
+        self.factory.connections += 1
+        reactor.callLater(0.2, self.answer)
+
+    def answer(self):
+        self.transport.write('HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nHello')
+        self.transport.loseConnection()
+
+class Request(BaseRequest):
+    def __init__(self, name, url, events, data=None, headers=None, cancel=False):
+        BaseRequest.__init__(self, url, data, headers=headers)
+        self.name = name
+        self.events = events.setdefault(name, [])
+        self.cancelling = cancel
+
+    def onStatus(self, version, status, message):
+        self.events.append(('status', status))
+        if self.cancelling:
+            self.cancel('Not this one')
+
+    def onSuccess(self, text, fetcher):
+        self.events.append(('success', text))
+
+    def onError(self, failure, fetcher):
+        self.events.append(('error', failure.value.__class__.__name__))
+
+    def onDone(self, response, fetcher):
+        self.events.append(('done', None))
+
+class TestCoalesce(unittest.TestCase):
+    def test_canonical(self):
+        self.assertEqual(canonical('HTTP://Example.COM'), 'http://example.com/')
+        self.assertEqual(canonical('http://example.com:80/a?b=c'), 'http://example.com/a?b=c')
+        self.assertEqual(canonical('https://example.com:443/'), 'https://example.com/')
+        self.assertEqual(canonical('https://example.com:8443/'), 'https://example.com:8443/')
+        self.assertEqual(canonical('http://user:pw@Example.com/'), 'http://user:pw@example.com/')
+        self.assertEqual(canonical('http://[::1]:80/'), 'http://[::1]/')
+
+    def test_coalesce(self):
+        # This runs the reactor, and so has to be the only test that does
+        factory = protocol.ServerFactory()
+        factory.protocol = Slow
+        factory.connections = 0
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1').getHost().port
+        url = 'http://127.0.0.1:%i/' % port
+        events = {}
+        fetcher = BaseFetcher(poolSize=20, stopWhenDone=True, coalesce=True)
+        # They're popped from the end
+        requests = [
+            # If the one leading cancels, the one following is fetched again
+            Request('refetched', url + 'other', events),
+            Request('cancels', url + 'other', events, cancel=True),
+            # A different body, or different headers, are different requests
+            Request('body', url, events, data='a=b'),
+            Request('cookie', url, events, headers={'Cookie': 'a=b'}),
+            # A follower can cancel without affecting the rest
+            Request('follower', url, events, cancel=True),
+            Request('upper', url.upper(), events),
+            Request('slashless', 'http://127.0.0.1:%i' % port, events),
+            Request('leader', url, events)
+        ]
+        fetcher.extend(requests)
+        reactor.callLater(10, reactor.stop)
+        fetcher.start()
+        self.assertEqual(factory.connections, 5)
+        self.assertEqual(fetcher.coalesced, 4)
+        self.assertEqual(fetcher.processed, 8)
+        self.assertEqual(fetcher.numFlight, 0)
+        self.assertEqual(fetcher.inflight, {})
+        # Every one that didn't cancel heard everything
+        heard = [('status', '200'), ('success', 'Hello'), ('done', None)]
+        for name in ('leader', 'upper', 'slashless', 'body', 'cookie'):
+            self.assertEqual(events[name], heard)
+        self.assertEqual(events['refetched'], [('status', '200')] + heard)
+        cancelled = [('status', '200'), ('error', 'UserPreemptionError'), ('done', None)]
+        self.assertEqual(events['follower'], cancelled)
+        self.assertEqual(events['cancels'], cancelled)
+        # Followers have their own timing, with the milestones they shared
+        leader, upper = requests[-1], requests[-3]
+        self.assertFalse(leader.timing is upper.timing)
+        self.assertTrue(upper.timing.breakdown()['ttfb'] > 0.1)
+        self.assertTrue(upper.timing.finished >= leader.timing.hops[0]['end'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+import logging
+import unittest
+from downpour import BaseRequest, RobotsRequest, logger
+from downpour.test import redisOptions
+from downpour.PoliteFetcher import PoliteFetcher
+
+logger.setLevel(logging.CRITICAL)
+
+private = 'User-agent: *\nDisallow: /private'
+
+class Fetcher(PoliteFetcher):
+    def __init__(self, *args, **kwargs):
+        PoliteFetcher.__init__(self, *args, **kwargs)
+        self.disallowed = []
+
+    def onDisallowed(self, request):
+        self.disallowed.append(request.url)
+
+class Watched(object):
+    '''A lock that counts how often it's taken while any of `inner` are held'''
+    def __init__(self, lock, inner):
+        self.lock     = lock
+        self.inner    = inner
+        self.inverted = 0
+
+    def __enter__(self):
+        if not self.lock._is_owned() and any(lock._is_owned() for lock in self.inner):
+            self.inverted += 1
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+class TestDisallowed(unittest.TestCase):
+    def setUp(self):
+        self.options = redisOptions()
+
+    def test_push(self):
+        f = Fetcher(**self.options)
+        f.robots.parse('http://a.example.com/robots.txt', private)
+        self.assertEqual(f.push(BaseRequest('http://a.example.com/private/1')), 0)
+        self.assertEqual(f.push(BaseRequest('http://a.example.com/public/1')), 1)
+        # Where we don't know the rules yet, it's allowed for now
+        self.assertEqual(f.push(BaseRequest('http://b.example.com/private/1')), 1)
+        self.assertEqual(f.extend([
+            BaseRequest('http://a.example.com/private/2'),
+            BaseRequest('http://a.example.com/public/2')]), 1)
+        self.assertEqual(f.disallowed, [
+            'http://a.example.com/private/1', 'http://a.example.com/private/2'])
+        self.assertEqual(f.rejected, 2)
+        self.assertEqual(f.pending(), 3)
+        self.assertEqual(f.remaining, 3)
+
+    def test_allowAll(self):
+        f = Fetcher(allowAll=True, **self.options)
+        f.robots.parse('http://a.example.com/robots.txt', private)
+        self.assertEqual(f.push(BaseRequest('http://a.example.com/private/1')), 1)
+        self.assertEqual(f.rejected, 0)
+
+    def test_pop(self):
+        f = Fetcher(**self.options)
+        f.push(BaseRequest('http://a.example.com/private/1'))
+        f.push(BaseRequest('http://a.example.com/public/1'))
+        # The rules aren't known, and so they're fetched first
+        r = f.pop()
+        self.assertTrue(isinstance(r, RobotsRequest))
+        f.robots.parse(r.url, private)
+        f.settle(r)
+        # And then what they disallow is passed over
+        self.assertEqual(f.pop(polite=False).url, 'http://a.example.com/public/1')
+        self.assertEqual(f.disallowed, ['http://a.example.com/private/1'])
+        self.assertEqual(f.pending(), 0)
+        self.assertEqual(f.remaining, 1)
+
+    def test_reliable(self):
+        f = Fetcher(reliable=True, worker='w', **self.options)
+        f.robots.parse('http://a.example.com/robots.txt', 'User-agent: *\nAllow: /')
+        f.push(BaseRequest('http://a.example.com/private/1'))
+        f.robots.parse('http://a.example.com/robots.txt', private)
+        self.assertEqual(f.pop(polite=False), None)
+        self.assertEqual(f.disallowed, ['http://a.example.com/private/1'])
+        # Its lease was let go of
+        self.assertEqual(f.r.llen('lease:w'), 0)
+        self.assertEqual(f.remaining, 0)
+
+    def test_feed(self):
+        # Being fed nothing but what's disallowed doesn't stop the feed
+        f = Fetcher(**self.options)
+        f.robots.parse('http://a.example.com/robots.txt', private)
+        urls = ['http://a.example.com/private/%i' % i for i in range(10)]
+        urls.append('http://a.example.com/public/1')
+        self.assertEqual(f.feed((BaseRequest(url) for url in urls), lookahead=4), 1)
+        self.assertEqual(f.rejected, 10)
+        self.assertEqual(f.pending(), 1)
+
+    def test_lockOrder(self):
+        # Our lock can be held around the queue's locks, but not taken inside
+        # of them (as rejecting at pop once did), or with threads, popping
+        # and being fed can deadlock
+        f = Fetcher(threads=4, delay=0, **self.options)
+        f.lock = Watched(f.lock, [f.req_lock, f.pld_lock, f.twi_lock])
+        # Nothing that's popped here finishes
+        f.maxParallelRequests = 100
+        pushed = ['http://a.example.com/%s/%i' % (path, i)
+            for i in range(10) for path in ('private', 'public')]
+        for url in pushed:
+            f.push(BaseRequest(url))
+        f.robots.parse('http://a.example.com/robots.txt', private)
+        f.feed((BaseRequest(url) for url in pushed), lookahead=100)
+        popped = []
+        while True:
+            r = f.pop()
+            if r is None:
+                break
+            popped.append(r.url)
+        self.assertEqual(popped, [url for url in pushed if 'public' in url] * 2)
+        self.assertEqual(f.lock.inverted, 0)
+
+if __name__ == '__main__':
+    unittest.main()
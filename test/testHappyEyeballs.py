@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+
+import socket
+import logging
+import unittest
+from downpour import logger, requestLogger
+from downpour import BaseFetcher, BaseRequest, reactor
+from downpour.HappyEyeballs import HappyEyeballs, interleave
+from twisted.internet import protocol
+
+logger.setLevel(logging.CRITICAL)
+requestLogger.setLevel(logging.CRITICAL)
+
+v4 = socket.AF_INET
+v6 = socket.AF_INET6
+
+class Hello(protocol.Protocol):
+    def connectionMade(self):
+        self.transport.write('HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nHello')
+        self.transport.loseConnection()
+
+class Request(BaseRequest):
+    def __init__(self, url, results):
+        BaseRequest.__init__(self, url)
+        self.results = results
+
+    def onSuccess(self, text, fetcher):
+        self.results.append(text)
+
+    def onError(self, failure, fetcher):
+        self.results.append(failure.value)
+
+class TestHappyEyeballs(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(interleave([1, 2, 3], ['a']), [1, 'a', 2, 3])
+        addresses = [(v4, '1.1.1.1'), (v4, '2.2.2.2'), (v6, '::1'), (v6, '::2')]
+        eyeballs = HappyEyeballs()
+        # IPv6 goes first, and the families alternate
+        self.assertEqual(eyeballs.order('a.com', addresses),
+            [(v6, '::1'), (v4, '1.1.1.1'), (v6, '::2'), (v4, '2.2.2.2')])
+        # Until something else works
+        eyeballs.worked('a.com', (v4, '2.2.2.2'))
+        self.assertEqual(eyeballs.order('a.com', addresses),
+            [(v4, '2.2.2.2'), (v4, '1.1.1.1'), (v6, '::1'), (v6, '::2')])
+        # And stops working
+        eyeballs.failed('a.com', (v4, '2.2.2.2'))
+        self.assertEqual(eyeballs.order('a.com', addresses)[0], (v6, '::1'))
+
+    def test_race(self):
+        # This runs the reactor, and so has to be the only test that does.
+        # The host has three addresses: one refuses connections, one never
+        # answers (its backlog is full) and one works.
+        factory = protocol.ServerFactory()
+        factory.protocol = Hello
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1').getHost().port
+        hangs = socket.socket()
+        hangs.bind(('127.0.0.2', port))
+        hangs.listen(0)
+        fillers = [socket.socket() for i in range(3)]
+        for filler in fillers:
+            filler.setblocking(0)
+            filler.connect_ex(('127.0.0.2', port))
+
+        lookups = []
+        def getaddrinfo(host, port, family, socktype):
+            lookups.append(host)
+            return [(v4, socktype, 6, '', (address, port)) for address in
+                ('127.0.0.3', '127.0.0.2', '127.0.0.1')]
+
+        eyeballs = HappyEyeballs(stagger=0.2, getaddrinfo=getaddrinfo)
+        fetcher = BaseFetcher(poolSize=1, stopWhenDone=True, eyeballs=eyeballs)
+        results = []
+        url = 'http://example.test:%i/' % port
+        fetcher.extend([Request(url, results), Request(url, results)])
+        reactor.callLater(10, reactor.stop)
+        fetcher.start()
+        self.assertEqual(results, ['Hello', 'Hello'])
+        # It was resolved once, and the address that worked was used again
+        self.assertEqual(lookups, ['example.test'])
+        self.assertEqual(eyeballs.winners.get('example.test'), (v4, '127.0.0.1'))
+        self.assertEqual(eyeballs.stats(), {'hosts': 1, 'races': 2, 'fallbacks': 1})
+        for s in [hangs] + fillers:
+            s.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+
+import unittest
+from downpour.HashRing import HashRing
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.keys = ['domain:%i.example.com' % i for i in range(10000)]
+
+    def test_empty(self):
+        self.assertEqual(HashRing().get('domain:foo.com'), None)
+
+    def test_stable(self):
+        # The same nodes, in any order, map keys the same way
+        a = HashRing(['a', 'b', 'c'])
+        b = HashRing(['c', 'a', 'b'])
+        for key in self.keys:
+            self.assertEqual(a.get(key), b.get(key))
+        self.assertEqual(a.get(u'domain:foo.com'), a.get('domain:foo.com'))
+
+    def test_balance(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = dict((node, 0) for node in ring.nodes)
+        for key in self.keys:
+            counts[ring.get(key)] += 1
+        for node, count in counts.items():
+            self.assertTrue(1500 < count < 3500, '%s has %i keys' % (node, count))
+
+    def test_add(self):
+        # Adding a node should only move keys onto that node, and only
+        # about its share of them
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get(key)) for key in self.keys)
+        ring.add('d')
+        moved = [key for key in self.keys if ring.get(key) != before[key]]
+        self.assertTrue(all(ring.get(key) == 'd' for key in moved))
+        self.assertTrue(1500 < len(moved) < 3500)
+
+    def test_remove(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        before = dict((key, ring.get(key)) for key in self.keys)
+        ring.remove('d')
+        self.assertEqual(len(ring), 3)
+        self.assertFalse('d' in ring)
+        for key in self.keys:
+            if before[key] != 'd':
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.assertNotEqual(ring.get(key), 'd')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import unittest
+import subprocess
+
+def python(code):
+    '''Run this code in a fresh interpreter, returning its stdout'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.abspath('..'), env.get('PYTHONPATH', '')])
+    env.pop('DOWNPOUR_LOGGING', None)
+    return subprocess.check_output([sys.executable, '-c', code], env=env)
+
+class TestImport(unittest.TestCase):
+    def test_side_effects(self):
+        # Importing shouldn't print anything, install a reactor, or pull in
+        # the politeness stack. How long it takes is in bench/imports.py.
+        output = python('\n'.join([
+            'import sys',
+            'import downpour',
+            'heavy = ("qr", "redis", "reppy", "OpenSSL", "twisted.web.client", "twisted.internet.reactor")',
+            'print [m for m in heavy if m in sys.modules]']))
+        self.assertEqual(output.strip(), '[]')
+
+    def test_no_reactor(self):
+        # Even after making requests, there's no reactor until one's needed
+        output = python('\n'.join([
+            'import sys',
+            'import downpour',
+            'requests = [downpour.BaseRequest("http://a.com/"), downpour.SlimRequest("http://a.com/")]',
+            'print [m for m in ("redis", "twisted.internet.reactor") if m in sys.modules]']))
+        self.assertEqual(output.strip(), '[]')
+
+    def test_lazy(self):
+        output = python('\n'.join([
+            'import downpour',
+            'from downpour import PoliteFetcher',
+            'import downpour.PoliteFetcher',
+            'print PoliteFetcher.__name__, downpour.PoliteFetcher is PoliteFetcher']))
+        self.assertEqual(output.strip(), 'PoliteFetcher True')
+
+    def test_reactor(self):
+        output = python('\n'.join([
+            'import downpour',
+            'fetcher = downpour.BaseFetcher(reactorName="select")',
+            'print downpour.reactor.__class__.__name__',
+            'print downpour.installReactor().__class__.__name__']))
+        self.assertEqual(output.split(), ['LazyReactor', 'SelectReactor'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+
+import os
+import gzip
+import shutil
+import tempfile
+import logging
+import unittest
+import downpour
+from downpour import Ingest
+
+downpour.logger.setLevel(logging.CRITICAL)
+
+class Fetcher(downpour.BaseFetcher):
+    '''Doesn't actually fetch anything'''
+    def serveNext(self):
+        pass
+
+class Picky(Fetcher):
+    '''Turns away anything private'''
+    def push(self, request):
+        if 'private' in request.url:
+            return 0
+        return Fetcher.push(self, request)
+
+    def extend(self, requests):
+        return sum(self.push(request) for request in requests)
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, text, compress=False):
+        path = os.path.join(self.path, name)
+        f = compress and gzip.open(path, 'wb') or open(path, 'wb')
+        f.write(text)
+        f.close()
+        return path
+
+    def test_text(self):
+        path = self.write('urls.txt', '# Seeds\nhttp://a.com/\n\n  http://b.com/#top \n')
+        self.assertEqual([r.url for r in Ingest.read(path)], ['http://a.com/', 'http://b.com/'])
+
+    def test_gzip(self):
+        # Gzipped files are found by their contents, not their names
+        path = self.write('urls', 'http://a.com/\nhttp://b.com/\n', compress=True)
+        self.assertEqual([r.url for r in Ingest.read(path)], ['http://a.com/', 'http://b.com/'])
+
+    def test_jsonl(self):
+        path = self.write('urls.jsonl.gz', '\n'.join([
+            '"http://a.com/"',
+            '{"url": "http://b.com/", "headers": {"Accept": "text/html"}, "data": "x=1"}',
+            '{"url": "http://c.com/", "proxy": "http://proxy:3128"}',
+            '{"no": "url"}',
+            'not json'
+        ]), compress=True)
+        requests = list(Ingest.read(path, downpour.SlimRequest))
+        self.assertEqual([r.url for r in requests], ['http://a.com/', 'http://b.com/', 'http://c.com/'])
+        self.assertEqual(requests[1].headers, {'Accept': 'text/html'})
+        self.assertTrue(isinstance(requests[1].headers.keys()[0], str))
+        self.assertEqual(requests[1].data, 'x=1')
+        self.assertEqual(requests[2].proxy, 'http://proxy:3128')
+
+    def test_feed(self):
+        # Only as many are read as the fetcher's lookahead
+        read = []
+        def requests():
+            for i in range(100):
+                read.append(i)
+                yield downpour.BaseRequest('http://a.com/%i' % i)
+        fetcher = Fetcher(poolSize=5)
+        self.assertEqual(fetcher.feed(requests(), lookahead=10), 10)
+        self.assertEqual(len(read), 10)
+        self.assertEqual(fetcher.top(), 0)
+        # As requests are taken, it reads more
+        for i in range(4):
+            fetcher.pop()
+            fetcher.remaining -= 1
+        self.assertEqual(fetcher.top(), 4)
+        self.assertEqual(len(read), 14)
+        # Until there are no more
+        fetcher.remaining = 0
+        fetcher.lookahead = 1000
+        self.assertEqual(fetcher.top(), 86)
+        self.assertEqual(fetcher.feeding, None)
+        self.assertEqual(fetcher.top(), 0)
+
+    def test_rejected(self):
+        # A batch that's all turned away doesn't stop the reading
+        urls = ['http://a.com/private/%i' % i for i in range(10)] + ['http://a.com/public']
+        fetcher = Picky(poolSize=5)
+        self.assertEqual(fetcher.feed((downpour.BaseRequest(url) for url in urls), lookahead=4), 1)
+        self.assertEqual([r.url for r in fetcher.requests], ['http://a.com/public'])
+        self.assertEqual(fetcher.feeding, None)
+
+    def test_broken(self):
+        # A feed that raises is done, but what it gave us is kept
+        def requests():
+            yield downpour.BaseRequest('http://a.com/1')
+            yield downpour.BaseRequest('http://a.com/2')
+            raise IOError('Truncated')
+        fetcher = Fetcher(poolSize=5)
+        self.assertEqual(fetcher.feed(requests(), lookahead=10), 2)
+        self.assertEqual(fetcher.feeding, None)
+        self.assertEqual(fetcher.top(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+import socket
+import unittest
+from downpour import Keys
+
+class TestKeys(unittest.TestCase):
+    def test_hostname(self):
+        key = Keys.strategy()
+        self.assertEqual(key('http://www.example.com/foo'), 'domain:www.example.com')
+        self.assertEqual(key(' http://WWW.Example.com:8080/'), 'domain:www.example.com')
+
+    def test_suffixes(self):
+        suffixes = Keys.PublicSuffixList()
+        for host, expected in [
+            ('www.example.com'       , 'example.com'),
+            ('a.b.c.example.co.uk'   , 'example.co.uk'),
+            ('example.com'           , 'example.com'),
+            ('co.uk'                 , 'co.uk'),
+            # Private suffixes are included in the list
+            ('foo.blogspot.com'      , 'foo.blogspot.com'),
+            # Wildcards and exceptions
+            ('a.b.c.ck'              , 'b.c.ck'),
+            ('a.www.ck'              , 'www.ck'),
+            # Punycoded internationalized suffixes
+            ('a.b.xn--55qx5d.cn'     , 'b.xn--55qx5d.cn'),
+            ('10.0.0.1'              , '10.0.0.1'),
+            ('localhost'             , 'localhost')]:
+            self.assertEqual(suffixes.registered(host), expected)
+
+    def test_domain(self):
+        key = Keys.strategy('domain')
+        self.assertEqual(key('http://a.example.com/'), 'domain:example.com')
+        self.assertEqual(key('http://b.example.com/'), 'domain:example.com')
+        self.assertEqual(key('http://a.example.co.uk/'), 'domain:example.co.uk')
+
+    def test_address(self):
+        calls = []
+        def resolve(host):
+            calls.append(host)
+            if host == 'nowhere.invalid':
+                raise socket.gaierror('Not found')
+            return '10.0.0.1'
+        key = Keys.AddressKey(resolve=resolve)
+        self.assertEqual(key('http://a.example.com/'), 'domain:10.0.0.1')
+        self.assertEqual(key('http://b.example.org/'), 'domain:10.0.0.1')
+        self.assertEqual(key('http://a.example.com/other'), 'domain:10.0.0.1')
+        self.assertEqual(calls, ['a.example.com', 'b.example.org'])
+        # Whether a lookup would be needed can be asked without one
+        self.assertEqual(key.cached('http://a.example.com/'), 'domain:10.0.0.1')
+        self.assertEqual(key.cached('http://c.example.net/'), None)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(key('http://nowhere.invalid/'), 'domain:nowhere.invalid')
+        # Expired lookups are resolved again
+        key = Keys.AddressKey(ttl=-1, resolve=resolve)
+        key('http://a.example.com/')
+        key('http://a.example.com/')
+        self.assertEqual(calls[-2:], ['a.example.com', 'a.example.com'])
+
+    def test_strategy(self):
+        custom = lambda url: 'domain:everything'
+        self.assertTrue(Keys.strategy(custom) is custom)
+        self.assertRaises(ValueError, Keys.strategy, 'nonsense')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+
+import redis
+import logging
+import unittest
+from downpour import BaseRequest, logger
+from downpour.test import redisOptions
+from downpour.PoliteFetcher import PoliteFetcher, Lease
+
+logger.setLevel(logging.CRITICAL)
+
+class TestLease(unittest.TestCase):
+    def setUp(self):
+        self.r = redis.Redis(connection_pool=redis.ConnectionPool(**redisOptions()))
+        # The oldest request is at the tail
+        self.r.lpush('domain:a', 'first')
+        self.r.lpush('domain:a', 'second')
+        self.r.set('pending', 2)
+        self.keyFor = lambda packed: 'domain:a'
+
+    def test_take(self):
+        self.assertEqual(Lease.take(self.r, 'w', 'domain:a', 60), 'first')
+        self.assertEqual(self.r.lrange('lease:w', 0, -1), ['first'])
+        self.assertEqual(self.r.hget('lease:w:keys', 'first'), 'domain:a')
+        self.assertEqual(self.r.smembers('leases'), set(['w']))
+        self.assertEqual(self.r.get('pending'), '1')
+        self.assertEqual(Lease.take(self.r, 'w', 'domain:a', 60), 'second')
+        self.assertEqual(Lease.take(self.r, 'w', 'domain:a', 60), None)
+        self.assertEqual(self.r.get('pending'), '0')
+
+    def test_release(self):
+        packed = Lease.take(self.r, 'w', 'domain:a', 60)
+        self.assertTrue(Lease.release(self.r, 'w', packed))
+        # It's only held once
+        self.assertFalse(Lease.release(self.r, 'w', packed))
+        self.assertEqual(self.r.llen('lease:w'), 0)
+        self.assertEqual(self.r.zcard('lease:w:deadlines'), 0)
+        self.assertFalse(self.r.exists('lease:w:keys'))
+
+    def test_expired(self):
+        Lease.heartbeat(self.r, 'w', 60)
+        Lease.take(self.r, 'w', 'domain:a', 60)
+        Lease.take(self.r, 'w', 'domain:a', -1)
+        # Only the expired lease goes back, and it's counted as pending again
+        self.assertEqual(Lease.reap(self.r, 'w', self.keyFor), ['domain:a'])
+        self.assertEqual(self.r.lrange('domain:a', 0, -1), ['second'])
+        self.assertEqual(self.r.lrange('lease:w', 0, -1), ['first'])
+        self.assertEqual(self.r.get('pending'), '1')
+        # The worker's alive, and so it's still a leaseholder
+        self.assertEqual(self.r.smembers('leases'), set(['w']))
+
+    def test_dead(self):
+        # Without a heartbeat, every lease goes back, in the order it was in
+        Lease.take(self.r, 'w', 'domain:a', 60)
+        Lease.take(self.r, 'w', 'domain:a', 60)
+        self.assertEqual(Lease.reap(self.r, 'w', self.keyFor), ['domain:a'] * 2)
+        self.assertEqual(self.r.rpop('domain:a'), 'first')
+        self.assertEqual(self.r.rpop('domain:a'), 'second')
+        self.assertEqual(self.r.get('pending'), '2')
+        self.assertEqual(self.r.smembers('leases'), set())
+
+    def test_everything(self):
+        Lease.heartbeat(self.r, 'w', 60)
+        Lease.take(self.r, 'w', 'domain:a', 60)
+        self.assertEqual(Lease.reap(self.r, 'w', self.keyFor), [])
+        self.assertEqual(Lease.reap(self.r, 'w', self.keyFor, everything=True), ['domain:a'])
+        self.assertEqual(self.r.llen('domain:a'), 2)
+
+    def test_once(self):
+        # Two reapers can't both requeue a lease
+        Lease.take(self.r, 'w', 'domain:a', -1)
+        self.assertEqual(Lease.reap(self.r, 'w', self.keyFor), ['domain:a'])
+        self.assertEqual(Lease.reap(self.r, 'w', self.keyFor), [])
+        self.assertEqual(self.r.llen('domain:a'), 2)
+
+    def test_lost_key(self):
+        # If the key mapping never got written, the key's recovered
+        packed = Lease.take(self.r, 'w', 'domain:a', -1)
+        self.r.hdel('lease:w:keys', packed)
+        self.assertEqual(Lease.reap(self.r, 'w', lambda packed: 'domain:b'), ['domain:b'])
+        self.assertEqual(self.r.lrange('domain:b', 0, -1), ['first'])
+
+class TestReliable(unittest.TestCase):
+    def setUp(self):
+        self.options = redisOptions()
+
+    def fetcher(self):
+        return PoliteFetcher(allowAll=True, reliable=True, worker='w', **self.options)
+
+    def test_pop(self):
+        f = self.fetcher()
+        f.push(BaseRequest('http://a.example.com/1'))
+        r = f.pop()
+        self.assertEqual(r.url, 'http://a.example.com/1')
+        self.assertEqual(f.r.lrange('lease:w', 0, -1), [r._lease])
+        self.assertEqual(f.pending(), 0)
+        f.ack(r)
+        self.assertEqual(f.r.llen('lease:w'), 0)
+
+    def test_restart(self):
+        f = self.fetcher()
+        f.push(BaseRequest('http://a.example.com/1'))
+        f.push(BaseRequest('http://a.example.com/2'))
+        self.assertEqual(f.pop().url, 'http://a.example.com/1')
+        # The next life of this worker takes back what the last one held
+        g = self.fetcher()
+        self.assertEqual(g.r.llen('lease:w'), 0)
+        self.assertEqual(g.pending(), 2)
+        self.assertEqual(g.pop(polite=False).url, 'http://a.example.com/1')
+
+if __name__ == '__main__':
+    unittest.main()
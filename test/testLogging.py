@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+
+import logging
+import unittest
+import downpour
+from downpour.QueueHandler import QueueHandler, SampleFilter
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+class TestLogging(unittest.TestCase):
+    def record(self, msg, *args):
+        return logging.LogRecord('downpour', logging.INFO, __file__, 0, msg, args, None)
+
+    def test_queue_handler(self):
+        target  = ListHandler()
+        handler = QueueHandler([target])
+        handler.handle(self.record('Hello %s', 'world'))
+        handler.close()
+        self.assertEqual(target.records, ['Hello world'])
+
+    def test_queue_handler_full(self):
+        # Records are dropped, rather than blocking, when the queue is full
+        import threading
+        blocked = threading.Event()
+        release = threading.Event()
+        class SlowHandler(ListHandler):
+            def emit(self, record):
+                blocked.set()
+                release.wait(5)
+                ListHandler.emit(self, record)
+
+        target  = SlowHandler()
+        handler = QueueHandler([target], size=1)
+        handler.handle(self.record('Taken'))
+        blocked.wait(5)
+        handler.handle(self.record('Queued'))
+        handler.handle(self.record('Dropped'))
+        release.set()
+        handler.close()
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(target.records, ['Taken', 'Queued'])
+
+    def test_sample_filter(self):
+        self.assertFalse(SampleFilter(0.0).filter(self.record('Nope')))
+        self.assertTrue(SampleFilter(1.0).filter(self.record('Yep')))
+        # Exceptions are always logged
+        record = self.record('Oops')
+        record.exc_info = (ValueError, ValueError('Oops'), None)
+        self.assertTrue(SampleFilter(0.0).filter(record))
+
+    def test_configure(self):
+        # Nothing but the NullHandler is installed on import
+        self.assertEqual([h.__class__ for h in downpour.logger.handlers], [logging.NullHandler])
+        installed = downpour.configureLogging('production', sample=0.5)
+        try:
+            self.assertEqual([h.__class__ for h in installed], [QueueHandler])
+            self.assertEqual(downpour.logger.level, logging.INFO)
+            self.assertEqual(len(downpour.requestLogger.filters), 1)
+            # Reconfiguring replaces what was there
+            installed = downpour.configureLogging('development')
+            self.assertEqual(len(downpour.requestLogger.filters), 0)
+            self.assertEqual(len(downpour.logger.handlers), 2)
+        finally:
+            for handler in installed:
+                downpour.logger.removeHandler(handler)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+
+import unittest
+import threading
+from downpour.Metrics import Metrics, Histogram
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        h = Histogram(buckets=(1, 2, 3, 4))
+        for value in (0.5, 1.5, 2.5, 3.5):
+            h.observe(value)
+        self.assertEqual(h.count, 4)
+        self.assertEqual(h.sum, 8.0)
+        self.assertEqual(h.counts, [1, 1, 1, 1, 0])
+        self.assertEqual(h.quantile(0.5), 2.0)
+        self.assertEqual(Histogram().quantile(0.5), None)
+
+    def test_request(self):
+        m = Metrics()
+        m.request('foo.com', '200', 100, 0.5, connect=0.1, ttfb=0.2)
+        m.request('foo.com', '404', 10 , 0.3)
+        m.request('bar.com', None , 0  , 45.0)
+        snapshot = m.snapshot()
+        self.assertEqual(snapshot['requests'], 3)
+        self.assertEqual(snapshot['bytes'], 110)
+        self.assertEqual(snapshot['counters']['downpour_requests_total{status="2xx"}'], 1)
+        self.assertEqual(snapshot['counters']['downpour_requests_total{status="error"}'], 1)
+        self.assertEqual(snapshot['histograms'][
+            'downpour_request_seconds{host="foo.com",status="2xx"}']['count'], 1)
+        # Rates are relative to the last snapshot
+        self.assertEqual(m.snapshot()['requestsPerSecond'], 0)
+
+    def test_max_hosts(self):
+        m = Metrics(maxHosts=1)
+        self.assertEqual(m.host('foo.com'), 'foo.com')
+        self.assertEqual(m.host('bar.com'), 'other')
+        self.assertEqual(m.host('foo.com'), 'foo.com')
+
+    def test_max_hosts_threads(self):
+        # Hosts seen at once from several threads don't go over the cap
+        m = Metrics(maxHosts=10)
+        def label(i):
+            for j in range(100):
+                m.host('%i-%i.com' % (i, j))
+        threads = [threading.Thread(target=label, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(m.hosts), 10)
+
+    def test_render(self):
+        m = Metrics()
+        m.request('foo.com', '200', 100, 0.5)
+        m.pool(3, 10)
+        text = m.render()
+        self.assertTrue('# TYPE downpour_requests_total counter' in text)
+        self.assertTrue('downpour_requests_total{status="2xx"} 1' in text)
+        self.assertTrue('downpour_pool_in_flight 3' in text)
+        self.assertTrue('downpour_request_seconds_bucket{host="foo.com",status="2xx",le="+Inf"} 1' in text)
+        self.assertTrue('downpour_request_seconds_count{host="foo.com",status="2xx"} 1' in text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+
+import os
+import json
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import downpour
+from downpour.Monitor import Monitor, Profiler
+from downpour.Metrics import Metrics
+
+def busy(seconds):
+    '''Block whatever thread this is on'''
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+class TestMonitor(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_profiler(self):
+        profiler = Profiler(interval=0.001)
+        profiler.start()
+        busy(0.2)
+        profiler.stop()
+        self.assertTrue(profiler.samples > 10)
+        path = profiler.dump(os.path.join(self.path, 'stacks'))
+        with open(path) as f:
+            lines = f.read().strip().split('\n')
+        # Each line is a stack, and how often it was seen
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(int(count) > 0)
+        self.assertTrue(any('testMonitor.py:busy' in line for line in lines))
+
+    def test_stalls(self):
+        # This runs the reactor, and so has to be the only test that does
+        reactor = downpour.installReactor()
+        metrics = Metrics()
+        monitor = Monitor(interval=0.02, threshold=0.1, metrics=metrics, directory=self.path).start()
+        control = os.path.join(self.path, 'control.sock')
+        monitor.listen(control)
+        replies = []
+
+        def command(name):
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(control)
+            client.sendall(name + '\n')
+            reply = ''
+            while not reply.endswith('\n'):
+                reply += client.recv(4096)
+            client.close()
+            replies.append(json.loads(reply))
+
+        def blocked():
+            '''This is what the monitor should catch'''
+            busy(0.4)
+
+        reactor.callLater(0.2, blocked)
+        # The control socket is served by the reactor, so talk to it from
+        # another thread
+        reactor.callLater(0.8, reactor.callInThread, lambda: [command('profile'), command('status'),
+            command('unprofile'), reactor.callFromThread(reactor.stop)])
+        reactor.run()
+        monitor.stop()
+
+        self.assertTrue(monitor.maxLag >= 0.3)
+        self.assertEqual(len(monitor.stalls), 1)
+        when, seconds, stack = monitor.stalls[0]
+        self.assertTrue(seconds > 0.2)
+        self.assertTrue('testMonitor.py:blocked' in stack)
+        self.assertEqual(metrics.snapshot()['counters'].get('downpour_reactor_stalls_total'), 1)
+        self.assertEqual(replies[0], 'profiling')
+        self.assertTrue(replies[1]['profiling'])
+        self.assertTrue(os.path.exists(replies[2]))
+
+if __name__ == '__main__':
+    unittest.main()
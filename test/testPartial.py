@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+
+import gzip
+import logging
+import unittest
+from cStringIO import StringIO
+from downpour import logger, requestLogger
+from downpour import BaseFetcher, BaseRequest, SlimRequest, reactor
+from twisted.internet import protocol
+from twisted.protocols import basic
+
+logger.setLevel(logging.CRITICAL)
+requestLogger.setLevel(logging.CRITICAL)
+
+body = ''.join('line %i\n' % i for i in range(20000))
+
+def gzipped(text):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(text)
+    f.close()
+    return out.getvalue()
+
+class Server(basic.LineReceiver):
+    '''Answers HEAD without closing the connection, and ranges only for
+    /ranged. Everything else gets the whole body, whatever it asked for.'''
+    def connectionMade(self):
+        self.lines = []
+
+    def lineReceived(self, line):
+        if line:
+            return self.lines.append(line)
+        method, path, version = self.lines[0].split()
+        headers = dict(l.lower().split(': ', 1) for l in self.lines[1:])
+        self.factory.requests.append((method, path, headers.get('range')))
+        text, extra = body, []
+        if path == '/gzip':
+            text = gzipped(body)
+            extra.append('Content-Encoding: gzip')
+        if method == 'HEAD':
+            self.transport.write('HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n' % len(text))
+            return
+        if path == '/ranged' and headers.get('range'):
+            end = int(headers['range'].split('-')[1])
+            extra.append('Content-Range: bytes 0-%i/%i' % (end, len(text)))
+            self.respond('206 Partial Content', text[:end + 1], extra)
+        else:
+            self.respond('200 OK', text, extra)
+
+    def respond(self, status, text, extra):
+        self.transport.write('HTTP/1.1 %s\r\n%sContent-Length: %i\r\n\r\n%s' % (
+            status, ''.join(e + '\r\n' for e in extra), len(text), text))
+        self.transport.loseConnection()
+
+class Request(BaseRequest):
+    def __init__(self, url, results, head=False, prefix=None):
+        BaseRequest.__init__(self, url)
+        self.results = results
+        self.head = head
+        self.prefix = prefix
+
+    def onSuccess(self, text, fetcher):
+        self.results[self.url] = (text, self.truncated)
+
+    def onError(self, failure, fetcher):
+        self.results[self.url] = failure.value
+
+class Prefix(SlimRequest):
+    __slots__ = ('results',)
+    prefix = 100
+
+    def onSuccess(self, text, fetcher):
+        self.results[self.url] = (text, self.truncated)
+
+class TestPartial(unittest.TestCase):
+    def test_partial(self):
+        # This runs the reactor, and so has to be the only test that does
+        factory = protocol.ServerFactory()
+        factory.protocol = Server
+        factory.requests = []
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1').getHost().port
+        url = 'http://127.0.0.1:%i' % port
+        results = {}
+        slim = Prefix(url + '/slim')
+        slim.results = results
+        fetcher = BaseFetcher(poolSize=10, stopWhenDone=True, coalesce=True)
+        fetcher.extend([
+            Request(url + '/head', results, head=True),
+            Request(url + '/ranged', results, prefix=1000),
+            Request(url + '/ignored', results, prefix=1000),
+            Request(url + '/gzip', results, prefix=1000),
+            Request(url + '/all', results, prefix=len(body)),
+            Request(url + '/whole', results),
+            slim
+        ])
+        reactor.callLater(10, reactor.stop)
+        fetcher.start()
+        self.assertEqual(fetcher.numFlight, 0)
+        self.assertEqual(results[url + '/head'], ('', False))
+        self.assertEqual(results[url + '/ranged'], (body[:1000], True))
+        self.assertEqual(results[url + '/ignored'], (body[:1000], True))
+        self.assertEqual(results[url + '/all'], (body, False))
+        self.assertEqual(results[url + '/whole'], (body, False))
+        self.assertEqual(results[url + '/slim'], (body[:100], True))
+        # What could be decompressed of the start of it
+        text, truncated = results[url + '/gzip']
+        self.assertTrue(truncated)
+        self.assertTrue(len(text) > 1000 and body.startswith(text))
+        requests = dict((path, (method, ranged)) for method, path, ranged in factory.requests)
+        self.assertEqual(requests['/head'], ('HEAD', None))
+        self.assertEqual(requests['/ranged'], ('GET', 'bytes=0-999'))
+        self.assertEqual(requests['/whole'], ('GET', None))
+
+if __name__ == '__main__':
+    unittest.main()
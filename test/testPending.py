@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+import redis
+import logging
+import unittest
+import cPickle as pickle
+from downpour import BaseRequest, logger
+from downpour.test import redisOptions
+from downpour.PoliteFetcher import PoliteFetcher
+
+logger.setLevel(logging.CRITICAL)
+
+class Fetcher(PoliteFetcher):
+    '''Keeps what it sheds, rather than failing it'''
+    def __init__(self, *args, **kwargs):
+        PoliteFetcher.__init__(self, *args, **kwargs)
+        self.shedded = []
+
+    def shed(self, key, requests):
+        self.shedded.extend(requests)
+
+class TestPending(unittest.TestCase):
+    def setUp(self):
+        self.options = redisOptions()
+        self.r = redis.Redis(connection_pool=redis.ConnectionPool(**self.options))
+
+    def fetcher(self):
+        return Fetcher(allowAll=True, scanCount=2, **self.options)
+
+    def preexisting(self, urls):
+        # Domain queues from before there was a pending count
+        for url in urls:
+            self.r.lpush('domain:' + url.split('/')[2], pickle.dumps(BaseRequest(url), 1))
+
+    def test_push_pop(self):
+        f = self.fetcher()
+        f.extend([BaseRequest('http://a.example.com/1'), BaseRequest('http://b.example.com/1')])
+        f.push(BaseRequest('http://a.example.com/2'))
+        self.assertEqual(f.pending(), 3)
+        self.assertEqual(len(f), 3)
+        self.assertEqual(f.remaining, 3)
+        f.pop()
+        f.pop()
+        self.assertEqual(f.pending(), 1)
+        self.assertEqual(f.pop(polite=False).url, 'http://a.example.com/2')
+        self.assertEqual(f.pending(), 0)
+        self.assertEqual(self.r.get('pending'), '0')
+
+    def test_trim(self):
+        f = self.fetcher()
+        requests = [BaseRequest('http://a.example.com/%i' % i) for i in range(5)]
+        f.extend(requests)
+        f.push(BaseRequest('http://b.example.com/1'))
+        f.trim(requests[0], 2)
+        self.assertEqual(f.pending(), 3)
+        self.assertEqual(f.remaining, 3)
+        self.assertEqual(self.r.llen('domain:a.example.com'), 2)
+        # Trimming to more than there is changes nothing
+        f.trim(requests[0], 10)
+        self.assertEqual(f.pending(), 3)
+
+    def test_drain(self):
+        f = self.fetcher()
+        f.extend([BaseRequest('http://a.example.com/%i' % i) for i in range(3)])
+        f.push(BaseRequest('http://b.example.com/1'))
+        f.drain(f.shards[0], 'domain:a.example.com')
+        self.assertEqual(len(f.shedded), 3)
+        self.assertEqual(f.pending(), 1)
+        self.assertFalse(self.r.exists('domain:a.example.com'))
+
+    def test_scan(self):
+        urls = ['http://%s.example.com/1' % c for c in 'abcde']
+        self.preexisting(urls)
+        self.r.lpush('domain:a.example.com', pickle.dumps(BaseRequest(urls[0]), 1))
+        f = self.fetcher()
+        self.assertEqual(f.counting, set(f.shards))
+        # Until the queues have been counted, there might be something
+        self.assertEqual(f.pending(), 0)
+        self.assertEqual(len(f), 1)
+        for o in f.scan():
+            pass
+        self.assertEqual(f.counting, set())
+        self.assertEqual(f.pending(), 6)
+        self.assertEqual(f.remaining, 6)
+        self.assertEqual(len(f), 6)
+        # And every queue was scheduled
+        self.assertEqual(self.r.zcard('plds'), 5)
+        # A fetcher that finds the count just uses it
+        g = self.fetcher()
+        self.assertEqual(g.counting, set())
+        self.assertEqual(g.remaining, 6)
+
+    def test_touched(self):
+        # Queues that are pushed onto, popped from or trimmed before they're scanned
+        # are counted then, and not again
+        self.preexisting(['http://a.example.com/1', 'http://b.example.com/1', 'http://b.example.com/2'])
+        f = self.fetcher()
+        f.push(BaseRequest('http://a.example.com/2'))
+        f.push(BaseRequest('http://c.example.com/1'))
+        self.assertEqual(f.pop().url, 'http://c.example.com/1')
+        f.trim(BaseRequest('http://b.example.com/3'), 1)
+        # Another worker joins in on the count
+        g = self.fetcher()
+        self.assertEqual(g.counting, set(g.shards))
+        for o in f.scan():
+            pass
+        self.assertEqual(f.pending(), 3)
+        # What's been popped remains until it's done
+        self.assertEqual(f.remaining, 4)
+        self.assertFalse(self.r.exists('counting'))
+        self.assertFalse(self.r.exists('counted'))
+        # And once it's done, there's nothing left to count
+        for o in g.scan():
+            pass
+        self.assertEqual(g.pending(), 3)
+
+    def test_recount(self):
+        f = self.fetcher()
+        f.extend([BaseRequest('http://a.example.com/%i' % i) for i in range(3)])
+        self.r.set('pending', 17)
+        self.assertEqual(f.recount(), 3)
+        self.assertEqual(f.pending(), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+
+import logging
+import unittest
+import downpour
+from downpour import logger
+from downpour.ProxyPool import ProxyPool
+from twisted.internet import defer, error
+from twisted.python.failure import Failure
+
+logger.setLevel(logging.CRITICAL)
+
+class Fetcher(downpour.BaseFetcher):
+    '''Pops right away on its "threads", but only hands over what it popped
+    when asked. It keeps track of where it would connect, but doesn't.'''
+    def __init__(self, *args, **kwargs):
+        downpour.BaseFetcher.__init__(self, *args, **kwargs)
+        self.held      = []
+        self.connected = []
+
+    def deferToPool(self, f, *args, **kwargs):
+        d = defer.Deferred()
+        self.held.append((d, f(*args, **kwargs)))
+        return d
+
+    def handOver(self):
+        d, result = self.held.pop(0)
+        d.callback(result)
+
+    def connect(self, factory, scheme, host, port):
+        self.connected.append((factory, host, port))
+
+class TestProxyPool(unittest.TestCase):
+    def test_least_outstanding(self):
+        pool = ProxyPool(['http://a:3128', 'http://b:3128'])
+        first  = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.release(first, 0.1, 100)
+        # The one that's free gets the next request
+        self.assertEqual(pool.acquire(), first)
+
+    def test_weights(self):
+        pool = ProxyPool({'http://a:3128': 3, 'http://b:3128': 1})
+        counts = {'http://a:3128': 0, 'http://b:3128': 0}
+        for i in range(8):
+            counts[pool.acquire().url] += 1
+        self.assertEqual(counts, {'http://a:3128': 6, 'http://b:3128': 2})
+
+    def test_limit(self):
+        pool = ProxyPool([('http://a:3128', 1, 2)])
+        proxies = [pool.acquire(), pool.acquire()]
+        self.assertEqual(pool.acquire(), None)
+        # Waiting on the requests in flight
+        self.assertEqual(pool.wait(), None)
+        pool.release(proxies[0], 0.1)
+        self.assertEqual(pool.wait(), 0)
+
+    def test_eject(self):
+        pool = ProxyPool(['http://a:3128'], failures=2, cooldown=60)
+        for i in range(2):
+            proxy = pool.acquire()
+            pool.release(proxy, 1, ok=False)
+        stats = pool.stats()['http://a:3128']
+        self.assertTrue(stats['ejected'])
+        self.assertEqual(stats['ejections'], 1)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(pool.acquire(), None)
+        self.assertTrue(55 < pool.wait() <= 60)
+        # Other proxies take up the slack while it's out
+        pool.add('http://b:3128')
+        self.assertEqual(pool.wait(), 0)
+        for i in range(3):
+            self.assertEqual(pool.acquire().url, 'http://b:3128')
+
+    def test_recover(self):
+        # Successes in between failures keep a proxy in
+        pool = ProxyPool(['http://a:3128'], failures=2)
+        for ok in (False, True, False, True):
+            pool.release(pool.acquire(), 1, ok=ok)
+        self.assertFalse(pool.stats()['http://a:3128']['ejected'])
+
+    def test_stats(self):
+        pool = ProxyPool(['http://a:3128'])
+        proxy = pool.acquire()
+        pool.release(proxy, 2.0, 1000)
+        stats = pool.stats()['http://a:3128']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['latency'], 2.0)
+        self.assertEqual(stats['throughput'], 500.0)
+
+    def test_servicer(self):
+        from downpour.BaseRequestServicer import BaseRequestServicer
+        request = downpour.BaseRequest('http://example.com/page')
+        factory = BaseRequestServicer(request, 'rogerbot/1.0', proxy='http://a:3128')
+        self.assertEqual((factory.host, factory.port), ('a', 3128))
+        self.assertEqual(factory.path, 'http://example.com/page')
+        # And redirects keep going through it
+        factory.setURL('https://example.com/other')
+        self.assertEqual((factory.host, factory.port), ('a', 3128))
+
+    def test_reserved(self):
+        # A proxy is reserved before popping, so with one slot, the second
+        # thread doesn't pop what it would have had to send direct
+        pool    = ProxyPool([('http://a:3128', 1, 1)])
+        fetcher = Fetcher(poolSize=4, threads=2, proxies=pool)
+        fetcher.extend([downpour.BaseRequest('http://example.com/%i' % i) for i in range(2)])
+        self.assertEqual(len(fetcher.held), 1)
+        fetcher.handOver()
+        factory, host, port = fetcher.connected[0]
+        self.assertEqual((factory.url, host, port), ('http://example.com/1', 'a', 3128))
+        self.assertEqual(fetcher.held, [])
+        # Once it's done, the next is popped, and goes through it too
+        factory.clientConnectionFailed(None, Failure(error.ConnectionRefusedError()))
+        self.assertEqual(len(fetcher.held), 1)
+        fetcher.handOver()
+        self.assertEqual([(f.url, h) for f, h, p in fetcher.connected],
+            [('http://example.com/1', 'a'), ('http://example.com/0', 'a')])
+        self.assertEqual(fetcher.remaining, 1)
+
+    def test_awaiting(self):
+        # A request with nothing reserved for it, and no proxy to be had,
+        # waits for one rather than going direct
+        pool    = ProxyPool([('http://a:3128', 1, 1)])
+        fetcher = Fetcher(poolSize=4, proxies=pool)
+        proxy   = pool.acquire()
+        fetcher.fetch(downpour.BaseRequest('http://example.com/0'))
+        self.assertEqual(fetcher.connected, [])
+        self.assertEqual(fetcher.numFlight, 0)
+        self.assertEqual(len(fetcher.awaiting), 1)
+        pool.release(proxy, 0.1)
+        fetcher.serveNext()
+        self.assertEqual(fetcher.awaiting, [])
+        self.assertEqual([(f.url, h) for f, h, p in fetcher.connected],
+            [('http://example.com/0', 'a')])
+
+    def test_unused(self):
+        # What's reserved for a pop that comes back empty, or fails, is given back
+        pool    = ProxyPool([('http://a:3128', 1, 1)])
+        fetcher = Fetcher(poolSize=4, threads=1, proxies=pool)
+        for result in (None, Failure(ValueError('popping'))):
+            fetcher.serveNext()
+            d, popped = fetcher.held.pop(0)
+            self.assertEqual(pool.wait(), None)
+            d.callback(result)
+            self.assertEqual(pool.wait(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+import qr
+import redis
+import logging
+import unittest
+from downpour import BaseRequest, logger
+from downpour.test import redisOptions
+from downpour.PoliteFetcher import PoliteFetcher, Shard, Queue, PLDQueue
+
+logger.setLevel(logging.CRITICAL)
+
+class TestQueues(unittest.TestCase):
+    def setUp(self):
+        self.options = redisOptions()
+        # Queues must never make their own clients (or pools)
+        self.getRedis = qr.getRedis
+        def getRedis(**kwargs):
+            raise AssertionError('Made a redis client for a queue')
+        qr.getRedis = getRedis
+
+    def tearDown(self):
+        qr.getRedis = self.getRedis
+
+    def test_handles(self):
+        shard = Shard('s', redis.ConnectionPool(**self.options))
+        q = shard.queue('domain:a')
+        self.assertTrue(shard.queue('domain:a') is q)
+        self.assertTrue(q.redis is shard.r)
+        self.assertTrue(shard.pldQueue.redis is shard.r)
+        self.assertNotEqual(shard.queue('domain:b'), q)
+
+    def test_evict(self):
+        shard = Shard('s', redis.ConnectionPool(**self.options), queueCache=2)
+        a = shard.queue('domain:a')
+        b = shard.queue('domain:b')
+        # Using a makes b the least recently used
+        shard.queue('domain:a')
+        shard.queue('domain:c')
+        self.assertEqual(shard.queues.keys(), ['domain:a', 'domain:c'])
+        self.assertTrue(shard.queue('domain:a') is a)
+        self.assertFalse(shard.queue('domain:b') is b)
+
+    def test_standalone(self):
+        r = redis.Redis(connection_pool=redis.ConnectionPool(**self.options))
+        q = Queue('domain:a', r)
+        q.push('hello')
+        self.assertEqual(q.pop(), 'hello')
+        p = PLDQueue('plds', r)
+        p.push('domain:a', 5)
+        self.assertEqual(p.pop(), 'domain:a')
+
+    def test_pool(self):
+        # Without threads, everything goes over one connection
+        f = PoliteFetcher(allowAll=True, **self.options)
+        f.extend([BaseRequest('http://%s.example.com/' % c) for c in 'abcdefgh'])
+        while f.pop():
+            pass
+        self.assertEqual(f.pending(), 0)
+        self.assertEqual(f.shards[0].pool._created_connections, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+import time
+import unittest
+import downpour
+from downpour.RedirectCache import RedirectCache
+
+class Request(downpour.BaseRequest):
+    def __init__(self, *args, **kwargs):
+        downpour.BaseRequest.__init__(self, *args, **kwargs)
+        self.urls = []
+
+    def onURL(self, url):
+        self.urls.append(url)
+
+class TestRedirectCache(unittest.TestCase):
+    def test_permanent(self):
+        cache = RedirectCache()
+        cache.record('http://a.com/', 'http://www.a.com/', 301)
+        cache.record('http://www.a.com/', 'https://www.a.com/', '308')
+        self.assertEqual(cache.resolve('http://a.com/'),
+            ['http://a.com/', 'http://www.a.com/', 'https://www.a.com/'])
+        self.assertEqual(cache.resolve('http://b.com/'), ['http://b.com/'])
+        # Only as many hops as we're allowed to follow
+        self.assertEqual(len(cache.resolve('http://a.com/', 1)), 2)
+
+    def test_temporary(self):
+        cache = RedirectCache(ttl=-1)
+        cache.record('http://a.com/', 'http://www.a.com/', 302)
+        self.assertEqual(cache.get('http://a.com/'), None)
+        cache = RedirectCache(ttl=60)
+        cache.record('http://a.com/', 'http://www.a.com/', 307)
+        self.assertEqual(cache.get('http://a.com/'), 'http://www.a.com/')
+        # 303 changes the method, and so isn't remembered
+        cache.record('http://b.com/', 'http://www.b.com/', 303)
+        self.assertEqual(cache.get('http://b.com/'), None)
+
+    def test_loop(self):
+        cache = RedirectCache()
+        cache.record('http://a.com/', 'http://b.com/', 301)
+        cache.record('http://b.com/', 'http://a.com/', 301)
+        self.assertEqual(cache.resolve('http://a.com/'), ['http://a.com/'])
+
+    def test_bounded(self):
+        cache = RedirectCache(size=2)
+        for i in range(3):
+            cache.record('http://%i.com/' % i, 'http://www.%i.com/' % i, 301)
+        self.assertEqual(cache.get('http://0.com/'), None)
+        self.assertEqual(cache.get('http://2.com/'), 'http://www.2.com/')
+
+    def test_servicer(self):
+        from downpour.BaseRequestServicer import BaseRequestServicer
+        cache = RedirectCache()
+        request = Request('http://a.com/')
+        factory = BaseRequestServicer(request, 'rogerbot/1.0', cache)
+        factory.status = '301'
+        factory.setURL('/elsewhere')
+        self.assertEqual(cache.get('http://a.com/'), 'http://a.com/elsewhere')
+        # Future requests skip the hop, but still hear about it
+        request = Request('http://a.com/')
+        factory = BaseRequestServicer(request, 'rogerbot/1.0', cache, cache.resolve(request.url))
+        self.assertEqual(request.urls, ['http://a.com/', 'http://a.com/elsewhere'])
+        self.assertEqual(factory.path, '/elsewhere')
+
+if __name__ == '__main__':
+    unittest.main()
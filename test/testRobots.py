@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+import time
+import unittest
+from downpour import RobotsRequest
+from downpour.Robots import Robots, Rules, agentToken
+
+robots = '''
+# A comment
+User-agent: *
+Disallow: /private
+Allow: /private/public
+Disallow: /*.pdf$
+Crawl-delay: 5
+
+User-agent: rogerbot
+User-agent: otherbot
+Disallow: /roger
+Allow: /
+
+Sitemap: http://example.com/sitemap.xml
+'''
+
+class TestRobots(unittest.TestCase):
+    def test_agent(self):
+        self.assertEqual(agentToken('rogerbot/1.0'), 'rogerbot')
+        self.assertEqual(agentToken('MyAgent'), 'myagent')
+
+    def test_default(self):
+        rules = Rules.parse(robots, 'somebot')
+        self.assertEqual(rules.crawlDelay, 5.0)
+        self.assertEqual(rules.sitemaps, ['http://example.com/sitemap.xml'])
+        self.assertTrue(rules.allowed('http://example.com/'))
+        self.assertFalse(rules.allowed('http://example.com/private'))
+        self.assertFalse(rules.allowed('http://example.com/private/secrets'))
+        # The longest match wins
+        self.assertTrue(rules.allowed('http://example.com/private/public/index.html'))
+        self.assertFalse(rules.allowed('http://example.com/docs/file.pdf'))
+        self.assertTrue(rules.allowed('http://example.com/docs/file.pdf?page=2'))
+        # robots.txt itself is always allowed
+        self.assertTrue(rules.allowed('http://example.com/robots.txt'))
+
+    def test_agent_group(self):
+        for agent in ('rogerbot', 'otherbot'):
+            rules = Rules.parse(robots, agent)
+            self.assertEqual(rules.crawlDelay, None)
+            self.assertTrue(rules.allowed('http://example.com/private'))
+            self.assertFalse(rules.allowed('http://example.com/roger/1'))
+
+    def test_many_rules(self):
+        # More rules than Python 2 allows groups in one pattern
+        text = 'User-agent: *\n' + '\n'.join('Disallow: /%i/' % i for i in range(500))
+        rules = Rules.parse(text, 'rogerbot')
+        self.assertTrue(len(rules.matchers) > 1)
+        self.assertFalse(rules.allowed('http://example.com/0/'))
+        self.assertFalse(rules.allowed('http://example.com/499/foo'))
+        self.assertTrue(rules.allowed('http://example.com/500/'))
+
+    def test_cache(self):
+        cache = Robots('rogerbot/1.0', size=2)
+        self.assertEqual(cache.allowed('http://a.com/roger'), None)
+        cache.parse('http://a.com/robots.txt', robots)
+        self.assertEqual(cache.allowed('http://a.com/roger'), False)
+        self.assertEqual(cache.allowed('http://A.com/private'), True)
+        self.assertEqual(cache.check(['http://a.com/roger', 'http://a.com/', 'http://b.com/']),
+            [False, True, None])
+        # The least recently used domain is dropped
+        cache.parse('http://b.com/robots.txt', '')
+        cache.find('http://a.com/')
+        cache.parse('http://c.com/robots.txt', '')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.find('http://b.com/'), None)
+        self.assertNotEqual(cache.find('http://a.com/'), None)
+
+    def test_expiry(self):
+        cache = Robots('rogerbot/1.0')
+        cache.parse('http://a.com/robots.txt', robots, ttl=-1)
+        self.assertEqual(cache.find('http://a.com/'), None)
+
+    def test_request(self):
+        cache = Robots('rogerbot/1.0')
+        request = RobotsRequest('http://a.com/robots.txt', robots=cache)
+        request.onStatus('HTTP/1.1', '403', 'Forbidden')
+        request.onError(None, None)
+        self.assertEqual(cache.allowed('http://a.com/'), False)
+        request = RobotsRequest('http://b.com/robots.txt', robots=cache)
+        request.onStatus('HTTP/1.1', '404', 'Not Found')
+        request.onError(None, None)
+        self.assertEqual(cache.allowed('http://b.com/'), True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,6 +32,10 @@ fetcher.push(ExpectRequest('302 Redirect Test', host + 'asis/302_to_ok.asis', ex
 	host + 'asis/ok.asis'
 ]))
 
+fetcher.push(ExpectRequest('301 Timing Test', host + 'asis/301_to_ok.asis',
+	expectDone = lambda request: (len(request.timing.hops) == 2) and
+		(request.timing.breakdown()['ttfb'] is not None)))
+
 # Expect that we get a failure from various bad requests
 bad = [
 	('HTTP/1.1', '400', 'Bad Request'),
@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+
+import time
+import logging
+import unittest
+import threading
+from downpour import logger, Keys
+from downpour.test import host, redisOptions
+from downpour import BaseFetcher, BaseRequest, reactor
+from downpour.PoliteFetcher import PoliteFetcher
+from twisted.internet import task, defer
+
+logger.setLevel(logging.CRITICAL)
+
+class SlowFetcher(BaseFetcher):
+    '''A fetcher whose queue takes a while to pop from, like redis would'''
+    def __init__(self, *args, **kwargs):
+        BaseFetcher.__init__(self, *args, **kwargs)
+        self.threadsUsed = set()
+        self.done = []
+
+    def pop(self):
+        self.threadsUsed.add(threading.current_thread().name)
+        time.sleep(0.05)
+        return BaseFetcher.pop(self)
+
+    def onDone(self, request):
+        self.done.append(request.url)
+
+class HeldFetcher(PoliteFetcher):
+    '''Pops right away, but only hands over what it popped when asked, as
+    though its scheduler thread were slow about it. Anything else it would
+    do on its scheduler threads is done right away. Nothing's fetched.'''
+    def __init__(self, *args, **kwargs):
+        PoliteFetcher.__init__(self, *args, **kwargs)
+        self.held    = []
+        self.fetched = []
+        self.stopped = False
+
+    def deferToPool(self, f, *args, **kwargs):
+        if f != self.timedPop:
+            return defer.maybeDeferred(f, *args, **kwargs)
+        d = defer.Deferred()
+        self.held.append((d, f(*args, **kwargs)))
+        return d
+
+    def handOver(self):
+        d, result = self.held.pop(0)
+        d.callback(result)
+
+    def fetch(self, request, pooled=None):
+        with self.lock:
+            self.numFlight += 1
+        self.fetched.append(request)
+
+    def stop(self):
+        self.stopped = True
+
+class TestScheduler(unittest.TestCase):
+    def test_threads(self):
+        # This runs the reactor, and so has to be the only test that does
+        fetcher = SlowFetcher(poolSize=4, threads=2, stopWhenDone=True)
+        urls = [host + 'asis/ok.asis?%i' % i for i in range(20)]
+        fetcher.extend([BaseRequest(url) for url in urls])
+        # While the pops are sleeping, the reactor should carry on
+        ticks = []
+        ticker = task.LoopingCall(lambda: ticks.append(time.time()))
+        ticker.start(0.01)
+        start = time.time()
+        reactor.callLater(10, reactor.stop)
+        fetcher.start()
+        elapsed = time.time() - start
+        self.assertEqual(sorted(fetcher.done), sorted(urls))
+        self.assertEqual(len(fetcher), 0)
+        self.assertEqual(fetcher.numFlight, 0)
+        # Pops never happen on the reactor thread
+        self.assertFalse(threading.current_thread().name in fetcher.threadsUsed)
+        # More than one pop was waiting at a time
+        self.assertLess(elapsed, 21 * 0.05)
+        # The reactor ticked through them, rather than waiting on each
+        self.assertGreater(len(ticks), elapsed / 0.01 / 2)
+
+    def test_whenDone(self):
+        # A request that's been popped on a scheduler thread, but not yet
+        # handed over, is in neither numFlight nor len(), and it mustn't be
+        # lost by stopping early. BaseFetcher's len() would hide that.
+        fetcher = HeldFetcher(poolSize=4, threads=1, stopWhenDone=True,
+            delay=0, allowAll=True, **redisOptions())
+        for o in fetcher.scan():
+            pass
+        urls = ['http://%s.example.com/' % c for c in 'abc']
+        fetcher.extend([BaseRequest(url) for url in urls])
+        fetcher.serveNext()
+        for i in range(3):
+            # This fetches the next one, and pops the one after that
+            fetcher.handOver()
+            fetcher._done(fetcher.fetched[i])
+            self.assertFalse(fetcher.stopped)
+        # It's when the last pop comes back empty that it's done
+        fetcher.handOver()
+        self.assertTrue(fetcher.stopped)
+        self.assertEqual([r.url for r in fetcher.fetched], urls)
+
+    def test_unthreaded(self):
+        # Without threads, deferToPool calls right away
+        fetcher = BaseFetcher()
+        results = []
+        fetcher.deferToPool(lambda x: x + 1, 1).addCallback(results.append)
+        self.assertEqual(results, [2])
+        self.assertEqual(fetcher.pool, None)
+        fetcher.callOnReactor(results.append, 3)
+        self.assertEqual(results, [2, 3])
+
+    def test_unresolved(self):
+        # Hostnames that have to be resolved to find their keys are resolved
+        # on our scheduler threads, and never on the reactor
+        resolved = []
+        def resolve(host):
+            resolved.append((host, threading.current_thread().name))
+            return '10.0.0.1'
+        fetcher = HeldFetcher(threads=1, allowAll=True,
+            key=Keys.AddressKey(resolve=resolve), **redisOptions())
+        for o in fetcher.scan():
+            pass
+        pooled = []
+        def deferToPool(f, *args, **kwargs):
+            # Pushing happens on a scheduler thread that comes right back
+            if f != fetcher.route:
+                return HeldFetcher.deferToPool(fetcher, f, *args, **kwargs)
+            thread = threading.Thread(target=lambda: pooled.append(f(*args, **kwargs)))
+            thread.start()
+            thread.join()
+            return defer.succeed(pooled[-1])
+        fetcher.deferToPool = deferToPool
+        fetcher.extend([BaseRequest('http://a.example.com/'), BaseRequest('http://b.example.org/')])
+        self.assertEqual(len(pooled), 1)
+        self.assertEqual([host for host, thread in resolved], ['a.example.com', 'b.example.org'])
+        self.assertFalse(threading.current_thread().name in [thread for host, thread in resolved])
+        self.assertEqual(fetcher.keying, 0)
+        self.assertEqual(fetcher.remaining, 2)
+        # Once they're on their queue, serving them carries on
+        self.assertEqual(len(fetcher.held), 1)
+        self.assertEqual(fetcher.pending(), 1)
+        # Once they're known, there's nothing to hand off
+        fetcher.push(BaseRequest('http://a.example.com/other'))
+        self.assertEqual(len(pooled), 1)
+        self.assertEqual(fetcher.pending(), 2)
+        # And circuits never resolve anything
+        self.assertEqual(fetcher.circuitKey(BaseRequest('http://c.example.net/')), 'domain:c.example.net')
+        self.assertEqual(fetcher.circuitKey(BaseRequest('http://b.example.org/')), 'domain:10.0.0.1')
+        self.assertEqual(len(resolved), 2)
+
+if __name__ == '__main__':
+    unittest.main()
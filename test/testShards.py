@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+
+import time
+import redis
+import logging
+import unittest
+from downpour import BaseRequest, logger
+from downpour.test import redisOptions
+from downpour.PoliteFetcher import PoliteFetcher, Shard, PLDQueue, move, reshard
+
+logger.setLevel(logging.CRITICAL)
+
+class TestShards(unittest.TestCase):
+    urls = ['redis://one/', 'redis://two/', 'redis://three/']
+
+    def setUp(self):
+        # Each url is a separate (fake) redis
+        pools = dict((url, redis.ConnectionPool(**redisOptions(i)))
+            for i, url in enumerate(self.urls))
+        self.fromURL = Shard.fromURL
+        Shard.fromURL = staticmethod(lambda url, maxConnections=None, queueCache=10000:
+            Shard(url, pools[url], queueCache))
+
+    def tearDown(self):
+        Shard.fromURL = staticmethod(self.fromURL)
+
+    def requests(self, count):
+        return [BaseRequest('http://site%i.example.com/' % i) for i in range(count)]
+
+    def test_routing(self):
+        f = PoliteFetcher(allowAll=True, shards=self.urls[:2])
+        f.extend(self.requests(20))
+        for shard in f.shards:
+            keys = [key for keys in shard.keys() for key in keys]
+            self.assertTrue(keys)
+            for key in keys:
+                self.assertEqual(f.ring.get(key), shard.name)
+            self.assertEqual(shard.pending(), len(keys))
+            self.assertEqual(shard.r.zcard('plds'), len(keys))
+        self.assertEqual(f.pending(), 20)
+
+    def test_owns(self):
+        f = PoliteFetcher(allowAll=True, shards=self.urls[:2])
+        f.extend(self.requests(20))
+        owned = f.shards[0].pending()
+        g = PoliteFetcher(allowAll=True, shards=self.urls[:2], owns=self.urls[:1])
+        popped = []
+        while True:
+            r = g.pop()
+            if r is None:
+                break
+            popped.append(r)
+        self.assertTrue(owned)
+        self.assertEqual(len(popped), owned)
+        for r in popped:
+            self.assertEqual(g.ring.get(r._originalKey), self.urls[0])
+        self.assertEqual(f.shards[0].pending(), 0)
+        self.assertEqual(g.pending(), 0)
+        self.assertEqual(f.pending(), 20 - len(popped))
+
+    def test_move(self):
+        source, destination = [Shard.fromURL(url) for url in self.urls[:2]]
+        for i in range(3):
+            source.r.lpush('domain:a', str(i))
+        source.r.set('pending', 3)
+        source.pldQueue.push('domain:a', 12345)
+        self.assertEqual(move(source, destination, 'domain:a'), 3)
+        self.assertFalse(source.r.exists('domain:a'))
+        self.assertEqual(source.pending(), 0)
+        self.assertEqual(source.r.zcard('plds'), 0)
+        # The oldest is still popped first, and it's still scheduled for then
+        self.assertEqual(destination.r.lrange('domain:a', 0, -1), ['2', '1', '0'])
+        self.assertEqual(destination.pending(), 3)
+        self.assertEqual(destination.pldQueue.peek(withscores=True), ('domain:a', 12345))
+
+    def test_placeholder(self):
+        # A domain that was being worked on is just scheduled for now
+        source, destination = [Shard.fromURL(url) for url in self.urls[:2]]
+        source.pldQueue.push('domain:a', PLDQueue._PH)
+        self.assertEqual(move(source, destination, 'domain:a'), 0)
+        key, when = destination.pldQueue.peek(withscores=True)
+        self.assertEqual(key, 'domain:a')
+        self.assertTrue(when <= time.time())
+
+    def test_reshard(self):
+        f = PoliteFetcher(allowAll=True, shards=self.urls[:2], reliable=True, worker='w')
+        f.extend(self.requests(30))
+        # Something that's leased when we reshard goes back to be moved
+        leased = f.pop()
+        self.assertEqual(f.pending(), 29)
+        moved = reshard(self.urls[:2], self.urls)
+        self.assertTrue(moved)
+        g = PoliteFetcher(allowAll=True, shards=self.urls)
+        total = 0
+        for shard in g.shards:
+            keys = [key for keys in shard.keys() for key in keys]
+            self.assertTrue(keys)
+            for key in keys:
+                self.assertEqual(g.ring.get(key), shard.name)
+            self.assertEqual(shard.pending(), shard.count(keys))
+            self.assertEqual(shard.r.zcard('plds'), len(keys))
+            self.assertEqual(shard.r.llen('lease:w'), 0)
+            total += shard.pending()
+        self.assertEqual(total, 30)
+        self.assertEqual(g.shards[2].pending(), moved)
+        self.assertTrue(g.queue(leased._originalKey).redis.llen(leased._originalKey))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+import os
+import gzip
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from downpour.Sink import Sink, Records
+
+def record(i, body='hello'):
+    return {
+        'url'    : 'http://example.com/%i' % i,
+        'status' : '200',
+        'version': 'HTTP/1.1',
+        'message': 'OK',
+        'headers': {'content-type': ['text/html']},
+        'timing' : {'total': 0.1},
+        'body'   : body
+    }
+
+class TestSink(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_records(self):
+        sink = Sink(self.path, 'records')
+        for i in range(10):
+            sink.write(record(i))
+        sink.write({'url': 'http://example.com/failed', 'error': 'Connection refused'})
+        sink.close()
+        self.assertEqual(len(sink.files), 1)
+        self.assertEqual(os.listdir(self.path), [os.path.basename(sink.files[0])])
+        records = list(Records.read(sink.files[0]))
+        self.assertEqual(len(records), 11)
+        self.assertEqual(records[3]['url'], 'http://example.com/3')
+        self.assertEqual(records[3]['headers'], {'content-type': ['text/html']})
+        self.assertEqual(records[3]['body'], 'hello')
+        self.assertEqual(records[-1]['error'], 'Connection refused')
+
+    def test_warc(self):
+        sink = Sink(self.path, 'warc')
+        sink.write(record(1, 'the body'))
+        sink.write({'url': 'http://example.com/failed', 'error': 'Connection refused'})
+        sink.close()
+        self.assertTrue(sink.files[0].endswith('.warc.gz'))
+        text = gzip.open(sink.files[0]).read()
+        self.assertEqual(text.count('WARC/1.0\r\n'), 2)
+        self.assertTrue('WARC-Type: warcinfo\r\n' in text)
+        self.assertTrue('WARC-Target-URI: http://example.com/1\r\n' in text)
+        self.assertTrue('HTTP/1.1 200 OK\r\ncontent-type: text/html\r\n\r\nthe body\r\n\r\n' in text)
+        self.assertFalse('failed' in text)
+
+    def test_rotate(self):
+        sink = Sink(self.path, 'records', batchBytes=1, rotateBytes=1)
+        for i in range(3):
+            sink.write(record(i))
+            # Let each be written in its own batch
+            deadline = time.time() + 5
+            while sink.records <= i and time.time() < deadline:
+                time.sleep(0.01)
+        sink.close()
+        self.assertTrue(len(sink.files) > 1)
+        self.assertEqual(sum(len(list(Records.read(path))) for path in sink.files), 3)
+
+    def test_backpressure(self):
+        drained = threading.Event()
+        sink = Sink(self.path, 'records', maxBytes=10000, interval=0.05)
+        sink.drained = drained.set
+        self.assertFalse(sink.full())
+        for i in range(10):
+            sink.write(record(i, 'x' * 1000))
+        self.assertTrue(sink.full())
+        # Once the writer catches up, we hear about it
+        drained.wait(5)
+        self.assertTrue(drained.is_set())
+        self.assertFalse(sink.full())
+        sink.close()
+
+if __name__ == '__main__':
+    unittest.main()
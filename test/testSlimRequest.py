@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+import gc
+import pickle
+import unittest
+import downpour
+from downpour import SlimRequest
+
+class Request(SlimRequest):
+    __slots__ = ('depth',)
+
+    def __init__(self, url, depth=0, **kwargs):
+        SlimRequest.__init__(self, url, **kwargs)
+        self.depth = depth
+
+class LooseRequest(SlimRequest):
+    pass
+
+class TestSlimRequest(unittest.TestCase):
+    def test_slots(self):
+        request = Request('http://example.com/#fragment', depth=2)
+        self.assertFalse(hasattr(request, '__dict__'))
+        self.assertEqual(request.url, 'http://example.com/')
+        self.assertEqual(request.timeout, 45)
+        self.assertRaises(AttributeError, setattr, request, 'whatever', 1)
+
+    def test_headers(self):
+        a = SlimRequest('http://a.com/', headers={'Accept': 'text/html'})
+        b = SlimRequest('http://b.com/', headers={'Accept': 'text/html'})
+        self.assertTrue(a.headers is b.headers)
+        self.assertEqual(SlimRequest('http://c.com/').headers, {})
+
+    def test_pickle(self):
+        request = Request('http://example.com/', depth=3, headers={'Accept': 'text/html'})
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(request, protocol))
+            self.assertEqual((copy.url, copy.depth, copy.headers),
+                ('http://example.com/', 3, {'Accept': 'text/html'}))
+            self.assertTrue(copy.headers is request.headers)
+        # Subclasses that didn't use slots keep their other attributes
+        request = LooseRequest('http://example.com/')
+        request.depth = 4
+        self.assertEqual(pickle.loads(pickle.dumps(request)).depth, 4)
+
+    def test_servicer(self):
+        from downpour.BaseRequestServicer import BaseRequestServicer
+        request = SlimRequest('http://example.com/', headers={'Accept': 'text/html'})
+        factory = BaseRequestServicer(request, 'rogerbot/1.0')
+        factory.setURL('http://example.com/elsewhere')
+        self.assertEqual(factory.headers['Accept'], 'text/html')
+        self.assertEqual(request.timing.hops[-1]['url'], 'http://example.com/elsewhere')
+        # Once it's done, the servicer lets go of the request
+        factory.finished(None)
+        self.assertEqual(factory.request, None)
+
+    def test_collected(self):
+        # Without a finalizer, a request caught in a cycle is still freed
+        gc.collect()
+        request = downpour.BaseRequest('http://example.com/')
+        request.cycle = request
+        del request
+        gc.collect()
+        self.assertEqual(gc.garbage, [])
+
+if __name__ == '__main__':
+    unittest.main()
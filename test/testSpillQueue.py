@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+import downpour
+from downpour.SpillQueue import SpillQueue
+
+class TestSpillQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_fifo(self):
+        queue = SpillQueue(self.path, window=3)
+        queue.extend(range(10))
+        queue.append(10)
+        self.assertEqual(len(queue), 11)
+        self.assertEqual([queue.pop() for i in range(5)], range(5))
+        # Interleaved with more being added
+        queue.append(11)
+        self.assertEqual([queue.pop() for i in range(7)], range(5, 12))
+        self.assertEqual(len(queue), 0)
+        self.assertRaises(IndexError, queue.pop)
+        # The window is all that's held in memory
+        queue.extend(range(100))
+        queue.pop()
+        self.assertTrue(len(queue.buffer) <= 3)
+
+    def test_segments(self):
+        queue = SpillQueue(self.path, segmentSize=100, sync=1)
+        queue.extend('x' * 20 for i in range(20))
+        self.assertTrue(len(self.segments()) > 3)
+        for i in range(20):
+            self.assertEqual(queue.pop(), 'x' * 20)
+        # Segments that have been read are removed
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_resume(self):
+        queue = SpillQueue(self.path, window=2, sync=5)
+        queue.extend(range(20))
+        popped = [queue.pop() for i in range(7)]
+        # If we crash, we start over from the last save
+        queue = SpillQueue(self.path, window=2, sync=5)
+        self.assertEqual(len(queue), 15)
+        self.assertEqual(queue.pop(), 5)
+        # If we close it, we start from exactly where we were
+        queue.close()
+        queue = SpillQueue(self.path, window=2, sync=5)
+        queue.append(20)
+        self.assertEqual(len(queue), 15)
+        self.assertEqual([queue.pop() for i in range(15)], range(6, 21))
+
+    def test_torn(self):
+        # A record that was cut short is skipped, and writing carries on in
+        # a new segment
+        queue = SpillQueue(self.path)
+        queue.extend(range(3))
+        queue.close()
+        with open(os.path.join(self.path, self.segments()[-1]), 'ab') as f:
+            f.write('\x00\x00\x01\x00abc')
+        queue = SpillQueue(self.path)
+        queue.append(3)
+        self.assertEqual(len(queue), 4)
+        self.assertEqual([queue.pop() for i in range(4)], range(4))
+
+    def test_fetcher(self):
+        queue = SpillQueue(self.path)
+        queue.extend(downpour.BaseRequest('http://example.com/%i' % i) for i in range(3))
+        fetcher = downpour.BaseFetcher(queue=queue)
+        self.assertEqual(len(fetcher), 3)
+        self.assertEqual(fetcher.pop().url, 'http://example.com/0')
+
+if __name__ == '__main__':
+    unittest.main()
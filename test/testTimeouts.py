@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+
+import socket
+import logging
+import unittest
+from downpour import logger, requestLogger
+from downpour import BaseFetcher, BaseRequest, reactor
+from downpour import ConnectTimeout, FirstByteTimeout, IdleTimeout, DeadlineTimeout, RequestTimeout
+from twisted.internet import protocol, task
+
+logger.setLevel(logging.CRITICAL)
+requestLogger.setLevel(logging.CRITICAL)
+
+class Silent(protocol.Protocol):
+    '''Accepts the connection, and then says nothing'''
+    pass
+
+class Stalls(protocol.Protocol):
+    '''Starts the response, and then stops partway through'''
+    def connectionMade(self):
+        self.transport.write('HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nHello')
+
+class Trickles(protocol.Protocol):
+    '''Sends the response a byte at a time, and never finishes'''
+    def connectionMade(self):
+        self.transport.write('HTTP/1.1 200 OK\r\nContent-Length: 100000\r\n\r\n')
+        self.call = task.LoopingCall(self.transport.write, '.')
+        self.call.start(0.02)
+
+    def connectionLost(self, reason):
+        self.call.stop()
+
+def listen(protocolClass):
+    factory = protocol.ServerFactory()
+    factory.protocol = protocolClass
+    return 'http://127.0.0.1:%i/' % reactor.listenTCP(0, factory, interface='127.0.0.1').getHost().port
+
+def unaccepting():
+    '''A port whose backlog is full, so that connecting to it hangs'''
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(0)
+    port = server.getsockname()[1]
+    filler = []
+    for i in range(3):
+        client = socket.socket()
+        client.setblocking(0)
+        client.connect_ex(('127.0.0.1', port))
+        filler.append(client)
+    return 'http://127.0.0.1:%i/' % port, [server] + filler
+
+class Request(BaseRequest):
+    def __init__(self, url, errors, **timeouts):
+        BaseRequest.__init__(self, url)
+        self.errors = errors
+        for name, value in timeouts.items():
+            setattr(self, name, value)
+
+    def onError(self, failure, fetcher):
+        self.errors[self.url] = failure.value
+
+class TestTimeouts(unittest.TestCase):
+    def test_timeouts(self):
+        # This runs the reactor, and so has to be the only test that does
+        errors = {}
+        silent, stalls, trickles = listen(Silent), listen(Stalls), listen(Trickles)
+        hangs, sockets = unaccepting()
+        fetcher = BaseFetcher(poolSize=10, stopWhenDone=True, timeouts={'connect': 0.3, 'idle': 0.3})
+        fetcher.extend([
+            Request(silent, errors, firstByteTimeout=0.2),
+            Request(stalls, errors),
+            Request(trickles, errors, timeout=0.5),
+            Request(hangs, errors)
+        ])
+        reactor.callLater(10, reactor.stop)
+        fetcher.start()
+        self.assertTrue(isinstance(errors[silent], FirstByteTimeout))
+        self.assertTrue(isinstance(errors[stalls], IdleTimeout))
+        self.assertTrue(isinstance(errors[trickles], DeadlineTimeout))
+        self.assertTrue(isinstance(errors[hangs], ConnectTimeout))
+        self.assertTrue(all(isinstance(e, RequestTimeout) for e in errors.values()))
+        self.assertEqual(errors[trickles].seconds, 0.5)
+        self.assertEqual(fetcher.numFlight, 0)
+        for s in sockets:
+            s.close()
+
+if __name__ == '__main__':
+    unittest.main()